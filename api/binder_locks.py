@@ -0,0 +1,220 @@
+import time
+import logging
+import gevent
+import redis as redis_lib
+from gevent import sleep as cooperative_sleep
+from common import load_yaml, get_redis, get_owner_repo_provider, REDIS_LOCK_DB
+
+"""
+Locks of BinderHub builds.
+
+A single build per repository runs at a time, shared by the preview
+and preprint processes. The lock is a Redis lease owned by the build
+task, renewed while the build streams, so that it expires shortly
+after its holder dies. Other build requests wait in a FIFO queue
+instead of being rejected.
+"""
+
+common_config = load_yaml('config/common.yaml')
+
+# Seconds a lease lasts without renewal. Renewed every third of it.
+BINDER_LOCK_LEASE = common_config.get('BINDER_LOCK_LEASE', 120)
+# Seconds between two attempts of a waiting build.
+BINDER_LOCK_POLL = common_config.get('BINDER_LOCK_POLL', 10)
+# Leases are not renewed beyond this many seconds, in case the holder
+# never releases them (matches the build task time limit).
+BINDER_LOCK_MAX_HOLD = common_config.get('BINDER_LOCK_MAX_HOLD', 6000)
+
+LOCK_KEY_PREFIX = "binder-build-lock:"
+QUEUE_KEY_PREFIX = "binder-build-queue:"
+ALIVE_KEY_PREFIX = "binder-build-waiting:"
+
+# Drops queue entries of builds that stopped polling, then takes the
+# lease if it is free and the build is at the head of the queue.
+# Returns 0 if acquired, the queue position otherwise.
+_ACQUIRE_SCRIPT = """
+local holder = ARGV[1]
+for _, member in ipairs(redis.call('ZRANGE', KEYS[2], 0, -1)) do
+    if member ~= holder and redis.call('EXISTS', ARGV[4] .. member) == 0 then
+        redis.call('ZREM', KEYS[2], member)
+    end
+end
+if redis.call('GET', KEYS[1]) == holder then
+    redis.call('ZREM', KEYS[2], holder)
+    return 0
+end
+if not redis.call('ZRANK', KEYS[2], holder) then
+    redis.call('ZADD', KEYS[2], tonumber(ARGV[3]), holder)
+end
+local rank = redis.call('ZRANK', KEYS[2], holder)
+if rank == 0 and redis.call('SET', KEYS[1], holder, 'NX', 'EX', tonumber(ARGV[2])) then
+    redis.call('ZREM', KEYS[2], holder)
+    return 0
+end
+return rank + 1
+"""
+
+# Extends the lease if it is still owned by the holder.
+_RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], tonumber(ARGV[2]))
+end
+return 0
+"""
+
+# Deletes the lease if it is still owned by the holder.
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+def get_lock_name(repo_url):
+    """
+    Simple helper function to identify the lock of a repository.
+    """
+    [owner, repo, provider] = get_owner_repo_provider(repo_url)
+    return f"{provider}/{owner}/{repo}"
+
+class BinderBuildLock:
+    """
+    Lease on the BinderHub build of a repository.
+
+    lock = BinderBuildLock(repo_url, task_id)
+    if lock.acquire(timeout=rate_limit * 60, on_wait=report_position):
+        lock.keep_alive()
+        try:
+            ... stream the build
+        finally:
+            lock.release()
+    """
+    def __init__(self, repo_url, holder, lease=BINDER_LOCK_LEASE):
+        self.name = get_lock_name(repo_url)
+        self.holder = holder
+        self.lease = lease
+        self.redis = get_redis(REDIS_LOCK_DB)
+        self.acquired = False
+        self._renewer = None
+
+    @property
+    def key(self):
+        return f"{LOCK_KEY_PREFIX}{self.name}"
+
+    @property
+    def queue_key(self):
+        return f"{QUEUE_KEY_PREFIX}{self.name}"
+
+    def try_acquire(self):
+        """
+        Returns 0 if acquired, position in the queue otherwise.
+        """
+        self.redis.set(f"{ALIVE_KEY_PREFIX}{self.holder}", 1, ex=BINDER_LOCK_POLL * 3)
+        script = self.redis.register_script(_ACQUIRE_SCRIPT)
+        return int(script(keys=[self.key, self.queue_key],
+                          args=[self.holder, self.lease, time.time(), ALIVE_KEY_PREFIX]))
+
+    def acquire(self, timeout, on_wait=None):
+        """
+        Waits (cooperatively) until the lease is acquired.
+
+        on_wait
+            Called with the position in the queue whenever it changes.
+
+        Returns True if acquired, False on timeout. Proceeds without
+        a lock if Redis is unavailable.
+        """
+        deadline = time.time() + timeout
+        last_position = None
+        while True:
+            try:
+                position = self.try_acquire()
+            except redis_lib.exceptions.RedisError as e:
+                logging.warning(f"Binder build locks unavailable, building {self.name} unlocked: {e}")
+                return True
+            if position == 0:
+                self.acquired = True
+                logging.info(f"Binder build lock of {self.name} acquired by {self.holder}.")
+                return True
+            if time.time() > deadline:
+                self._leave_queue()
+                return False
+            if position != last_position and on_wait is not None:
+                on_wait(position)
+            last_position = position
+            cooperative_sleep(BINDER_LOCK_POLL)
+
+    def renew(self):
+        """
+        Extends the lease. Returns False if it was lost (expired or
+        force released).
+        """
+        try:
+            script = self.redis.register_script(_RENEW_SCRIPT)
+            return bool(script(keys=[self.key], args=[self.holder, self.lease]))
+        except redis_lib.exceptions.RedisError as e:
+            logging.warning(f"Could not renew the binder build lock of {self.name}: {e}")
+            return True
+
+    def _renew_forever(self):
+        deadline = time.time() + BINDER_LOCK_MAX_HOLD
+        while self.acquired and time.time() < deadline:
+            cooperative_sleep(self.lease / 3)
+            if self.acquired and not self.renew():
+                logging.warning(f"Binder build lock of {self.name} is no longer held by {self.holder}.")
+                self.acquired = False
+
+    def keep_alive(self):
+        """
+        Renews the lease in the background until it is released.
+        """
+        if self.acquired and self._renewer is None:
+            self._renewer = gevent.spawn(self._renew_forever)
+
+    def _leave_queue(self):
+        try:
+            pipe = self.redis.pipeline()
+            pipe.zrem(self.queue_key, self.holder)
+            pipe.delete(f"{ALIVE_KEY_PREFIX}{self.holder}")
+            pipe.execute()
+        except redis_lib.exceptions.RedisError as e:
+            logging.warning(f"Could not remove {self.holder} from the binder build queue of {self.name}: {e}")
+
+    def release(self):
+        """
+        Frees the lease (or the place in the queue). Safe to call twice.
+        """
+        was_acquired = self.acquired
+        self.acquired = False
+        if self._renewer is not None:
+            self._renewer.kill(block=False)
+            self._renewer = None
+        self._leave_queue()
+        if not was_acquired:
+            return
+        try:
+            script = self.redis.register_script(_RELEASE_SCRIPT)
+            script(keys=[self.key], args=[self.holder])
+        except redis_lib.exceptions.RedisError as e:
+            logging.warning(f"Could not release the binder build lock of {self.name}: {e}")
+
+def get_lock_status(repo_url):
+    """
+    Returns (holder, remaining lease in seconds, number of waiting
+    builds), holder is None if the repository is not locked.
+    """
+    name = get_lock_name(repo_url)
+    redis_client = get_redis(REDIS_LOCK_DB)
+    pipe = redis_client.pipeline()
+    pipe.get(f"{LOCK_KEY_PREFIX}{name}")
+    pipe.ttl(f"{LOCK_KEY_PREFIX}{name}")
+    pipe.zcard(f"{QUEUE_KEY_PREFIX}{name}")
+    holder, ttl, waiting = pipe.execute()
+    return (holder.decode() if holder else None), max(ttl, 0), waiting
+
+def force_release(repo_url):
+    """
+    Removes the lock of a repository whoever holds it, the next
+    build in the queue takes it. Returns False if it was not locked.
+    """
+    return bool(get_redis(REDIS_LOCK_DB).delete(f"{LOCK_KEY_PREFIX}{get_lock_name(repo_url)}"))
@@ -0,0 +1,252 @@
+import os
+import json
+import time
+import logging
+import psutil
+import redis as redis_lib
+from gevent import sleep as cooperative_sleep
+from common import load_yaml, get_redis, REDIS_LOCK_DB
+
+"""
+Resource-aware admission control for MyST builds.
+
+Every build reserves CPU, memory and disk before spawning its
+execution container. Reservations of all worker processes are kept
+in Redis, a build is admitted only when its reservation fits in the
+capacity of the host, otherwise it waits in a FIFO queue. The
+container limits are derived from the reservation.
+"""
+
+common_config = load_yaml('config/common.yaml')
+
+DATA_ROOT_PATH = common_config['DATA_ROOT_PATH']
+
+# Resources kept for the host (OS, web servers, workers)
+BUILD_RESERVED_CPUS = common_config.get('BUILD_RESERVED_CPUS', 2)
+BUILD_RESERVED_MEMORY_GB = common_config.get('BUILD_RESERVED_MEMORY_GB', 4)
+BUILD_MIN_FREE_DISK_GB = common_config.get('BUILD_MIN_FREE_DISK_GB', 20)
+# Reservation of a single build
+BUILD_CPUS = common_config.get('BUILD_CPUS', 2)
+BUILD_MEMORY_GB = common_config.get('BUILD_MEMORY_GB', 8)
+BUILD_DISK_GB = common_config.get('BUILD_DISK_GB', 10)
+# Seconds between two admission attempts, and maximum waiting time
+BUILD_ADMISSION_POLL = common_config.get('BUILD_ADMISSION_POLL', 15)
+BUILD_ADMISSION_TIMEOUT = common_config.get('BUILD_ADMISSION_TIMEOUT', 1800)
+# Reservations of builds that did not release them (e.g., killed worker)
+# expire after this many seconds (matches the build task time limit).
+BUILD_RESERVATION_TTL = common_config.get('BUILD_RESERVATION_TTL', 6000)
+# Bounds of the notebooks executed in parallel by a build, and memory
+# expected per notebook (see get_execute_parallel).
+MYST_EXECUTE_PARALLEL_MIN = common_config.get('MYST_EXECUTE_PARALLEL_MIN', 1)
+MYST_EXECUTE_PARALLEL_MAX = common_config.get('MYST_EXECUTE_PARALLEL_MAX', 4)
+MYST_EXECUTE_NOTEBOOK_MEMORY_GB = common_config.get('MYST_EXECUTE_NOTEBOOK_MEMORY_GB', 2)
+
+RESERVATIONS_KEY = "build-admission:reservations"
+QUEUE_KEY = "build-admission:queue"
+ALIVE_KEY_PREFIX = "build-admission:alive:"
+
+# Drops expired reservations and queue entries of builds that stopped
+# polling, then admits the build if it is at the head of the queue and
+# its reservation fits. Returns 0 if admitted, the queue position otherwise.
+_ADMIT_SCRIPT = """
+local task_id = ARGV[1]
+local now = tonumber(ARGV[2])
+local cpus = tonumber(ARGV[3])
+local memory = tonumber(ARGV[4])
+local disk = tonumber(ARGV[5])
+local cap_cpus = tonumber(ARGV[6])
+local cap_memory = tonumber(ARGV[7])
+local cap_disk = tonumber(ARGV[8])
+
+local used_cpus, used_memory, used_disk = 0, 0, 0
+local reservations = redis.call('HGETALL', KEYS[1])
+for i = 1, #reservations, 2 do
+    local r = cjson.decode(reservations[i + 1])
+    if r['expires'] < now then
+        redis.call('HDEL', KEYS[1], reservations[i])
+    elseif reservations[i] ~= task_id then
+        used_cpus = used_cpus + r['cpus']
+        used_memory = used_memory + r['memory_gb']
+        used_disk = used_disk + r['disk_gb']
+    end
+end
+
+for _, member in ipairs(redis.call('ZRANGE', KEYS[2], 0, -1)) do
+    if member ~= task_id and redis.call('EXISTS', ARGV[10] .. member) == 0 then
+        redis.call('ZREM', KEYS[2], member)
+    end
+end
+if not redis.call('ZRANK', KEYS[2], task_id) then
+    redis.call('ZADD', KEYS[2], now, task_id)
+end
+local rank = redis.call('ZRANK', KEYS[2], task_id)
+
+if rank == 0 and used_cpus + cpus <= cap_cpus and used_memory + memory <= cap_memory and used_disk + disk <= cap_disk then
+    redis.call('HSET', KEYS[1], task_id, ARGV[9])
+    redis.call('ZREM', KEYS[2], task_id)
+    return 0
+end
+return rank + 1
+"""
+
+def get_build_capacity():
+    """
+    Returns the (cpus, memory_gb, disk_gb) that builds can share on this host.
+
+    Disk capacity is based on the current free space, so it is
+    conservative: the space already written by running builds is
+    counted both as used and as reserved.
+    """
+    cpus = max(1, (os.cpu_count() or 1) - BUILD_RESERVED_CPUS)
+    memory_gb = max(1, psutil.virtual_memory().total / (1024 ** 3) - BUILD_RESERVED_MEMORY_GB)
+    disk_gb = max(0, psutil.disk_usage(DATA_ROOT_PATH).free / (1024 ** 3) - BUILD_MIN_FREE_DISK_GB)
+    return cpus, memory_gb, disk_gb
+
+class BuildAdmission:
+    """
+    Reservation of build resources for a task.
+
+    admission = BuildAdmission(task_id, "owner/repo")
+    if admission.acquire(on_wait=report_position):
+        try:
+            ... spawn container with admission.cpu_limit, admission.memory_limit
+        finally:
+            admission.release()
+    """
+    def __init__(self, task_id, repository, cpus=BUILD_CPUS, memory_gb=BUILD_MEMORY_GB, disk_gb=BUILD_DISK_GB):
+        self.task_id = task_id
+        self.repository = repository
+        self.redis = get_redis(REDIS_LOCK_DB)
+        cap_cpus, cap_memory_gb, _ = get_build_capacity()
+        # A build never reserves more than the whole capacity,
+        # otherwise it would never be admitted.
+        self.cpus = min(cpus, cap_cpus)
+        self.memory_gb = min(memory_gb, cap_memory_gb)
+        self.disk_gb = disk_gb
+        self.admitted = False
+        self._script = self.redis.register_script(_ADMIT_SCRIPT)
+
+    @property
+    def cpu_limit(self):
+        return self.cpus
+
+    @property
+    def memory_limit(self):
+        return f"{int(self.memory_gb)}g"
+
+    def try_acquire(self):
+        """
+        Returns 0 if admitted, position in the queue otherwise.
+        """
+        cap_cpus, cap_memory_gb, cap_disk_gb = get_build_capacity()
+        now = time.time()
+        reservation = json.dumps(dict(cpus=self.cpus, memory_gb=self.memory_gb, disk_gb=self.disk_gb,
+                                      repository=self.repository, admitted_at=now,
+                                      expires=now + BUILD_RESERVATION_TTL))
+        self.redis.set(f"{ALIVE_KEY_PREFIX}{self.task_id}", 1, ex=BUILD_ADMISSION_POLL * 3)
+        return int(self._script(keys=[RESERVATIONS_KEY, QUEUE_KEY],
+                                args=[self.task_id, now, self.cpus, self.memory_gb, self.disk_gb,
+                                      cap_cpus, cap_memory_gb, cap_disk_gb,
+                                      reservation, ALIVE_KEY_PREFIX]))
+
+    def acquire(self, on_wait=None, timeout=BUILD_ADMISSION_TIMEOUT):
+        """
+        Waits (cooperatively) until the build is admitted.
+
+        on_wait
+            Called with the position in the queue whenever it changes.
+
+        Returns True if admitted, False on timeout. Admits the build
+        if Redis is unavailable.
+        """
+        deadline = time.time() + timeout
+        last_position = None
+        while True:
+            try:
+                position = self.try_acquire()
+            except redis_lib.exceptions.RedisError as e:
+                logging.warning(f"Build admission unavailable, admitting {self.repository}: {e}")
+                self.admitted = True
+                return True
+            if position == 0:
+                self.admitted = True
+                logging.info(f"Build {self.task_id} ({self.repository}) admitted with {self.cpus} CPUs, {self.memory_limit} memory.")
+                return True
+            if time.time() > deadline:
+                self._leave_queue()
+                return False
+            if position != last_position and on_wait is not None:
+                on_wait(position)
+            last_position = position
+            cooperative_sleep(BUILD_ADMISSION_POLL)
+
+    def _leave_queue(self):
+        try:
+            pipe = self.redis.pipeline()
+            pipe.zrem(QUEUE_KEY, self.task_id)
+            pipe.delete(f"{ALIVE_KEY_PREFIX}{self.task_id}")
+            pipe.execute()
+        except redis_lib.exceptions.RedisError as e:
+            logging.warning(f"Could not remove build {self.task_id} from the queue: {e}")
+
+    def release(self):
+        """
+        Frees the reservation (or the place in the queue).
+        """
+        self._leave_queue()
+        try:
+            self.redis.hdel(RESERVATIONS_KEY, self.task_id)
+        except redis_lib.exceptions.RedisError as e:
+            logging.warning(f"Could not release build reservation {self.task_id}: {e}")
+        self.admitted = False
+
+def get_build_reservations():
+    """
+    Returns the active reservations {task_id: reservation} and the queue.
+    """
+    redis_client = get_redis(REDIS_LOCK_DB)
+    reservations = {k.decode(): json.loads(v) for k, v in redis_client.hgetall(RESERVATIONS_KEY).items()}
+    queue = [m.decode() for m in redis_client.zrange(QUEUE_KEY, 0, -1)]
+    return reservations, queue
+
+def _memory_gb(memory_limit):
+    """
+    Memory limit of a container ("8g", "512m") in GB, None if unlimited.
+    """
+    units = {'g': 1, 'm': 1 / 1024, 'k': 1 / 1024 ** 2}
+    if isinstance(memory_limit, str) and memory_limit[-1:].lower() in units:
+        try:
+            return float(memory_limit[:-1]) * units[memory_limit[-1].lower()]
+        except ValueError:
+            return None
+    return None
+
+def get_execute_parallel(cpu_limit, memory_limit):
+    """
+    Chooses how many notebooks a build executes in parallel, from the
+    current CPU and memory headroom of the host and the number of
+    admitted builds, within MYST_EXECUTE_PARALLEL_MIN/MAX.
+
+    Returns (parallel, details), details are recorded in the build log.
+    """
+    try:
+        builds = max(1, len(get_build_reservations()[0]))
+    except redis_lib.exceptions.RedisError:
+        builds = 1
+    cap_cpus, cap_memory_gb, _ = get_build_capacity()
+    # CPUs not used over the last minute, shared with the builds that
+    # are starting at the same time.
+    idle_cpus = (os.cpu_count() or 1) - os.getloadavg()[0] - BUILD_RESERVED_CPUS
+    cpus = min(cap_cpus / builds, max(1, idle_cpus))
+    if isinstance(cpu_limit, (int, float)):
+        cpus = min(cpus, cpu_limit)
+    # Memory that is actually free, running builds already use theirs.
+    available_memory_gb = psutil.virtual_memory().available / (1024 ** 3) - BUILD_RESERVED_MEMORY_GB
+    memory_gb = available_memory_gb
+    if _memory_gb(memory_limit) is not None:
+        memory_gb = min(memory_gb, _memory_gb(memory_limit))
+    parallel = int(min(cpus, memory_gb / MYST_EXECUTE_NOTEBOOK_MEMORY_GB))
+    parallel = max(MYST_EXECUTE_PARALLEL_MIN, min(MYST_EXECUTE_PARALLEL_MAX, parallel))
+    details = dict(admitted_builds=builds, idle_cpus=round(idle_cpus, 1), cpus=round(cpus, 1),
+                   available_memory_gb=round(available_memory_gb, 1), memory_gb=round(memory_gb, 1))
+    return parallel, details
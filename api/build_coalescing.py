@@ -0,0 +1,210 @@
+import json
+import logging
+import redis as redis_lib
+from common import load_yaml, get_redis, REDIS_LOCK_DB
+
+"""
+Coalescing of MyST build requests.
+
+Each repository has at most one running and one queued build in
+a Redis registry. A request for the same commit and binder hash as
+the running or queued build attaches to it and receives its result
+(unless it is forced and that build is not).
+A request for another commit replaces the queued build (the running
+one is never interrupted), requesters of the replaced build receive
+the result of the new one.
+"""
+
+common_config = load_yaml('config/common.yaml')
+
+# Registry entries of builds whose worker died expire after this many
+# seconds (matches the build task time limit).
+BUILD_REGISTRY_TTL = common_config.get('BUILD_REGISTRY_TTL', 6000)
+
+REGISTRY_KEY_PREFIX = "myst-builds:"
+FOLLOWERS_KEY_PREFIX = "myst-build-followers:"
+
+BUILD_NEW = "new"
+BUILD_ATTACHED = "attach"
+BUILD_SUPERSEDED = "supersede"
+
+# Returns {action, task_id}: the build to attach to, the queued build
+# that was replaced, or the new build itself.
+_REGISTER_SCRIPT = """
+local task_id, commit, binder, requester = ARGV[1], ARGV[2], ARGV[3], ARGV[4]
+local ttl = tonumber(ARGV[5])
+local force = ARGV[7] == '1'
+local running = redis.call('HGET', KEYS[1], 'running')
+local queued = redis.call('HGET', KEYS[1], 'queued')
+
+for _, raw in ipairs({running or false, queued or false}) do
+    if raw then
+        local entry = cjson.decode(raw)
+        -- A forced request only attaches to a forced build.
+        if entry['commit'] == commit and entry['binder'] == binder and (entry['force'] or not force) then
+            local followers = ARGV[6] .. entry['task_id']
+            redis.call('RPUSH', followers, requester)
+            redis.call('EXPIRE', followers, ttl)
+            return {'attach', entry['task_id']}
+        end
+    end
+end
+
+local result = {'new', task_id}
+local followers = ARGV[6] .. task_id
+if queued then
+    local old = cjson.decode(queued)
+    local old_followers = ARGV[6] .. old['task_id']
+    redis.call('RPUSH', followers, old['requester'])
+    for _, follower in ipairs(redis.call('LRANGE', old_followers, 0, -1)) do
+        redis.call('RPUSH', followers, follower)
+    end
+    redis.call('DEL', old_followers)
+    redis.call('EXPIRE', followers, ttl)
+    result = {'supersede', old['task_id']}
+end
+redis.call('HSET', KEYS[1], 'queued', cjson.encode({task_id=task_id, commit=commit, binder=binder, force=force, requester=requester}))
+redis.call('EXPIRE', KEYS[1], ttl)
+return result
+"""
+
+# 1 if the queued build is now running, 0 if it was replaced,
+# -1 if it is not in the registry.
+_START_SCRIPT = """
+local queued = redis.call('HGET', KEYS[1], 'queued')
+if not queued then
+    return -1
+end
+if cjson.decode(queued)['task_id'] ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'running', queued)
+redis.call('HDEL', KEYS[1], 'queued')
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[2]))
+return 1
+"""
+
+# Removes the running build and returns its followers.
+_FINISH_SCRIPT = """
+local running = redis.call('HGET', KEYS[1], 'running')
+if running and cjson.decode(running)['task_id'] == ARGV[1] then
+    redis.call('HDEL', KEYS[1], 'running')
+end
+local followers = ARGV[2] .. ARGV[1]
+local result = redis.call('LRANGE', followers, 0, -1)
+redis.call('DEL', followers)
+return result
+"""
+
+# Removes the queued build if it is still this one (it ended before
+# it started), returns its followers.
+_ABANDON_SCRIPT = """
+local queued = redis.call('HGET', KEYS[1], 'queued')
+if queued and cjson.decode(queued)['task_id'] == ARGV[1] then
+    redis.call('HDEL', KEYS[1], 'queued')
+end
+local followers = ARGV[2] .. ARGV[1]
+local result = redis.call('LRANGE', followers, 0, -1)
+redis.call('DEL', followers)
+return result
+"""
+
+def _registry_key(repository):
+    return f"{REGISTRY_KEY_PREFIX}{repository}"
+
+def _run_script(script, keys, args):
+    redis_client = get_redis(REDIS_LOCK_DB)
+    return redis_client.register_script(script)(keys=keys, args=args)
+
+def register_build(repository, commit_hash, binder_hash, task_id, requester, force=False):
+    """
+    Registers a build request before it is sent to the queue.
+
+    repository
+        owner/repo
+    requester
+        ScreeningClient.to_dict() of the request, used to send the
+        result if the request is attached to another build.
+    force
+        The build ignores the build index. A forced request does not
+        attach to a build that is not forced.
+
+    Returns (action, task_id):
+        (BUILD_NEW, task_id)               the request is queued as task_id.
+        (BUILD_ATTACHED, other_task_id)    do not queue, other_task_id will report.
+        (BUILD_SUPERSEDED, old_task_id)    queue task_id, old_task_id should be revoked.
+    Fails open (BUILD_NEW) if Redis is unavailable.
+    """
+    try:
+        action, build_task_id = _run_script(_REGISTER_SCRIPT, [_registry_key(repository)],
+                                            [task_id, commit_hash, str(binder_hash), json.dumps(requester),
+                                             BUILD_REGISTRY_TTL, FOLLOWERS_KEY_PREFIX, int(bool(force))])
+    except redis_lib.exceptions.RedisError as e:
+        logging.warning(f"Build registry unavailable, not coalescing {repository}: {e}")
+        return BUILD_NEW, task_id
+    return action.decode(), build_task_id.decode()
+
+def is_build_superseded(repository, task_id):
+    """
+    True if a newer request replaced this queued build.
+    """
+    try:
+        queued = get_redis(REDIS_LOCK_DB).hget(_registry_key(repository), 'queued')
+    except redis_lib.exceptions.RedisError:
+        return False
+    return queued is not None and json.loads(queued)['task_id'] != task_id
+
+def start_build(repository, task_id):
+    """
+    Marks the queued build as running, after which it can no longer be
+    replaced. Returns False if it was replaced in the meantime.
+    """
+    try:
+        return int(_run_script(_START_SCRIPT, [_registry_key(repository)], [task_id, BUILD_REGISTRY_TTL])) != 0
+    except redis_lib.exceptions.RedisError as e:
+        logging.warning(f"Build registry unavailable for {repository}: {e}")
+        return True
+
+def finish_build(repository, task_id):
+    """
+    Removes the build from the registry. Returns the requesters
+    (ScreeningClient dicts) that attached to it.
+    """
+    try:
+        followers = _run_script(_FINISH_SCRIPT, [_registry_key(repository)], [task_id, FOLLOWERS_KEY_PREFIX])
+    except redis_lib.exceptions.RedisError as e:
+        logging.warning(f"Build registry unavailable for {repository}: {e}")
+        return []
+    return [json.loads(follower) for follower in followers]
+
+def abandon_build(repository, task_id):
+    """
+    Removes a queued build that ended before it started (e.g., it gave
+    up waiting for the repository lock), so that later requests do not
+    attach to it. Returns the requesters that attached to it.
+    """
+    try:
+        followers = _run_script(_ABANDON_SCRIPT, [_registry_key(repository)], [task_id, FOLLOWERS_KEY_PREFIX])
+    except redis_lib.exceptions.RedisError as e:
+        logging.warning(f"Build registry unavailable for {repository}: {e}")
+        return []
+    return [json.loads(follower) for follower in followers]
+
+def notify_followers(followers, task_id, phase, message, collapsable=True):
+    """
+    Sends the result of a build to the requesters attached to it,
+    as a new comment on their issue and/or by email.
+    """
+    # Imported here, the registry itself does not need GitHub.
+    from screening_client import ScreeningClient
+    for follower in followers:
+        try:
+            screening = ScreeningClient.from_dict(follower)
+            screening.task_id = task_id
+            if screening.issue_id is not None:
+                template = screening.gh_response_template(message=message, collapse=collapsable)
+                screening.gh_create_comment(template[phase])
+            if screening.email_address is not None:
+                screening.send_user_email(message)
+        except Exception as e:
+            logging.warning(f"Could not send the result of build {task_id} to {follower.get('issue_id') or follower.get('email_address')}: {e}")
@@ -0,0 +1,95 @@
+import os
+import json
+import time
+import logging
+import docker
+import redis as redis_lib
+from common import load_yaml, get_redis
+from image_cache import image_reference
+
+"""
+Index of successful MyST builds.
+
+A build is identified by its repository, commit, the digest of the
+runtime image it resolved to (a binder hash like "latest" can point
+to another image over time) and the flags that change its output.
+The MyST task looks it up before spawning a container: if the same
+build already succeeded and its outputs still exist, the existing
+webpage is returned instead of rebuilding (unless forced).
+"""
+
+common_config = load_yaml('config/common.yaml')
+
+# Entries of a repository expire if it is not built for this many seconds.
+BUILD_INDEX_TTL = common_config.get('BUILD_INDEX_TTL', 90 * 24 * 3600)
+
+INDEX_KEY_PREFIX = "myst-build-index:"
+
+def _index_key(repository):
+    return f"{INDEX_KEY_PREFIX}{repository}"
+
+def resolve_image_digest(rees):
+    """
+    Returns the content digest of the runtime image of a REES, from
+    the local image if it was pulled, from the registry otherwise.
+    None if it cannot be resolved (the build is not indexed then).
+    """
+    reference = image_reference(rees)
+    try:
+        image = rees.docker_client.images.get(reference)
+        for repo_digest in image.attrs.get('RepoDigests', []):
+            if repo_digest.split('@')[0] == reference.rsplit(':', 1)[0]:
+                return repo_digest.split('@')[-1]
+    except docker.errors.ImageNotFound:
+        pass
+    except docker.errors.DockerException as e:
+        logging.warning(f"Could not inspect image {reference}: {e}")
+        return None
+    try:
+        auth_config = dict(username=os.getenv('DOCKER_PRIVATE_REGISTRY_USERNAME'),
+                           password=os.getenv('DOCKER_PRIVATE_REGISTRY_PASSWORD'))
+        return rees.docker_client.images.get_registry_data(reference, auth_config=auth_config).id
+    except docker.errors.DockerException as e:
+        logging.warning(f"Could not resolve the digest of {reference}: {e}")
+        return None
+
+def build_key(commit_hash, image_digest, **flags):
+    """
+    Field of a build in the index of its repository.
+    """
+    flags = ",".join(f"{name}={flags[name]}" for name in sorted(flags))
+    return f"{commit_hash}|{image_digest}|{flags}"
+
+def lookup_build(repository, key, required_paths=()):
+    """
+    Returns the record of a successful build, None if there is none or
+    if one of its outputs (required_paths) no longer exists.
+    """
+    try:
+        redis_client = get_redis()
+        record = redis_client.hget(_index_key(repository), key)
+        if record is None:
+            return None
+        record = json.loads(record)
+        missing = [path for path in required_paths if not os.path.exists(path)]
+        if missing:
+            logging.info(f"Indexed build of {repository} ({key}) is gone: {missing[0]} does not exist.")
+            redis_client.hdel(_index_key(repository), key)
+            return None
+        return record
+    except redis_lib.exceptions.RedisError as e:
+        logging.warning(f"Build index unavailable, building {repository}: {e}")
+        return None
+
+def record_build(repository, key, **record):
+    """
+    Adds a successful build to the index.
+    """
+    record['time'] = time.time()
+    try:
+        pipe = get_redis().pipeline()
+        pipe.hset(_index_key(repository), key, json.dumps(record))
+        pipe.expire(_index_key(repository), BUILD_INDEX_TTL)
+        pipe.execute()
+    except redis_lib.exceptions.RedisError as e:
+        logging.warning(f"Could not index the build of {repository} ({key}): {e}")
@@ -0,0 +1,174 @@
+import json
+import time
+import logging
+import contextlib
+import gevent
+import psutil
+import redis as redis_lib
+from gevent import sleep as cooperative_sleep
+from common import load_yaml, get_redis, REDIS_LOCK_DB
+
+"""
+Watchdog of MyST build locks.
+
+The lock of a MyST build is a short Redis lease. While the build task
+is healthy, a watchdog greenlet extends it and refreshes a liveness
+key of the repository. During the `myst build` step, it also checks
+that the build subprocess is alive. If the worker dies or hangs, or
+the subprocess disappears, renewals stop and the lock is released
+within a lease instead of the task time limit.
+"""
+
+common_config = load_yaml('config/common.yaml')
+
+# Seconds a lock lasts without renewal. Renewed every third of it.
+MYST_BUILD_LOCK_LEASE = common_config.get('MYST_BUILD_LOCK_LEASE', 300)
+# Seconds the build subprocess may be missing before the build is
+# considered stalled and its lock released.
+MYST_BUILD_STALL_GRACE = common_config.get('MYST_BUILD_STALL_GRACE', 60)
+
+ALIVE_KEY_PREFIX = "myst-build-alive:"
+
+def _alive_key(repository):
+    return f"{ALIVE_KEY_PREFIX}{repository}"
+
+def find_build_processes(source_dir):
+    """
+    Returns the running child processes of this worker that build
+    source_dir (working directory or argument within it).
+
+    The worker may run several builds, so processes are told apart
+    by their source directory.
+    """
+    processes = []
+    for child in psutil.Process().children(recursive=True):
+        try:
+            if child.status() in (psutil.STATUS_ZOMBIE, psutil.STATUS_STOPPED, psutil.STATUS_DEAD):
+                continue
+            if child.cwd().startswith(source_dir) or any(source_dir in arg for arg in child.cmdline()):
+                processes.append(child)
+        except psutil.Error:
+            continue
+    return processes
+
+def get_build_liveness(repository):
+    """
+    Returns the last heartbeat {task_id, pids, time} of the build
+    holding the lock of a repository, None if there is none.
+    """
+    try:
+        alive = get_redis(REDIS_LOCK_DB).get(_alive_key(repository))
+    except redis_lib.exceptions.RedisError:
+        return None
+    return json.loads(alive) if alive else None
+
+class BuildLockWatchdog:
+    """
+    Keeps the (acquired) lock of a MyST build while the build is alive.
+
+    The lock must be created with thread_local=False, as it is
+    extended from another greenlet.
+
+    watchdog = BuildLockWatchdog(build_lock, "owner/repo", task_id)
+    watchdog.start()
+    try:
+        with watchdog.watching(source_dir):
+            ... run the build subprocess
+    finally:
+        watchdog.stop()
+    """
+    def __init__(self, lock, repository, task_id, lease=MYST_BUILD_LOCK_LEASE):
+        self.lock = lock
+        self.repository = repository
+        self.task_id = task_id
+        self.source_dir = None
+        self.lease = lease
+        self.redis = get_redis(REDIS_LOCK_DB)
+        # True once the lock was released because the build stalled,
+        # or lost (expired) before it could be extended.
+        self.stalled = False
+        self.lost = False
+        self._watching = False
+        self._missing_since = None
+        self._greenlet = None
+
+    def start(self):
+        self._heartbeat([])
+        self._greenlet = gevent.spawn(self._run)
+
+    @contextlib.contextmanager
+    def watching(self, source_dir):
+        """
+        Within this block, a subprocess building source_dir must be alive.
+        """
+        self.source_dir = source_dir
+        self._watching = True
+        self._missing_since = None
+        try:
+            yield
+        finally:
+            self._watching = False
+
+    def _heartbeat(self, pids):
+        try:
+            self.redis.set(_alive_key(self.repository),
+                           json.dumps(dict(task_id=self.task_id, pids=pids, time=time.time())),
+                           ex=self.lease)
+        except redis_lib.exceptions.RedisError as e:
+            logging.warning(f"Could not signal liveness of build {self.task_id}: {e}")
+
+    def _check_subprocess(self):
+        """
+        Returns the pids of the build subprocess, None if it has been
+        missing for longer than the grace period.
+        """
+        if not self._watching:
+            return []
+        pids = [p.pid for p in find_build_processes(self.source_dir)]
+        if pids:
+            self._missing_since = None
+        elif self._missing_since is None:
+            self._missing_since = time.time()
+        elif time.time() - self._missing_since > MYST_BUILD_STALL_GRACE:
+            return None
+        return pids
+
+    def _run(self):
+        while True:
+            cooperative_sleep(self.lease / 3)
+            pids = self._check_subprocess()
+            if pids is None:
+                logging.warning(f"Build subprocess of {self.task_id} ({self.repository}) is gone, releasing the build lock.")
+                self.stalled = True
+                self._release()
+                return
+            try:
+                self.lock.extend(self.lease, replace_ttl=True)
+            except redis_lib.exceptions.LockError as e:
+                logging.warning(f"Build lock of {self.repository} was lost by {self.task_id}: {e}")
+                self.lost = True
+                return
+            except redis_lib.exceptions.RedisError as e:
+                logging.warning(f"Could not extend the build lock of {self.repository}: {e}")
+            self._heartbeat(pids)
+
+    def _release(self):
+        try:
+            self.redis.delete(_alive_key(self.repository))
+            self.lock.release()
+        except redis_lib.exceptions.RedisError as e:
+            logging.warning(f"Could not release the build lock of {self.repository}: {e}")
+
+    def stop(self):
+        """
+        Stops renewing. The lock itself is released by its owner.
+        """
+        if self._greenlet is not None:
+            self._greenlet.kill(block=False)
+            self._greenlet = None
+        try:
+            alive = get_build_liveness(self.repository)
+            if alive is not None and alive['task_id'] == self.task_id:
+                self.redis.delete(_alive_key(self.repository))
+        except redis_lib.exceptions.RedisError as e:
+            logging.warning(f"Could not clear liveness of build {self.task_id}: {e}")
@@ -1,8 +1,11 @@
 import os
 import glob
 import time
+import random
 import git
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 from flask import abort
 from itertools import chain
@@ -22,6 +25,7 @@ import logging
 import psutil
 import pytz
 import datetime
+import redis as redis_lib
 
 
 """
@@ -43,6 +47,25 @@ JB_ROOT_PATH = f"{common_config['DATA_ROOT_PATH']}/{common_config['JB_ROOT_FOLDE
 
 MYST_ROOT_PATH = f"{common_config['DATA_ROOT_PATH']}/{common_config['MYST_FOLDER']}"
 
+# Redis databases on localhost:6379
+#   0: Celery broker
+#   1: Celery results backend
+#   2: Build locks
+#   3: Shared caches (GitHub responses etc.)
+REDIS_LOCK_DB = 2
+REDIS_CACHE_DB = 3
+
+_redis_clients = {}
+
+def get_redis(db=REDIS_CACHE_DB):
+    """
+    Returns a (process-wide) Redis client for the given database.
+    Clients are backed by a connection pool, safe to share.
+    """
+    if db not in _redis_clients:
+        _redis_clients[db] = redis_lib.Redis(host='localhost', port=6379, db=db)
+    return _redis_clients[db]
+
 def load_all():
     """
     Get the list of all books (Jupyter Book and MyST) that exist in the server.
@@ -157,27 +180,135 @@ def get_owner_repo_provider(repo_url,provider_full_name=False):
     # camelCase or PascalCase are problematic.
     return [owner.lower(),repo.lower(),provider]
 
+# Default (connect, read) timeouts in seconds of outbound HTTP requests.
+HTTP_TIMEOUT = (10, common_config.get('HTTP_READ_TIMEOUT', 120))
+# For large uploads/downloads and streamed build logs.
+HTTP_LONG_TIMEOUT = (10, common_config.get('HTTP_LONG_READ_TIMEOUT', 3600))
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter applying a default timeout to requests that do
+    not set one.
+    """
+    def __init__(self, *args, timeout=HTTP_TIMEOUT, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+_http_session = None
+
+def get_http_session():
+    """
+    Returns the process-wide requests session for outbound HTTP
+    (Zenodo, BinderHub, GitHub, preview server, Groq).
+
+    Connections are pooled and kept alive, every request gets a
+    default timeout and idempotent requests (GET/HEAD) are retried on
+    connection errors and 502/503/504. Under gevent, sockets are
+    cooperative so a slow request only blocks its own greenlet.
+    """
+    global _http_session
+    if _http_session is None:
+        retry = Retry(total=3, backoff_factor=1,
+                      status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset(["GET", "HEAD", "OPTIONS"]),
+                      raise_on_status=False)
+        adapter = TimeoutHTTPAdapter(max_retries=retry,
+                                     pool_connections=common_config.get('HTTP_POOL_CONNECTIONS', 10),
+                                     pool_maxsize=common_config.get('HTTP_POOL_MAXSIZE', 20))
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _http_session = session
+    return _http_session
+
+def download_file(url, target_path, chunk_size=1024*1024, **kwargs):
+    """
+    Streams a remote file to disk in chunks (replaces wget calls).
+    The partial file is removed if the download fails.
+
+    Returns True if successful, False otherwise.
+    """
+    try:
+        with get_http_session().get(url, stream=True, timeout=HTTP_LONG_TIMEOUT, **kwargs) as response:
+            response.raise_for_status()
+            with open(target_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+        return True
+    except (requests.RequestException, OSError) as e:
+        logging.error(f"Cannot download {url}: {e}")
+        if os.path.exists(target_path):
+            os.remove(target_path)
+        return False
+
+# Resolved HEAD commits are cached for a short time, see format_commit_hash.
+COMMIT_HASH_CACHE_TTL = common_config.get('COMMIT_HASH_CACHE_TTL', 30)
+# "git" (git ls-remote) or "github_api" (GitHub REST API, github.com only)
+COMMIT_HASH_RESOLVER = common_config.get('COMMIT_HASH_RESOLVER', "git")
+COMMIT_HASH_MAX_ATTEMPTS = common_config.get('COMMIT_HASH_MAX_ATTEMPTS', 5)
+
+def resolve_head_commit(repo_url):
+    """
+    Returns the commit hash at HEAD of a remote repository,
+    asking for the HEAD ref only.
+    """
+    if COMMIT_HASH_RESOLVER == "github_api" and "github.com" in repo_url:
+        # Imported here, github_client depends on this module.
+        from github_client import gh_cached_get, gh_filter
+        commit_hash = gh_cached_get(f"/repos/{gh_filter(repo_url)}/commits/HEAD",
+                                    accept="application/vnd.github.sha")
+        if commit_hash is None:
+            raise ValueError(f"Cannot resolve HEAD of {repo_url}")
+        return commit_hash.strip()
+    refs = git.cmd.Git().ls_remote(repo_url, "HEAD").split("\n")
+    for ref in refs:
+        if ref.endswith("\tHEAD"):
+            return ref.split('\t')[0]
+    raise ValueError(f"Cannot resolve HEAD of {repo_url}")
+
 def format_commit_hash(repo_url, commit_hash):
     """
     Returns the latest commit if HEAD (default endpoint value)
     Returns the hash itself otherwise.
+
+    Resolved commits are cached in Redis for COMMIT_HASH_CACHE_TTL
+    seconds, failed attempts are retried with jittered exponential
+    backoff.
     """
-    if commit_hash == "HEAD":
-        attempt = 0
-        max_attempts = 5
-        while attempt < max_attempts:
-            try:
-                refs = git.cmd.Git().ls_remote(repo_url).split("\n")
-                for ref in refs:
-                    if ref.split('\t')[1] == "HEAD":
-                        commit_hash = ref.split('\t')[0]
-                break  # Exit the loop if successful
-            except Exception as e:
-                attempt += 1
-                if attempt < max_attempts:
-                    time.sleep(10)  # Wait for 10 seconds before retrying
-                else:
-                    raise e  # Re-raise the exception if all attempts fail
+    if commit_hash != "HEAD":
+        return commit_hash
+
+    cache_key = f"head-commit:{repo_url}"
+    try:
+        cached = get_redis().get(cache_key)
+        if cached:
+            return cached.decode()
+    except redis_lib.exceptions.RedisError as e:
+        logging.warning(f"Commit hash cache unavailable: {e}")
+
+    attempt = 0
+    while True:
+        try:
+            commit_hash = resolve_head_commit(repo_url)
+            break
+        except Exception as e:
+            attempt += 1
+            if attempt >= COMMIT_HASH_MAX_ATTEMPTS:
+                raise e  # Re-raise the exception if all attempts fail
+            # Full jitter: 0-2s, 0-4s, 0-8s... capped at 30s
+            delay = random.uniform(0, min(30, 2 ** attempt))
+            logging.warning(f"Cannot resolve HEAD of {repo_url} (attempt {attempt}), retrying in {delay:.1f}s: {e}")
+            time.sleep(delay)
+
+    try:
+        get_redis().set(cache_key, commit_hash, ex=COMMIT_HASH_CACHE_TTL)
+    except redis_lib.exceptions.RedisError as e:
+        logging.warning(f"Could not cache commit hash: {e}")
     return commit_hash
 
 def get_binder_build_url(binderName, domainName, repo, owner, provider, commit_hash):
@@ -186,56 +317,21 @@ def get_binder_build_url(binderName, domainName, repo, owner, provider, commit_h
     """
     return f"https://{binderName}.{domainName}/build/{provider}/{owner}/{repo}.git/{commit_hash}"
 
-def get_lock_filename(repo_url):
-    """
-    Simple helper function to identify the lock filename.
-    """
-    [owner, repo, provider] = get_owner_repo_provider(repo_url)
-    fname = f"{provider}_{owner}_{repo}.lock"
-    return os.path.join(os.getcwd(),'build_locks',fname)
-
-def check_lock_status(lock_filename,build_rate_limit):
-    """
-    If lock has expired, remove it (unlocked)
-    If not expired, return the remaining time in seconds.
-    If never existed, inform (not_locked)
-    Non-numeric returns are for semantics only. Downstream 
-    flow is determined based on numeric or not. 
-    """
-    if os.path.exists(lock_filename):
-    # If lock exists, check its age first.
-            lock_age_in_sec = time.time() - os.path.getmtime(lock_filename)
-            # If the lock file older than the rate limit, remove.
-            if lock_age_in_sec > build_rate_limit*60:
-                os.remove(lock_filename)
-                return "unlocked"
-            else: 
-                # Return remaining time in seconds
-                return round(build_rate_limit - lock_age_in_sec/60,1)
-    else:
-        return "not_locked"
-    
-def run_binder_build_preflight_checks(repo_url,commit_hash,build_rate_limit, binderName, domainName):
+def run_binder_build_preflight_checks(repo_url,commit_hash,build_rate_limit, binderName, domainName, lock, on_wait=None):
     """
         Two arguments repo_url and commit_hash are passed with payload
-        by the client. The last tree arguments are from configurations.
+        by the client. The next three arguments are from configurations.
+        lock is the BinderBuildLock of the build (see binder_locks.py),
+        builds of the same repository wait for it in a queue for up to
+        build_rate_limit minutes. on_wait is called with the position
+        in the queue.
     """
     # Parse url to process
     [owner, repo, provider] = get_owner_repo_provider(repo_url)
 
-    # Get lock filename
-    lock_filename = get_lock_filename(repo_url)
-
-    # First check on build lock conditions.
-    lock_status = check_lock_status(lock_filename,build_rate_limit)
-
-    if isinstance(lock_status, (int, float)):
-    # If lock is not expired, deny request and inform the client.
-        abort(409, f"Looks like a build is already in progress for {owner}/{repo}. Will be unlocked in {lock_status} minutes. Please try again later or request unlock (reviewers/editors only).")
-    else:
-        # Create a fresh lock and proceed to build.
-        with open(lock_filename, "w") as f:
-            f.write("")
+    if not lock.acquire(timeout=build_rate_limit*60, on_wait=on_wait):
+    # Waited for the whole rate limit, deny request and inform the client.
+        abort(409, f"Looks like a build is already in progress for {owner}/{repo}. Waited {build_rate_limit} minutes for it to finish. Please try again later or request unlock (reviewers/editors only).")
 
     # Get the latest commit hash if HEAD, pass otherwise.
     commit_hash = format_commit_hash(repo_url,commit_hash)
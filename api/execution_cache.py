@@ -0,0 +1,158 @@
+import os
+import shutil
+import hashlib
+import logging
+import tempfile
+from common import load_yaml
+
+"""
+Cross-commit cache of notebook executions for MyST builds.
+
+mystmd caches the outputs of each notebook in _build/execute, under
+a hash of its code cells and kernel. That directory is preserved in
+latest/ across commits, but it is oblivious to the runtime image and
+the data: outputs computed with another image or another version of
+the dataset would be reused.
+
+Here the entries are kept in a shared store, one directory per
+(runtime image digest, data manifest). Before a build, _build/execute
+is replaced with the entries of its image and data, so that only
+notebooks whose code changed are executed again. After a successful
+build, the new entries are added to the store. The least recently
+used entries are removed over EXECUTION_CACHE_BUDGET_GB.
+"""
+
+common_config = load_yaml('config/common.yaml')
+
+EXECUTION_CACHE_ENABLED = common_config.get('EXECUTION_CACHE_ENABLED', True)
+EXECUTION_CACHE_PATH = common_config.get('EXECUTION_CACHE_PATH', os.path.join(common_config['DATA_ROOT_PATH'], "execution-cache"))
+EXECUTION_CACHE_BUDGET_GB = common_config.get('EXECUTION_CACHE_BUDGET_GB', 50)
+# Execution cache of mystmd, relative to the project root.
+MYST_EXECUTE_CACHE_DIR = common_config.get('MYST_EXECUTE_CACHE_DIR', "_build/execute")
+
+NO_DATA = "no-data"
+
+def data_manifest_hash(data_dir):
+    """
+    Hash of the file names, sizes and modification times of a dataset.
+    Contents are not read, datasets can be large.
+    """
+    if not data_dir or not os.path.isdir(data_dir):
+        return NO_DATA
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(data_dir):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            digest.update(f"{os.path.relpath(path, data_dir)}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+def cache_key(image_digest, data_hash):
+    """
+    Store directory of the executions with an image and a dataset.
+    """
+    return hashlib.sha256(f"{image_digest}|{data_hash}".encode()).hexdigest()[:32]
+
+def _store_dir(key):
+    return os.path.join(EXECUTION_CACHE_PATH, key)
+
+def restore(source_dir, key):
+    """
+    Replaces the execution cache of a project with the stored entries of
+    the key. Returns (number of entries, bytes).
+    """
+    execute_dir = os.path.join(source_dir, MYST_EXECUTE_CACHE_DIR)
+    store_dir = _store_dir(key)
+    # Entries of a previous build may come from another image.
+    shutil.rmtree(execute_dir, ignore_errors=True)
+    os.makedirs(execute_dir, exist_ok=True)
+    count, nbytes = 0, 0
+    if not os.path.isdir(store_dir):
+        return count, nbytes
+    for name in os.listdir(store_dir):
+        path = os.path.join(store_dir, name)
+        try:
+            shutil.copy2(path, os.path.join(execute_dir, name))
+            # Last use, for eviction.
+            os.utime(path)
+        except OSError as e:
+            logging.warning(f"Could not restore execution cache entry {path}: {e}")
+            continue
+        count += 1
+        nbytes += os.path.getsize(path)
+    return count, nbytes
+
+def record(source_dir, key):
+    """
+    Adds the new entries of a project's execution cache to the store,
+    then evicts. Returns (number of entries, bytes) added.
+    """
+    execute_dir = os.path.join(source_dir, MYST_EXECUTE_CACHE_DIR)
+    store_dir = _store_dir(key)
+    if not os.path.isdir(execute_dir):
+        return 0, 0
+    os.makedirs(store_dir, exist_ok=True)
+    count, nbytes = 0, 0
+    for name in os.listdir(execute_dir):
+        path = os.path.join(execute_dir, name)
+        target = os.path.join(store_dir, name)
+        if not os.path.isfile(path) or os.path.exists(target):
+            continue
+        # Written aside then renamed, builds of other repositories may read the store.
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=store_dir, prefix=".tmp-")
+            os.close(fd)
+            shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, target)
+        except OSError as e:
+            logging.warning(f"Could not store execution cache entry {name}: {e}")
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            continue
+        count += 1
+        nbytes += os.path.getsize(target)
+    evict()
+    return count, nbytes
+
+def evict():
+    """
+    Removes the least recently used entries until the store fits in
+    EXECUTION_CACHE_BUDGET_GB. Returns the number of bytes freed.
+    """
+    entries = []
+    total = 0
+    for root, _, files in os.walk(EXECUTION_CACHE_PATH):
+        for name in files:
+            if name.startswith(".tmp-"):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+    budget = EXECUTION_CACHE_BUDGET_GB * 1024 ** 3
+    freed = 0
+    for _, size, path in sorted(entries):
+        if total <= budget:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        freed += size
+        # Drops the directory of an image/dataset once it is empty.
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+    if freed:
+        logging.info(f"Evicted {freed / 1024 ** 2:.1f} MB of notebook executions.")
+    return freed
@@ -1,15 +1,197 @@
 import os
 import re
-from common import get_time
+import time
+import threading
+import functools
+import logging
+from common import get_time, load_yaml, get_redis, get_http_session
 import json
+import base64
 import yaml
 import git
+import redis as redis_lib
+from github import Github, InputGitTreeElement, GithubException
+from github.Requester import Requester
+from requests.structures import CaseInsensitiveDict
+from ratelimit import ApiRateBudget, request_priority, PRIORITY_HIGH
 
 # Name of the GitHub organization where repositories 
 # will be forked into for production. Editorial bot 
 # must be authorized for this organization.
 GH_ORGANIZATION = "roboneurolibre"
 
+common_config = load_yaml("config/common.yaml")
+
+# Seconds a cached Repository/Issue/IssueComment handle stays valid.
+GH_HANDLE_CACHE_TTL = common_config.get('GH_HANDLE_CACHE_TTL', 300)
+# Size of the HTTP connection pool shared by the process-wide client.
+GH_CLIENT_POOL_SIZE = common_config.get('GH_CLIENT_POOL_SIZE', 10)
+# Seconds an ETag/response pair is kept in the shared (Redis) HTTP cache.
+GH_ETAG_CACHE_TTL = common_config.get('GH_ETAG_CACHE_TTL', 86400)
+
+GH_API_URL = "https://api.github.com"
+
+# Budget of the bot token, shared by all web and worker processes.
+# Status comments are sent with high priority and may use the reserves.
+gh_rate_budget = ApiRateBudget("github",
+                               per_hour=common_config.get('GH_RATE_LIMIT_PER_HOUR', 5000),
+                               burst=common_config.get('GH_RATE_BURST', 20),
+                               burst_reserve=common_config.get('GH_RATE_BURST_RESERVE', 5),
+                               remaining_reserve=common_config.get('GH_RATE_REMAINING_RESERVE', 200))
+
+def _throttled(request_raw):
+    """
+    Wraps Requester.__requestRaw, through which PyGithub issues every
+    request (redirects included), so that each request is taken out of
+    the shared rate budget before it is sent, and the rate limit headers
+    are reported back to it. Connections stay persistent.
+    """
+    @functools.wraps(request_raw)
+    def throttled_request_raw(requester, *args, **kwargs):
+        gh_rate_budget.acquire()
+        status, response_headers, output = request_raw(requester, *args, **kwargs)
+        # PyGithub lowercases header names.
+        gh_rate_budget.record(status, CaseInsensitiveDict(response_headers))
+        return status, response_headers, output
+    throttled_request_raw._throttled = True
+    return throttled_request_raw
+
+_github_client = None
+_github_client_lock = threading.Lock()
+
+def get_github_client():
+    """
+    Returns the process-wide GitHub client authenticated as the bot.
+
+    A single client (and its pooled HTTP session) is shared by all
+    tasks and request handlers of a worker process, instead of
+    creating a new Github() object (and TLS connection) per call.
+    """
+    global _github_client
+    if _github_client is None:
+        with _github_client_lock:
+            if _github_client is None:
+                if not getattr(Requester._Requester__requestRaw, '_throttled', False):
+                    Requester._Requester__requestRaw = _throttled(Requester._Requester__requestRaw)
+                _github_client = Github(os.getenv('GH_BOT'), pool_size=GH_CLIENT_POOL_SIZE)
+    return _github_client
+
+class GithubHandleCache:
+    """
+    In-memory TTL cache of PyGithub Repository, Issue and IssueComment
+    objects. These handles are only used to address API endpoints
+    (create/edit comments, read files), so serving them from memory
+    saves the GET round-trips PyGithub performs to build them.
+
+    Mutable content (e.g., issue body) must NOT be read from cached
+    handles, see gh_read_from_issue_body.
+    """
+    def __init__(self, ttl=GH_HANDLE_CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+        # Load outside of the lock, API calls may block.
+        value = loader()
+        self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+gh_handle_cache = GithubHandleCache()
+
+def gh_get_repo(github_client, repository):
+    """
+    Returns a (cached) Repository handle. The repository is
+    requested lazily, attributes are fetched on first access only.
+    """
+    repo_name = gh_filter(repository)
+    return gh_handle_cache.get(("repo", repo_name),
+                               lambda: github_client.get_repo(repo_name, lazy=True))
+
+def gh_get_issue(github_client, repository, issue_id):
+    """
+    Returns a (cached) Issue handle.
+    """
+    repo_name = gh_filter(repository)
+    return gh_handle_cache.get(("issue", repo_name, int(issue_id)),
+                               lambda: gh_get_repo(github_client, repo_name).get_issue(number=int(issue_id)))
+
+def gh_get_comment(github_client, repository, issue_id, comment_id):
+    """
+    Returns a (cached) IssueComment handle.
+    """
+    repo_name = gh_filter(repository)
+    return gh_handle_cache.get(("comment", repo_name, int(comment_id)),
+                               lambda: gh_get_issue(github_client, repo_name, issue_id).get_comment(int(comment_id)))
+
+
+def gh_cached_get(path, accept="application/vnd.github+json"):
+    """
+    Conditional GET request to the GitHub REST API.
+
+    The ETag and body of the last 200 response are stored in Redis
+    (shared by the web and worker processes) and the ETag is sent
+    back as If-None-Match. When the resource has not changed GitHub
+    answers 304, which does not count against the rate limit, and
+    the cached body is returned.
+
+    path
+        API path, e.g. /repos/owner/repo/issues/1
+    accept
+        Media type, e.g. application/vnd.github.raw for file contents.
+
+    Returns the response body (str), or None if the resource does
+    not exist (404). Other HTTP errors are raised.
+    """
+    cache_key = f"gh-http-cache:{accept}:{path}"
+    headers = {"Accept": accept,
+               "Authorization": f"token {os.getenv('GH_BOT')}",
+               "X-GitHub-Api-Version": "2022-11-28"}
+    cached = None
+    try:
+        cached = get_redis().hgetall(cache_key)
+    except redis_lib.exceptions.RedisError as e:
+        logging.warning(f"GitHub HTTP cache unavailable, sending unconditional request: {e}")
+    if cached and b"etag" in cached:
+        headers["If-None-Match"] = cached[b"etag"].decode()
+
+    gh_rate_budget.acquire()
+    response = get_http_session().get(f"{GH_API_URL}{path}", headers=headers, timeout=30)
+    gh_rate_budget.record(response.status_code, response.headers)
+    if response.status_code == 304 and cached:
+        return cached[b"body"].decode()
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+
+    etag = response.headers.get("ETag")
+    if etag:
+        try:
+            pipe = get_redis().pipeline()
+            pipe.hset(cache_key, mapping={"etag": etag, "body": response.text})
+            pipe.expire(cache_key, GH_ETAG_CACHE_TTL)
+            pipe.execute()
+        except redis_lib.exceptions.RedisError as e:
+            logging.warning(f"Could not store GitHub response in the HTTP cache: {e}")
+    return response.text
+
 def isNotBlank(myString):
     return bool(myString and myString.strip())
 
@@ -81,19 +263,47 @@ def gh_create_comment(github_client,issue_repo,issue_id,comment_body):
     """
     To create a new comment under an existing GitHub issue.
     """
-    repo = github_client.get_repo(gh_filter(issue_repo))
-    issue = repo.get_issue(number=issue_id)
-    commit_comment = issue.create_comment(comment_body)
+    issue = gh_get_issue(github_client, issue_repo, issue_id)
+    with request_priority(PRIORITY_HIGH):
+        commit_comment = issue.create_comment(comment_body)
+    # Comment will be updated by the task, keep its handle around.
+    gh_handle_cache.set(("comment", gh_filter(issue_repo), commit_comment.id), commit_comment)
     return commit_comment.id
 
+def gh_create_comments(github_client,issue_repo,issue_id,comment_bodies):
+    """
+    Creates several comments under an issue with a single (GraphQL)
+    request. Comments are created in order, each one can be a bot
+    command. Returns the comment IDs.
+    """
+    if not comment_bodies:
+        return []
+    issue = gh_get_issue(github_client, issue_repo, issue_id)
+    variables = {"subjectId": issue.node_id}
+    params = ["$subjectId: ID!"]
+    mutations = []
+    for idx, body in enumerate(comment_bodies):
+        variables[f"body{idx}"] = body
+        params.append(f"$body{idx}: String!")
+        mutations.append(f"c{idx}: addComment(input: {{subjectId: $subjectId, body: $body{idx}}}) {{ commentEdge {{ node {{ databaseId }} }} }}")
+    query = f"mutation({', '.join(params)}) {{\n" + "\n".join(mutations) + "\n}"
+    with request_priority(PRIORITY_HIGH):
+        _, response = github_client.requester.graphql_query(query, variables)
+    data = response["data"]
+    return [data[f"c{idx}"]["commentEdge"]["node"]["databaseId"] for idx in range(len(comment_bodies))]
+
 def gh_update_comment(github_client, issue_repo,issue_id,comment_id,comment_body):
     """
     Update an existing GitHub issue comment. 
     """
-    repo = github_client.get_repo(gh_filter(issue_repo))
-    issue = repo.get_issue(issue_id)
-    comment = issue.get_comment(comment_id)
-    comment.edit(comment_body)
+    try:
+        with request_priority(PRIORITY_HIGH):
+            comment = gh_get_comment(github_client, issue_repo, issue_id, comment_id)
+            comment.edit(comment_body)
+    except Exception:
+        # Handle may be stale (e.g., comment deleted), do not keep it.
+        gh_handle_cache.invalidate(("comment", gh_filter(issue_repo), int(comment_id)))
+        raise
 
 def gh_template_respond(github_client,phase,task_name,repo,issue_id,task_id="",comment_id="", message="",collapsable=True):
     """
@@ -157,7 +367,7 @@ def gh_get_project_name(github_client,target_repo):
     file that is required to be located under the binder 
     folder as required by neurolibre.
     """
-    repo = github_client.get_repo(gh_filter(target_repo))
+    repo = gh_get_repo(github_client, target_repo)
     # This is a requirement
     contents = repo.get_contents("binder/data_requirement.json")
     data = json.loads(contents.decoded_content)
@@ -186,7 +396,7 @@ def gh_fork_repository(github_client,source_repo):
     where the final version of preprint repositories
     will be forked into.
     """
-    repo_to_fork = github_client.get_repo(gh_filter(source_repo))
+    repo_to_fork = gh_get_repo(github_client, source_repo)
     target_org = github_client.get_organization(GH_ORGANIZATION)
     forked_repo = target_org.create_fork(repo_to_fork)
     return forked_repo
@@ -211,7 +421,7 @@ def gh_create_file(github_client, repo, file_path, content, commit_message=None,
         file_name = file_path.split('/')[-1]
         commit_message = f":robot: [Automated] Create {file_name}"
 
-    repo = github_client.get_repo(gh_filter(repo))
+    repo = gh_get_repo(github_client, repo)
     try:
         # Handle binary content (like images)
         # if encoding is None and isinstance(content, bytes):
@@ -231,13 +441,18 @@ def gh_get_file_content(github_client,repo,file_path):
     """
     Generic helper function to read (raw) file content from
     a github repository.
+
+    Uses a conditional request (see gh_cached_get), github_client
+    is kept for API compatibility.
     """
-    repo = github_client.get_repo(gh_filter(repo))
     try:
-        file_content = repo.get_contents(file_path).decoded_content.decode()
+        file_content = gh_cached_get(f"/repos/{gh_filter(repo)}/contents/{file_path}",
+                                     accept="application/vnd.github.raw")
     except Exception as e:
-        print(f"Error retrieving file content: {str(e)}")
+        logging.error(f"Error retrieving file content: {str(e)}")
         return None
+    if file_content is None:
+        logging.warning(f"Error retrieving file content: {file_path} not found in {gh_filter(repo)}")
     return file_content
 
 def gh_update_file_content(github_client,repo,file_path,new_content,commit_message):
@@ -245,7 +460,7 @@ def gh_update_file_content(github_client,repo,file_path,new_content,commit_messa
     Generic helper function to update (existing) file content from
     a github repository.
     """
-    repo = github_client.get_repo(gh_filter(repo))
+    repo = gh_get_repo(github_client, repo)
     try:
         # Retrieve existing file content
         file = repo.get_contents(file_path)
@@ -255,6 +470,47 @@ def gh_update_file_content(github_client,repo,file_path,new_content,commit_messa
     except Exception as e:
         return {"status": False, "message": str(e)}
 
+def gh_commit_files(github_client, repo, files, commit_message, branch=None):
+    """
+    Commit multiple files at once using the Git Data API.
+
+    All files are written in a single tree on top of the branch head
+    and committed with one commit, instead of one commit (and several
+    requests) per file through the contents API.
+
+    Parameters:
+    - github_client: GitHub client instance
+    - repo: Repository name/path
+    - files: {path: content}, content can be string or bytes (binary files)
+    - commit_message: Message of the commit
+    - branch: Target branch (default branch if None)
+
+    Returns:
+    - dict: Status, message and sha of the branch head
+    """
+    repo = gh_get_repo(github_client, repo)
+    try:
+        if branch is None:
+            branch = repo.default_branch
+        ref = repo.get_git_ref(f"heads/{branch}")
+        base_commit = repo.get_git_commit(ref.object.sha)
+        tree_elements = []
+        for file_path, content in files.items():
+            if isinstance(content, bytes):
+                # Binary content (like images) has to be uploaded as a blob.
+                blob = repo.create_git_blob(base64.b64encode(content).decode(), "base64")
+                tree_elements.append(InputGitTreeElement(file_path, "100644", "blob", sha=blob.sha))
+            else:
+                tree_elements.append(InputGitTreeElement(file_path, "100644", "blob", content=content))
+        tree = repo.create_git_tree(tree_elements, base_tree=base_commit.tree)
+        if tree.sha == base_commit.tree.sha:
+            return {"status": True, "message": "No changes", "sha": base_commit.sha}
+        commit = repo.create_git_commit(commit_message, tree, [base_commit])
+        ref.edit(commit.sha)
+        return {"status": True, "message": "Success", "sha": commit.sha}
+    except Exception as e:
+        return {"status": False, "message": str(e)}
+
 def gh_get_yaml(github_client, repo, file_path):
     """
     Get YAML file content from a repository.
@@ -323,6 +579,86 @@ def gh_update_jb_toc(github_client, repo, content):
     return gh_update_yaml(github_client, repo, "content/_toc.yml", content,
                          ":robot: [Automated] JB TOC update")
 
+def gh_get_repository_snapshot(github_client, repository, file_paths, license_repository=None):
+    """
+    Fetches the state of a repository with a single GraphQL query.
+
+    Parameters:
+    - github_client: GitHub client instance
+    - repository: Repository name/URL
+    - file_paths: Paths of the (text) files to read at HEAD of the default branch
+    - license_repository: Optional repository name/URL to read the license
+                          from (e.g., the upstream of a fork). Defaults to repository.
+
+    Returns:
+    - dict with keys
+        default_branch: Name of the default branch
+        head_sha: Commit hash at HEAD of the default branch
+        license: SPDX ID of the license (None if not detected, or if
+                 license_repository cannot be read)
+        files: {path: content or None if not found (or binary)}
+        exists: {path: True if the file exists}
+        yaml: {path: parsed YAML or None} for the .yml/.yaml files
+    """
+    owner, name = gh_filter(repository).split("/", 1)
+    variables = {"owner": owner, "name": name}
+    file_fields = ""
+    for idx, path in enumerate(file_paths):
+        variables[f"expr{idx}"] = f"HEAD:{path}"
+        file_fields += f"file{idx}: object(expression: $expr{idx}) {{ ... on Blob {{ text isBinary }} }}\n"
+    expr_vars = "".join([f", $expr{idx}: String!" for idx in range(len(file_paths))])
+
+    license_query = ""
+    license_vars = ""
+    if license_repository:
+        variables["licOwner"], variables["licName"] = gh_filter(license_repository).split("/", 1)
+        license_query = "upstream: repository(owner: $licOwner, name: $licName) { licenseInfo { spdxId } }"
+        license_vars = ", $licOwner: String!, $licName: String!"
+
+    query = f"""
+    query($owner: String!, $name: String!{expr_vars}{license_vars}) {{
+        repo: repository(owner: $owner, name: $name) {{
+            defaultBranchRef {{ name target {{ oid }} }}
+            licenseInfo {{ spdxId }}
+            {file_fields}
+        }}
+        {license_query}
+    }}"""
+    try:
+        _, response = github_client.requester.graphql_query(query, variables)
+    except GithubException as e:
+        if not license_repository:
+            raise
+        # The upstream may be gone or private, its license is then unknown.
+        logging.warning(f"Could not read the license of {license_repository}: {e}")
+        snapshot = gh_get_repository_snapshot(github_client, repository, file_paths)
+        snapshot["license"] = None
+        return snapshot
+    data = response["data"]
+    repo_data = data["repo"]
+
+    if license_repository:
+        license_info = (data.get("upstream") or {}).get("licenseInfo")
+    else:
+        license_info = repo_data["licenseInfo"]
+    snapshot = {
+        "default_branch": repo_data["defaultBranchRef"]["name"],
+        "head_sha": repo_data["defaultBranchRef"]["target"]["oid"],
+        # NOASSERTION is what GitHub reports for unrecognized licenses.
+        "license": license_info["spdxId"] if license_info and license_info["spdxId"] != "NOASSERTION" else None,
+        "files": {},
+        "exists": {},
+        "yaml": {}
+    }
+    for idx, path in enumerate(file_paths):
+        blob = repo_data.get(f"file{idx}")
+        content = blob["text"] if blob and not blob.get("isBinary") else None
+        snapshot["files"][path] = content
+        snapshot["exists"][path] = blob is not None
+        if path.endswith((".yml", ".yaml")):
+            snapshot["yaml"][path] = yaml.safe_load(content) if content else None
+    return snapshot
+
 def gh_get_paper_markdown(github_client,repo):
     """
     Get paper.md content from the root of the target repository
@@ -330,6 +666,29 @@ def gh_get_paper_markdown(github_client,repo):
     file_content = gh_get_file_content(github_client,repo,"paper.md")
     return file_content
 
+# OpenJournals convention: <!--tag-->value<!--end-tag-->
+ISSUE_TAG_PATTERN = re.compile(r"<!--([\w-]+)-->(.*?)<!--end-\1-->", re.DOTALL)
+
+def gh_parse_issue_tags(issue_body):
+    """
+    Returns all tag/value pairs found in an issue body as a dict.
+    Pending values are returned as None.
+    """
+    tags = {}
+    for match in ISSUE_TAG_PATTERN.finditer(issue_body or ""):
+        value = match.group(2).strip()
+        # Keep the first occurrence, as str.find would.
+        tags.setdefault(match.group(1), None if value == "Pending" else value)
+    return tags
+
+def gh_read_issue_tags(github_client, issue_repo, issue_id):
+    """
+    Fetches the issue body once and returns every tag in it
+    (see gh_read_from_issue_body) as a dict. Not cached, tasks keep
+    the tags of their issue (see ScreeningClient.gh_read_issue_tags).
+    """
+    return gh_parse_issue_tags(gh_get_issue_body(github_client, issue_repo, issue_id))
+
 def gh_read_from_issue_body(github_client,issue_repo,issue_id,tag):
     """
     Issue body of the reviews has markers around review entries
@@ -348,27 +707,27 @@ def gh_read_from_issue_body(github_client,issue_repo,issue_id,tag):
     Returns None if:
         - a requested tag does not exist 
         - the value is Pending
+
+    To read multiple tags, prefer gh_read_issue_tags.
     """
-    repo = github_client.get_repo(gh_filter(issue_repo))
-    issue = repo.get_issue(issue_id)
-    issue_body = issue.body
-    # OpenJournals convention.
-    start_marker = f"<!--{tag}-->"
-    end_marker = f"<!--end-{tag}-->"
-    start_index = issue_body.find(start_marker)
-    end_index = issue_body.find(end_marker)
-    if start_index !=-1 and end_index !=-1:
-        extracted_text = issue_body[start_index+len(start_marker):end_index].strip()
-        if extracted_text == "Pending":
-            extracted_text = None
-    else:
-        extracted_text = None
-    return extracted_text
+    return gh_read_issue_tags(github_client, issue_repo, issue_id).get(tag)
+
 
+def gh_get_issue_body(github_client, issue_repo, issue_id):
+    """
+    Returns the (up to date) body of an issue, using a
+    conditional request.
+    """
+    issue = gh_cached_get(f"/repos/{gh_filter(issue_repo)}/issues/{int(issue_id)}")
+    if issue is None:
+        raise ValueError(f"Issue {issue_id} not found in {gh_filter(issue_repo)}")
+    return json.loads(issue).get("body") or ""
 
 def get_default_branch(github_client,repository):
-    repo = github_client.get_repo(gh_filter(repository))
-    default_branch = repo.default_branch
+    repo = gh_cached_get(f"/repos/{gh_filter(repository)}")
+    if repo is None:
+        raise ValueError(f"Repository {gh_filter(repository)} not found")
+    default_branch = json.loads(repo)["default_branch"]
     return default_branch
 
 def gh_clone_repository(repo_url, target_path, depth=1):
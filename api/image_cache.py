@@ -0,0 +1,142 @@
+import socket
+import logging
+import docker
+import redis as redis_lib
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from common import load_yaml, get_redis
+
+"""
+Local cache of the runtime (binder) images.
+
+Images are pulled from BINDER_REGISTRY when a build is queued rather
+than when it starts. Their last use is tracked per host, and the least
+recently used images are removed once the images pulled for builds
+exceed the disk budget. Images in use by a container and the noexec
+image are never removed.
+"""
+
+common_config = load_yaml('config/common.yaml')
+
+IMAGE_CACHE_ENABLED = common_config.get('IMAGE_CACHE_ENABLED', True)
+# Disk budget (GB) of the images pulled for builds.
+IMAGE_CACHE_BUDGET_GB = common_config.get('IMAGE_CACHE_BUDGET_GB', 200)
+BINDER_REGISTRY = common_config['BINDER_REGISTRY']
+NOEXEC_CONTAINER_REPOSITORY = common_config['NOEXEC_CONTAINER_REPOSITORY']
+
+# Images are local to the docker daemon of a host.
+LAST_USED_KEY = f"image-cache:{socket.gethostname()}:last-used"
+STATS_KEY = f"image-cache:{socket.gethostname()}:stats"
+
+def image_reference(rees):
+    """
+    Name of the image of a REES, as pulled from the registry.
+    """
+    return f"{BINDER_REGISTRY.split('https://')[-1]}/{rees.found_image_name}:{rees.binder_image_tag}"
+
+def _count(field, amount=1):
+    try:
+        get_redis().hincrby(STATS_KEY, field, amount)
+    except redis_lib.exceptions.RedisError as e:
+        logging.warning(f"Could not update image cache stats: {e}")
+
+def record_use(image):
+    """
+    Marks a (docker) image as used now.
+    """
+    try:
+        redis_client = get_redis()
+        redis_client.zadd(LAST_USED_KEY, {image.id: redis_client.time()[0]})
+    except redis_lib.exceptions.RedisError as e:
+        logging.warning(f"Could not record use of image {image.id}: {e}")
+
+def ensure_image(rees):
+    """
+    Makes sure that the image of a REES is available locally, pulls
+    it on a miss. Records its use, then evicts the least recently
+    used images over the budget.
+
+    Returns True on a hit (no pull).
+    """
+    reference = image_reference(rees)
+    try:
+        image = rees.docker_client.images.get(reference)
+        hit = True
+    except docker.errors.ImageNotFound:
+        logging.info(f"Image cache miss, pulling {reference}")
+        rees.pull_image()
+        image = rees.docker_image or rees.docker_client.images.get(reference)
+        hit = False
+    _count("hits" if hit else "misses")
+    record_use(image)
+    evict_images(rees.docker_client, keep=(image.id,))
+    return hit
+
+def _is_pinned(image):
+    return any(tag.split(':')[0].endswith(NOEXEC_CONTAINER_REPOSITORY) for tag in image.tags)
+
+def evict_images(docker_client, keep=()):
+    """
+    Removes the least recently used images until the tracked images fit
+    in IMAGE_CACHE_BUDGET_GB. Returns the number of bytes freed.
+
+    Sizes are those reported by docker, shared layers are counted for
+    every image, so the budget is conservative.
+    """
+    redis_client = get_redis()
+    try:
+        tracked = [image_id.decode() for image_id in redis_client.zrange(LAST_USED_KEY, 0, -1)]
+    except redis_lib.exceptions.RedisError as e:
+        logging.warning(f"Image cache unavailable, not evicting: {e}")
+        return 0
+
+    images = []
+    for image_id in tracked:
+        try:
+            images.append(docker_client.images.get(image_id))
+        except docker.errors.ImageNotFound:
+            # Removed by hand (e.g., docker image prune)
+            redis_client.zrem(LAST_USED_KEY, image_id)
+    total = sum(image.attrs['Size'] for image in images)
+    budget = IMAGE_CACHE_BUDGET_GB * 1024 ** 3
+
+    freed = 0
+    # Oldest use first
+    for image in images:
+        if total <= budget:
+            break
+        if image.id in keep or _is_pinned(image):
+            continue
+        size = image.attrs['Size']
+        try:
+            docker_client.images.remove(image.id, force=False)
+        except docker.errors.APIError as e:
+            # In use by a container (e.g., a running build)
+            logging.info(f"Could not evict image {image.tags or image.id}: {e}")
+            continue
+        logging.info(f"Evicted image {image.tags or image.id} ({size / 1024 ** 3:.1f} GB)")
+        redis_client.zrem(LAST_USED_KEY, image.id)
+        total -= size
+        freed += size
+        _count("evictions")
+        _count("evicted_bytes", size)
+    return freed
+
+def get_image_cache_stats():
+    """
+    Returns the hits, misses, evictions and evicted bytes of this host,
+    with the number of tracked images.
+    """
+    redis_client = get_redis()
+    stats = {k.decode(): int(v) for k, v in redis_client.hgetall(STATS_KEY).items()}
+    stats['images'] = redis_client.zcard(LAST_USED_KEY)
+    return stats
+
+class ImageCacheCollector:
+    """
+    Prometheus collector of the image cache stats of this host.
+    """
+    def collect(self):
+        stats = get_image_cache_stats()
+        for name in ("hits", "misses", "evictions", "evicted_bytes"):
+            yield CounterMetricFamily(f"neurolibre_image_cache_{name}", f"Image cache {name.replace('_', ' ')}.", value=stats.get(name, 0))
+        yield GaugeMetricFamily("neurolibre_image_cache_images", "Images tracked by the image cache.", value=stats['images'])
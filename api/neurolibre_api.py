@@ -27,6 +27,8 @@ class NeuroLibreAPI:
                             neurolibre_common_api.api_get_books,
                             neurolibre_common_api.api_heartbeat,
                             neurolibre_common_api.api_unlock_build,
+                            neurolibre_common_api.api_task_events,
+                            neurolibre_common_api.api_metrics,
                             neurolibre_common_api.api_preview_list,
                             neurolibre_common_api.chat,
                             neurolibre_common_api.view_logs]
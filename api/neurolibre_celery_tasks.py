@@ -1,15 +1,28 @@
 from celery import Celery
+from kombu import Queue
 import time
 import os
 import json
 import subprocess
 import redis as redis_lib
-from celery import states
+from celery import states, chord
+from celery.result import ResultBase
 from github_client import *
 from screening_client import ScreeningClient
+from build_admission import BuildAdmission, get_execute_parallel
+from binder_locks import BinderBuildLock
+from ratelimit import RedisSemaphore
+from build_coalescing import start_build, finish_build, abandon_build, is_build_superseded, notify_followers
+from build_watchdog import BuildLockWatchdog, get_build_liveness, MYST_BUILD_LOCK_LEASE
+from warm_pool import WARM_POOL_ENABLED, pool_key, claim_container, park_container, dataset_matches, discard_container
+from image_cache import IMAGE_CACHE_ENABLED, ensure_image, image_reference
+from build_index import resolve_image_digest, build_key, lookup_build, record_build
+from execution_cache import EXECUTION_CACHE_ENABLED, data_manifest_hash, cache_key as execution_cache_key, restore as restore_executions, record as record_executions
+from task_events import publish_task_event, EVENT_STATE, EVENT_PROGRESS, EVENT_LOG, EVENT_END
+from task_metrics import phase as timed_phase, observe, TASK_SECONDS, OUTCOME_FAILURE
 from common import *
 from preprint import *
-from github import Github, UnknownObjectException, GithubException
+from github import UnknownObjectException, GithubException
 from dotenv import load_dotenv
 import logging
 import requests
@@ -17,18 +30,21 @@ from flask import Response
 import shutil
 import base64
 import tempfile
-from celery.exceptions import Ignore
+from celery.exceptions import Ignore, Retry
 from repo2data.repo2data import Repo2Data
 from myst_libre.tools import JupyterHubLocalSpawner
 from myst_libre.rees import REES
 from myst_libre.builders import MystBuilder
 from celery.schedules import crontab
+from celery.signals import task_prerun, task_postrun
+from gevent import sleep as cooperative_sleep
 import zipfile
 import tempfile
 import tarfile
 import re
 from celery.exceptions import TimeoutError, SoftTimeLimitExceeded
 import functools
+import contextlib
 import yaml
 import fnmatch
 
@@ -68,8 +84,20 @@ PUBLISH_LICENSE = common_config['PUBLISH_LICENSE']
 
 CONTAINER_CPU_LIMIT = common_config.get('CONTAINER_CPU_LIMIT')
 CONTAINER_MEMORY_LIMIT = common_config.get('CONTAINER_MEMORY_LIMIT')
-MYST_EXECUTE_PARALLEL = common_config.get('MYST_EXECUTE_PARALLEL', 2)
+MYST_EXECUTE_PARALLEL = common_config.get('MYST_EXECUTE_PARALLEL', "auto")
 MYST_BUILD_TIMEOUT = common_config.get('MYST_BUILD_TIMEOUT')
+# When enabled, container limits come from the build's resource reservation
+# (see build_admission.py) instead of CONTAINER_CPU_LIMIT/CONTAINER_MEMORY_LIMIT.
+BUILD_ADMISSION_ENABLED = common_config.get('BUILD_ADMISSION_ENABLED', True)
+# Production workflow uploads (see zenodo_production_task): maximum
+# number of concurrent uploads per item across workers, retries of
+# transient upload errors and retry delays (seconds).
+ZENODO_UPLOAD_CONCURRENCY = preprint_config.get('ZENODO_UPLOAD_CONCURRENCY', {'book': 2, 'repository': 2, 'data': 1, 'docker': 1})
+ZENODO_UPLOAD_MAX_RETRIES = preprint_config.get('ZENODO_UPLOAD_MAX_RETRIES', 3)
+ZENODO_UPLOAD_RETRY_DELAY = preprint_config.get('ZENODO_UPLOAD_RETRY_DELAY', 60)
+ZENODO_UPLOAD_SLOT_WAIT = preprint_config.get('ZENODO_UPLOAD_SLOT_WAIT', 30)
+# Maximum time a build waits for another build of the same repository.
+MYST_BUILD_LOCK_WAIT = common_config.get('MYST_BUILD_LOCK_WAIT', 1800)
 
 JB_INTERFACE_OVERRIDE = preprint_config['JB_INTERFACE_OVERRIDE']
 
@@ -102,8 +130,58 @@ celery_app.conf.result_persistent = True
 
 # For long-running tasks, increase visibility timeout to prevent premature re-delivery
 # Set to 2 hours to match worker time limit
+# Priority steps enable task priorities on the Redis transport, where
+# 0 is the highest priority (messages are polled in that order).
 celery_app.conf.broker_transport_options = {
     'visibility_timeout': 7200,  # 2 hours
+    'priority_steps': list(range(10)),
+    'sep': ':',
+    'queue_order_strategy': 'priority',
+}
+
+# Queues, each consumed by a dedicated worker node with its own
+# concurrency (see systemd/default/celery), so that long builds and
+# uploads cannot starve quick tasks.
+#   build: binder/book/myst builds and data downloads (long, CPU heavy)
+#   archive: Zenodo uploads and rsync transfers (long, I/O heavy)
+#   notify: emails
+#   default: everything else (quick GitHub/Zenodo API calls, health checks)
+celery_app.conf.task_queues = (
+    Queue('build'),
+    Queue('archive'),
+    Queue('notify'),
+    Queue('default'),
+)
+celery_app.conf.task_default_queue = 'default'
+celery_app.conf.task_default_priority = 5
+
+celery_app.conf.task_routes = {
+    'neurolibre_celery_tasks.preview_build_book_task': {'queue': 'build', 'priority': 6},
+    'neurolibre_celery_tasks.preview_build_book_test_task': {'queue': 'build', 'priority': 6},
+    'neurolibre_celery_tasks.preview_build_myst_task': {'queue': 'build', 'priority': 6},
+    'neurolibre_celery_tasks.binder_build_task': {'queue': 'build', 'priority': 5},
+    'neurolibre_celery_tasks.preview_download_data': {'queue': 'build', 'priority': 7},
+    'neurolibre_celery_tasks.zenodo_upload_book_task': {'queue': 'archive', 'priority': 5},
+    'neurolibre_celery_tasks.zenodo_upload_data_task': {'queue': 'archive', 'priority': 6},
+    'neurolibre_celery_tasks.zenodo_upload_repository_task': {'queue': 'archive', 'priority': 5},
+    'neurolibre_celery_tasks.zenodo_upload_docker_task': {'queue': 'archive', 'priority': 6},
+    'neurolibre_celery_tasks.myst_upload_task': {'queue': 'archive', 'priority': 5},
+    'neurolibre_celery_tasks.image_prepull_task': {'queue': 'archive', 'priority': 7},
+    'neurolibre_celery_tasks.rsync_data_task': {'queue': 'archive', 'priority': 6},
+    'neurolibre_celery_tasks.rsync_book_task': {'queue': 'archive', 'priority': 5},
+    'neurolibre_celery_tasks.rsync_myst_prod_task': {'queue': 'archive', 'priority': 5},
+    'neurolibre_celery_tasks.zenodo_flush_task': {'queue': 'archive', 'priority': 4},
+    'neurolibre_celery_tasks.send_email_celery': {'queue': 'notify', 'priority': 0},
+    'neurolibre_celery_tasks.send_email_with_html_attachment_celery': {'queue': 'notify', 'priority': 0},
+    'neurolibre_celery_tasks.sleep_task': {'queue': 'default', 'priority': 0},
+    'neurolibre_celery_tasks.zenodo_create_buckets_task': {'queue': 'default', 'priority': 3},
+    'neurolibre_celery_tasks.zenodo_publish_task': {'queue': 'default', 'priority': 3},
+    'neurolibre_celery_tasks.zenodo_production_task': {'queue': 'default', 'priority': 3},
+    'neurolibre_celery_tasks.zenodo_production_upload_task': {'queue': 'archive', 'priority': 5},
+    'neurolibre_celery_tasks.zenodo_production_publish_task': {'queue': 'default', 'priority': 3},
+    'neurolibre_celery_tasks.fork_configure_repository_task': {'queue': 'default', 'priority': 4},
+    'neurolibre_celery_tasks.sync_fork_from_upstream_task': {'queue': 'default', 'priority': 4},
+    'neurolibre_celery_tasks.preprint_build_pdf_draft': {'queue': 'build', 'priority': 4},
 }
 
 celery_app.conf.worker_prefetch_multiplier = 1
@@ -116,8 +194,52 @@ celery_app.conf.worker_max_tasks_per_child = 100
 celery_app.conf.broker_heartbeat = 0
 
 # Redis client for distributed locks (uses the same broker instance).
-# DB 0 is the Celery broker; we use DB 2 for locks to avoid key collisions.
-_lock_redis = redis_lib.Redis(host='localhost', port=6379, db=2)
+# DB 0 is the Celery broker; we use DB 2 for locks to avoid key collisions
+# (see get_redis in common.py for the database layout).
+_lock_redis = get_redis(REDIS_LOCK_DB)
+
+# Start times of the running tasks of this worker, by task id.
+_task_started = {}
+
+@task_prerun.connect
+def record_task_start(task_id=None, **kwargs):
+    _task_started[task_id] = time.time()
+
+@task_postrun.connect
+def record_task_duration(task_id=None, task=None, state=None, **kwargs):
+    """
+    Duration of every task, by state (see task_metrics.py).
+    """
+    started = _task_started.pop(task_id, None)
+    if started is not None and task is not None:
+        observe(TASK_SECONDS, (task.name.split('.')[-1], state), time.time() - started)
+
+# Screening clients of the running BaseNeuroLibreTasks of this worker,
+# by task id, so that handle_soft_timeout reports through their
+# comment updater.
+_task_screenings = {}
+
+@task_postrun.connect
+def forget_task_screening(task_id=None, **kwargs):
+    _task_screenings.pop(task_id, None)
+
+class DuplicateDelivery(Ignore):
+    """
+    Raised by a task redelivered by the broker (visibility_timeout)
+    while its first delivery is still running. The first delivery
+    keeps reporting, the task state and events are left untouched.
+    """
+
+@task_postrun.connect
+def publish_task_end(task_id=None, state=None, retval=None, **kwargs):
+    """
+    Closes the event streams of the task (see task_events.py).
+    Tasks returning the result of a canvas they started (e.g., a chord)
+    are closed by the last task of the canvas.
+    """
+    if isinstance(retval, (ResultBase, DuplicateDelivery)):
+        return
+    publish_task_event(task_id, EVENT_END, state=state)
 
 """
 Configuration END
@@ -153,15 +275,19 @@ def handle_soft_timeout(func):
                 if 'review_repository' in args[0]:
                     review_repository = args[0]['review_repository']
             
-            # If we have a BaseNeuroLibreTask
-            if hasattr(self, 'screening') and hasattr(self.screening, 'issue_id'):
-                self.screening.respond.FAILURE(f"Task timed out after reaching its time limit: {str(e)}")
+            # If we have a BaseNeuroLibreTask, the failure goes through its comment
+            # updater, which drops any pending progress edit.
+            screening = _task_screenings.get(self.request.id)
+            if screening is not None and screening.issue_id is not None:
+                try:
+                    screening.respond.FAILURE(f"Task timed out after reaching its time limit: {str(e)}")
+                except Exception as notify_error:
+                    logging.error(f"Failed to notify on GitHub: {str(notify_error)}")
             
             # If we have enough info for a GitHub notification
             elif issue_id and comment_id and review_repository:
                 try:
-                    GH_BOT = os.getenv('GH_BOT')
-                    github_client = Github(GH_BOT)
+                    github_client = get_github_client()
                     gh_template_respond(
                         github_client, 
                         "failure", 
@@ -240,13 +366,21 @@ class BaseNeuroLibreTask:
             self.owner_name, self.repo_name, self.provider_name = get_owner_repo_provider(payload['repo_url'], provider_full_name=True)
         else:
             raise ValueError("Either screening or payload must be provided.")
+        # (phase, message, collapsable) of the last succeed/fail call.
+        self.outcome = None
+        # Timed phases (see phase), reported in the log header.
+        self.phases = []
+        # Progress updates (start) are coalesced, terminal ones are not.
+        self.screening.enable_debounced_updates()
+        _task_screenings[self.task_id] = self.screening
 
     def start(self, message=""):
         if self.screening.issue_id is not None:
             self.screening.respond.STARTED(message)
-            self.update_state(states.STARTED, {'message': message})
+        self.update_state(states.STARTED, {'message': message})
 
     def fail(self, message, attachment_path=None):
+        self.outcome = ("FAILURE", message, False)
         if self.screening.issue_id is not None:
             if attachment_path and os.path.exists(attachment_path):
                 # Create comment with file attachment
@@ -261,12 +395,15 @@ class BaseNeuroLibreTask:
                 'message': message
             })
             raise Ignore()
+        publish_task_event(self.task_id, EVENT_STATE, state=states.FAILURE, message=message)
 
     def email_user(self, message):
         if self.screening.email_address is not None:
             self.screening.send_user_email(message)
 
     def succeed(self, message, collapsable=True, attachment_path=None):
+        self.outcome = ("SUCCESS", message, collapsable)
+        publish_task_event(self.task_id, EVENT_STATE, state=states.SUCCESS, message=message)
         if self.screening.issue_id is not None:
             if attachment_path:
                 self.screening.STATE_WITH_ATTACHMENT(message, attachment_path, failure=False)
@@ -275,6 +412,53 @@ class BaseNeuroLibreTask:
 
     def update_state(self, state, meta):
         self.celery_task.update_state(state=state, meta=meta)
+        publish_task_event(self.task_id, EVENT_STATE, state=state, message=meta.get('message'))
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Times a phase of the task (see task_metrics.py):
+
+        with task.phase("archive") as phase:
+            ...
+            phase.nbytes = os.path.getsize(archive_path)
+
+        A phase in which the task fails ends as "failure".
+        """
+        outcome = self.outcome
+        with timed_phase(self.celery_task.name.split('.')[-1], name, on_end=self.phases.append) as p:
+            try:
+                yield p
+            finally:
+                if self.outcome is not outcome and self.outcome[0] == "FAILURE":
+                    p.outcome = OUTCOME_FAILURE
+
+    def phase_summary(self):
+        """
+        Returns {phase_<name>: duration, outcome and bytes} of the timed phases.
+        """
+        return {f"phase_{p.name}": p.summary() for p in self.phases}
+
+    def write_log(self, log_type, log_content, info_dict=None):
+        """
+        Writes a log of the task repository, with the timed phases
+        in its header.
+        """
+        info_dict = dict(info_dict or {})
+        info_dict.update(self.phase_summary())
+        return write_log(self.owner_name, self.repo_name, log_type, log_content, info_dict)
+
+    def progress(self, current, total, message=""):
+        """
+        Reports a progress counter (e.g., uploaded items) to event stream clients.
+        """
+        publish_task_event(self.task_id, EVENT_PROGRESS, current=current, total=total, message=message)
+
+    def log(self, line):
+        """
+        Sends a log line to event stream clients.
+        """
+        publish_task_event(self.task_id, EVENT_LOG, line=line)
 
     def get_commit_hash(self):
         return format_commit_hash(self.payload['repo_url'], self.payload.get('commit_hash', 'HEAD'))
@@ -334,8 +518,7 @@ def rsync_data_task(self, comment_id, issue_id, project_name, reviewRepository):
     from the test server.
     """
     task_title = "DATA TRANSFER (Preview --> Preprint)"
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = get_github_client()
     task_id = self.request.id
     remote_path = os.path.join("neurolibre-preview:", "DATA", project_name)
     # TODO: improve this, subpar logging.
@@ -383,8 +566,7 @@ def rsync_book_task(self, repo_url, commit_hash, comment_id, issue_id, reviewRep
     to enable DOI formatted links.
     """
     task_title = "REPRODUCIBLE PREPRINT TRANSFER (Preview --> Preprint)"
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = get_github_client()
     task_id = self.request.id
     [owner,repo,provider] = get_owner_repo_provider(repo_url,provider_full_name=True)
     if owner != GH_ORGANIZATION:
@@ -452,8 +634,7 @@ def rsync_book_task(self, repo_url, commit_hash, comment_id, issue_id, reviewRep
 def fork_configure_repository_task(self, payload):
     task_title = "INITIATE PRODUCTION (Fork and Configure)"
 
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = get_github_client()
     task_id = self.request.id
 
     now = get_time()
@@ -519,16 +700,22 @@ def fork_configure_repository_task(self, payload):
 
     gh_template_respond(github_client,"started",task_title,payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], "Forked repo has become available. Proceeding with configuration updates.")
 
-    jb_config = gh_get_jb_config(github_client,forked_name)
-    jb_toc = gh_get_jb_toc(github_client,forked_name)
-    myst_config = gh_get_myst_config(github_client,forked_name)
+    # Configuration files of the fork and license of the upstream in one request.
+    try:
+        snapshot = gh_get_repository_snapshot(github_client, forked_name,
+                                              ["content/_config.yml", "content/_toc.yml", "myst.yml", "favicon.ico", "logo.png"],
+                                              license_repository=payload['repository_url'])
+    except Exception as e:
+        msg = f"Could not read the configuration of {forked_name}: \n {str(e)}"
+        gh_template_respond(github_client,"failure",task_title,payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], msg)
+        self.update_state(state=states.FAILURE, meta={'exc_type':f"{JOURNAL_NAME} celery exception",'exc_message': "Custom",'message': msg})
+        return
+
+    jb_config = snapshot['yaml']["content/_config.yml"]
+    jb_toc = snapshot['yaml']["content/_toc.yml"]
+    myst_config = snapshot['yaml']["myst.yml"]
 
-    code_license_info = get_repository_license(github_client, payload['repository_url'])
-    
-    if code_license_info['status']:
-        code_license_info = code_license_info['license']
-    else:
-        code_license_info = None
+    code_license_info = snapshot['license']
 
     if (not jb_config or not jb_toc) and (not myst_config):
         msg = f"Could not load [_config.yml and _toc.yml] under the content or myst.yml at the base of {forked_name}"
@@ -541,21 +728,16 @@ def fork_configure_repository_task(self, payload):
         'logo.png': '../assets/logo.png'
     }
 
+    # All changes are committed at once at the end (see gh_commit_files).
+    files_to_commit = {}
     for target_path, source_path in assets_to_upload.items():
+        # Do not overwrite existing assets.
+        if snapshot['exists'][target_path]:
+            logging.info(f"{target_path} already exists in {forked_name}")
+            continue
         try:
             with open(source_path, 'rb') as f:
-                image_content = f.read()
-                result = gh_create_file(
-                    github_client, 
-                    forked_name, 
-                    target_path, 
-                    image_content, 
-                    encoding=None
-                )
-            if result["status"]:
-                logging.info(f"{target_path} created successfully")
-            else:
-                logging.info(f"Error creating {target_path}: {result['message']}")
+                files_to_commit[target_path] = f.read()
         except Exception as e:
             logging.info(f"Error reading {source_path}: {str(e)}")
     
@@ -606,9 +788,10 @@ def fork_configure_repository_task(self, payload):
         if myst_config['site']['template'] == "article-theme" and 'banner' not in myst_config['project']:
             myst_config_new['project']['banner'] = f"https://raw.githubusercontent.com/evidencepub/brand/main/banner/png/article_hdr_{random.randint(1,7)}.jpg"
 
-        if not myst_config_new != myst_config:
-            response = gh_update_myst_config(github_client,forked_name,myst_config_new)
-        
+        files_to_commit['myst.yml'] = yaml.dump(myst_config_new)
+        response = gh_commit_files(github_client, forked_name, files_to_commit,
+                                   ":robot: [Automated] MyST configuration update")
+
         if not response['status']:
             msg = f"Could not update myst.yml for {forked_name}: \n {response['message']}"
             gh_template_respond(github_client,"failure",task_title,payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], msg)
@@ -631,14 +814,7 @@ def fork_configure_repository_task(self, payload):
         # Make sure that there's a link to the forked source.
         jb_config['repository']['url'] = f"https://github.com/{forked_name}"
 
-        # Update configuration file in the forked repo
-        response = gh_update_jb_config(github_client,forked_name,jb_config)
-
-        if not response['status']:
-            msg = f"Could not update _config.yml for {forked_name}: \n {response['message']}"
-            gh_template_respond(github_client,"failure",task_title,payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], msg)
-            self.update_state(state=states.FAILURE, meta={'exc_type':f"{JOURNAL_NAME} celery exception",'exc_message': "Custom",'message': msg})
-            return
+        files_to_commit['content/_config.yml'] = yaml.dump(jb_config)
 
         jb_toc_new = jb_toc
         if 'parts' in jb_toc:
@@ -662,15 +838,16 @@ def fork_configure_repository_task(self, payload):
                 "title": "Citable PDF and archives"
             })
 
-        # Update TOC file in the forked repo only if the new toc is different
-        # otherwise github api will complain.
-        if not jb_toc_new != jb_toc:
-            response = gh_update_jb_toc(github_client,forked_name,jb_toc)
+        files_to_commit['content/_toc.yml'] = yaml.dump(jb_toc_new)
+
+        # Assets, configuration and TOC updates in a single commit.
+        response = gh_commit_files(github_client, forked_name, files_to_commit,
+                                   ":robot: [Automated] JB configuration and TOC update")
 
         if not response['status']:
-            msg = f"Could not update toc.yml for {forked_name}: \n {response['message']}"
+            msg = f"Could not update _config.yml and _toc.yml for {forked_name}: \n {response['message']}"
             gh_template_respond(github_client,"failure",task_title,payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], msg)
-            self.update_state(state=states.FAILURE, meta={'exc_type':f"{JOURNAL_NAME} celery exception",'exc_message': "Custom",'message': f"Could not update _toc.yml for {forked_name}"})
+            self.update_state(state=states.FAILURE, meta={'exc_type':f"{JOURNAL_NAME} celery exception",'exc_message': "Custom",'message': f"Could not update _config.yml and _toc.yml for {forked_name}"})
             return
 
         msg = f"Please confirm that the <a href=\"https://github.com/{forked_name}\">forked repository</a> is available and (<code>_toc.yml</code> and <code>_config.ymlk</code>) properly configured."
@@ -795,6 +972,7 @@ def sync_fork_from_upstream_task(self, screening_dict):
         fork_main_sha = fork_main_branch.commit.sha
 
         yaml_comparisons = []
+        preserved_files = {}
         for file_path in files_to_preserve:
             try:
                 task.start(f"Preserving {file_path} from fork's main")
@@ -818,20 +996,24 @@ def sync_fork_from_upstream_task(self, screening_dict):
                     # File doesn't exist in upstream
                     yaml_comparisons.append(f"### 📝 `{file_path}`\n\nThis file exists in fork but not in upstream.")
 
-                # Update the file in the sync branch with fork's version
-                forked_repo.update_file(
-                    path=file_path,
-                    message=f"Preserve {file_path} from fork",
-                    content=fork_file_content.decoded_content,
-                    sha=forked_repo.get_contents(file_path, ref=sync_branch).sha,
-                    branch=sync_branch
-                )
-                task.start(f"Preserved {file_path} from fork's main in {sync_branch}")
+                # Fork's version will be committed to the sync branch
+                preserved_files[file_path] = fork_file_content.decoded_content
             except Exception as e:
                 # File might not exist in upstream or fork, log but continue
                 task.start(f"Could not preserve {file_path}: {str(e)}")
                 yaml_comparisons.append(f"### ⚠️ `{file_path}`\n\nCould not preserve: {str(e)}")
 
+        if preserved_files:
+            # Single commit for all the preserved files
+            preserved_list = ", ".join(preserved_files.keys())
+            response = gh_commit_files(task.screening.github_client, forked_name, preserved_files,
+                                       f"Preserve {preserved_list} from fork", branch=sync_branch)
+            if response['status']:
+                task.start(f"Preserved {preserved_list} from fork's main in {sync_branch}")
+            else:
+                task.start(f"Could not preserve {preserved_list}: {response['message']}")
+                yaml_comparisons.append(f"### ⚠️ `{preserved_list}`\n\nCould not preserve: {response['message']}")
+
         # Create a pull request from sync branch to main
         pr_title = f'🤖 {task.screening.preprint_version} changes from upstream ({upstream_repo_name})'
         pr_body = load_txt_file(os.path.join(os.path.dirname(__file__),'templates/version_pr.md.template'))
@@ -875,8 +1057,7 @@ def sync_fork_from_upstream_task(self, screening_dict):
 @celery_app.task(bind=True)
 def preview_build_book_task(self, payload):
 
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = get_github_client()
     task_id = self.request.id
     # binderhub_request = run_binder_build_preflight_checks(payload['repo_url'],
     #                                                       payload['commit_hash'],
@@ -972,8 +1153,7 @@ def preview_build_book_task(self, payload):
 @handle_soft_timeout
 def zenodo_create_buckets_task(self, payload):
 
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = get_github_client()
     task_id = self.request.id
 
     gh_template_respond(github_client,"started",payload['task_title'], payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'])
@@ -987,89 +1167,24 @@ def zenodo_create_buckets_task(self, payload):
         self.update_state(state=states.FAILURE, meta={'exc_type':f"{JOURNAL_NAME} celery exception",'exc_message': "Custom",'message': msg})
         return
 
-    data = payload['paper_data']
+    def on_progress(archive_type):
+        gh_template_respond(github_client,"started",payload['task_title'], payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], f"Creating Zenodo buckets for {archive_type}")
 
-    # We need to go through some affiliation mapping here.
-    affiliation_mapping = {str(affiliation['index']): affiliation['name'] for affiliation in data['affiliations']}
-    first_affiliations = []
-    for author in data['authors']:
-        if isinstance(author['affiliation'],int):
-            affiliation_index = author['affiliation']
-        else:
-            affiliation_indices = [affiliation_index for affiliation_index in author['affiliation'].split(',')]
-            affiliation_index = affiliation_indices[0]
-        first_affiliation = affiliation_mapping[str(affiliation_index)]
-        first_affiliations.append(first_affiliation)
-
-    for ii in range(len(data['authors'])):
-        data['authors'][ii]['affiliation'] = first_affiliations[ii]
-
-    # To deal with some typos, also with orchid :)
-    valid_field_names = {'name', 'orcid', 'affiliation'}
-    for author in data['authors']:
-        invalid_fields = []
-        for field in author:
-            if field not in valid_field_names:
-                invalid_fields.append(field)
-
-        for invalid_field in invalid_fields:
-            valid_field = None
-            for valid_name in valid_field_names:
-                if valid_name.lower() in invalid_field.lower() or (valid_name == 'orcid' and invalid_field.lower() == 'orchid'):
-                    valid_field = valid_name
-                    break
-
-            if valid_field:
-                author[valid_field] = author.pop(invalid_field)
-
-        if 'equal-contrib' in author:
-            author.pop('equal-contrib')
-
-        if 'corresponding' in author:
-            author.pop('corresponding')
-
-        # if author.get('orcid') is None:
-        #     author.pop('orcid')
-
-    collect = {}
-    for archive_type in payload['archive_assets']:
-                gh_template_respond(github_client,"started",payload['task_title'], payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], f"Creating Zenodo buckets for {archive_type}")
-                tmp = item_to_record_name(archive_type)
-                r = zenodo_create_bucket(data['title'],
-                                         archive_type,
-                                         data['authors'],
-                                         payload['repository_url'],
-                                         payload['issue_id'])
-                collect[archive_type] = r
-                # Rate limit
-                time.sleep(2)
-
-    if {k: v for k, v in collect.items() if 'reason' in v}:
-        # This means at least one of the deposits has failed.
-        logging.info(f"Caught an issue with the deposit. A record (JSON) will not be created.")
-
-        # Delete deposition if succeeded for a certain resource
-        remove_dict = {k: v for k, v in collect.items() if not 'reason' in v }
-        for key in remove_dict:
-            logging.info("Deleting " + remove_dict[key]["links"]["self"])
-            tmp = zenodo_delete_bucket(remove_dict[key]["links"]["self"])
-            time.sleep(1)
-            # Returns 204 if successful, cast str to display
-            collect[key + "_deleted"] = str(tmp)
+    success, collect = zenodo_create_buckets(payload['paper_data'],
+                                             payload['archive_assets'],
+                                             payload['repository_url'],
+                                             payload['issue_id'],
+                                             on_progress)
+    if not success:
         gh_template_respond(github_client,"failure",payload['task_title'], payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], f"{collect}")
     else:
-        # This means that all requested deposits are successful
-        print(f'Writing {local_file}...')
-        with open(local_file, 'w') as outfile:
-            json.dump(collect, outfile)
         gh_template_respond(github_client,"success",payload['task_title'], payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], f"Zenodo records have been created successfully: \n {collect}")
 
 @celery_app.task(bind=True)
 @handle_soft_timeout
 def zenodo_upload_book_task(self, payload):
 
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = get_github_client()
     task_id = self.request.id
 
     gh_template_respond(github_client,"started",payload['task_title'], payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'])
@@ -1121,8 +1236,7 @@ def zenodo_upload_book_task(self, payload):
 @handle_soft_timeout
 def zenodo_upload_data_task(self,payload):
 
-        GH_BOT=os.getenv('GH_BOT')
-        github_client = Github(GH_BOT)
+        github_client = get_github_client()
         task_id = self.request.id
 
         gh_template_respond(github_client,"started",payload['task_title'], payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'])
@@ -1176,8 +1290,7 @@ def zenodo_upload_data_task(self,payload):
 @handle_soft_timeout
 def zenodo_upload_repository_task(self, payload):
 
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = get_github_client()
     task_id = self.request.id
 
     gh_template_respond(github_client,"started",payload['task_title'], payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'])
@@ -1195,8 +1308,7 @@ def zenodo_upload_repository_task(self, payload):
 
     # REFACTOR HERE AND MANAGE CONDITIONS CLEANER.
     # Try main first
-    resp = os.system(f"wget -O {zenodo_file} {download_url}")
-    if resp != 0:
+    if not download_file(download_url, zenodo_file):
         gh_template_respond(github_client,"failure",payload['task_title'], payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], f"Cannot download: {download_url}")
         self.update_state(state=states.FAILURE, meta={'exc_type':f"{JOURNAL_NAME} celery exception",'exc_message': "Custom",'message': f"Cannot download {download_url}"})
         return
@@ -1265,7 +1377,11 @@ def zenodo_upload_docker_task(self, screening_dict):
 
         if rees_resources.search_img_by_repo_name():
             logging.info(f"🐳 FOUND IMAGE... ⬇️ PULLING {rees_resources.found_image_name}")
-            rees_resources.pull_image()
+            with task.phase("image_pull"):
+                if IMAGE_CACHE_ENABLED:
+                    ensure_image(rees_resources)
+                else:
+                    rees_resources.pull_image()
         else:
             task.fail(f"Failes REES docker image pull for {fork_url}")
 
@@ -1309,7 +1425,12 @@ def zenodo_upload_docker_task(self, screening_dict):
         # First binder deployment was done with the registry url entered twice...
         # In the config['common.yaml'] file the registry address includes https://, so we need to remove it.
         image_name = f"{BINDER_REGISTRY.split('https://')[-1]}/{rees_resources.found_image_name}:{commit_fork}"
-        r = docker_save(image_name,task.screening.issue_id,commit_fork)
+        with task.phase("docker_save") as phase:
+            r = docker_save(image_name,task.screening.issue_id,commit_fork)
+            if r[0]['status']:
+                phase.nbytes = os.path.getsize(r[1])
+            else:
+                phase.outcome = OUTCOME_FAILURE
         
         if not r[0]['status']:
             task.fail(f"Cannot save the docker image \n {r[0]['message']}")
@@ -1319,7 +1440,11 @@ def zenodo_upload_docker_task(self, screening_dict):
 
         task.start(f"Uploading docker image: \n {tar_file}")
 
-        response = zenodo_upload_item(tar_file,task.screening.bucket_url,task.screening.issue_id,commit_fork,"docker")
+        with task.phase("upload") as phase:
+            response = zenodo_upload_item(tar_file,task.screening.bucket_url,task.screening.issue_id,commit_fork,"docker")
+            phase.nbytes = os.path.getsize(tar_file)
+            if not (isinstance(response, requests.Response) and response.status_code < 300):
+                phase.outcome = OUTCOME_FAILURE
         if (isinstance(response, requests.Response)):
             if (response.status_code > 300):
                 task.fail(f"ERROR {fork_url}: {response.text}")
@@ -1338,8 +1463,7 @@ def zenodo_upload_docker_task(self, screening_dict):
 @handle_soft_timeout
 def zenodo_publish_task(self, payload):
 
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = get_github_client()
     task_id = self.request.id
 
     gh_template_respond(github_client,"started",payload['task_title'], payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'])
@@ -1354,10 +1478,9 @@ def zenodo_publish_task(self, payload):
         # Show already exists status
         gh_template_respond(github_client,"exists",payload['task_title'], payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], f"Looks like the reproducibility assets have already been published! So... \n\n {gpt_response}", False)
         dois = zenodo_collect_dois(payload['issue_id'])
-        for key in dois.keys():
-            command = f"@roboneuro set {dois[key]} as {key} archive"
-            gh_create_comment(github_client,payload['review_repository'],payload['issue_id'],command)
-            time.sleep(1)
+        # One command per comment, all created with a single request.
+        commands = [f"@roboneuro set {dois[key]} as {key} archive" for key in dois.keys()]
+        gh_create_comments(github_client,payload['review_repository'],payload['issue_id'],commands)
         return
     else:
         # Not published, issue the command.
@@ -1379,12 +1502,7 @@ def zenodo_publish_task(self, payload):
             gpt_response = get_gpt_response(prompt)
             gh_template_respond(github_client,"success",payload['task_title'], payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], f"Congrats! Reproducibility assets have been successfully archived and published :rocket: \n\n {gpt_response}", False)
             dois = zenodo_collect_dois(payload['issue_id'])
-            msgs = ["🥳 Reproducibility assets have been successfully archived and published!"]
-            msgs.append("\n>[!NOTE]\n>It may take a few minutes for Zenodo DOIs to be set. You can test each DOI by clicking the `(test ... DOI)` hyperlinks. Successful page load is a prerequisite for finalizing DOI assignment. \n\n When the DOIs become available, you can set them as reproducibility assets by running the following commands per object:")
-            for key in dois.keys():
-                msgs.append(f"\n* [Test {key} DOI](https://doi.org/{dois[key]}) ➡️ `@roboneuro set {dois[key]} as {key} archive`")
-            
-            gh_create_comment(github_client,payload['review_repository'],payload['issue_id'],"".join(msgs))
+            gh_create_comment(github_client,payload['review_repository'],payload['issue_id'],zenodo_doi_commands_message(dois))
 
         else:
             # Some one None
@@ -1393,6 +1511,277 @@ def zenodo_publish_task(self, payload):
             gh_template_respond(github_client,"failure",payload['task_title'], payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], msg, False)
             self.update_state(state=states.FAILURE, meta={'exc_type':f"{JOURNAL_NAME} celery exception",'exc_message': "Custom",'message': msg})
 
+def zenodo_doi_commands_message(dois):
+    """
+    Comment listing the DOIs of the published assets and the commands to set them.
+    """
+    msgs = ["🥳 Reproducibility assets have been successfully archived and published!"]
+    msgs.append("\n>[!NOTE]\n>It may take a few minutes for Zenodo DOIs to be set. You can test each DOI by clicking the `(test ... DOI)` hyperlinks. Successful page load is a prerequisite for finalizing DOI assignment. \n\n When the DOIs become available, you can set them as reproducibility assets by running the following commands per object:")
+    for key in dois.keys():
+        msgs.append(f"\n* [Test {key} DOI](https://doi.org/{dois[key]}) ➡️ `@roboneuro set {dois[key]} as {key} archive`")
+    return "".join(msgs)
+
+"""
+Production workflow of the reproducibility assets:
+
+    zenodo_production_task
+        creates the Zenodo buckets (unless they exist), then starts
+    chord(zenodo_production_upload_task per item)
+        uploads in parallel, at most ZENODO_UPLOAD_CONCURRENCY[item]
+        uploads of a kind at a time across workers, then
+    zenodo_production_publish_task
+        publishes the records if all the items have been uploaded.
+
+Upload tasks never fail (a failed item is reported in the result),
+so that one item cannot prevent the others from completing. Items
+uploaded earlier are skipped, the workflow can be started again to
+retry failed items. Status of the items is kept in Redis and shown
+in the status comment of the workflow.
+"""
+
+ZENODO_PRODUCTION_STATUS_ICONS = {
+    "queued": "⏳",
+    "waiting": "⏳",
+    "uploading": "🔄",
+    "retrying": "🔁",
+    "uploaded": "🟢",
+    "failed": "🔴",
+}
+
+def _zenodo_production_key(workflow_id):
+    return f"zenodo-production:{workflow_id}"
+
+def zenodo_production_table(workflow_id):
+    """
+    Markdown table of the item statuses of a production workflow.
+    Returns the table and the number of completed (uploaded or failed) items.
+    """
+    statuses = {k.decode(): json.loads(v) for k, v in get_redis().hgetall(_zenodo_production_key(workflow_id)).items()}
+    rows = ["| Item | Status | Details |", "| --- | --- | --- |"]
+    for item in sorted(statuses):
+        status = statuses[item]
+        icon = ZENODO_PRODUCTION_STATUS_ICONS.get(status['status'], "")
+        rows.append(f"| {item_to_record_name(item)} | {icon} {status['status']} | {status.get('message', '')} |")
+    done = sum(1 for status in statuses.values() if status['status'] in ("uploaded", "failed"))
+    return "\n".join(rows), done, len(statuses)
+
+def zenodo_production_status(screening_dict, item, status, message=""):
+    """
+    Records the status of an item and refreshes the workflow comment.
+    Status updates are best effort, they never fail the upload.
+    """
+    workflow_id = screening_dict['task_id']
+    try:
+        key = _zenodo_production_key(workflow_id)
+        get_redis().hset(key, item, json.dumps(dict(status=status, message=message)))
+        get_redis().expire(key, 86400)
+        table, done, total = zenodo_production_table(workflow_id)
+        publish_task_event(workflow_id, EVENT_PROGRESS, current=done, total=total, item=item, status=status, message=message)
+        screening = ScreeningClient.from_dict(screening_dict)
+        screening.respond.STARTED(f"Uploading reproducibility assets ({done}/{total}).\n\n{table}", collapsable=False)
+    except Exception as e:
+        logging.warning(f"Could not update the status of {item} in workflow {workflow_id}: {e}")
+
+def prepare_zenodo_archive(item, issue_id, repository_url, commit_fork):
+    """
+    Creates the archive of a reproducibility asset for its Zenodo upload.
+    Data and docker archives left by a previous attempt are reused.
+
+    Returns (archive_path, commit_hash), raises ValueError on failure.
+    """
+    github_client = get_github_client()
+    owner, repo, provider = get_owner_repo_provider(repository_url, provider_full_name=True)
+    fork_url = f"https://{provider}/{GH_ORGANIZATION}/{repo}"
+    record_name = item_to_record_name(item)
+    archive_base = os.path.join(get_archive_dir(issue_id),f"{record_name}_{DOI_PREFIX}_{JOURNAL_NAME}_{issue_id:05d}_{commit_fork[0:6]}")
+
+    if item == "book":
+        return prepare_myst_book_archive(issue_id, repo)
+    elif item == "repository":
+        default_branch = get_default_branch(github_client, fork_url)
+        download_url = f"{fork_url}/archive/refs/heads/{default_branch}.zip"
+        zenodo_file = archive_base + ".zip"
+        if not download_file(download_url, zenodo_file):
+            raise ValueError(f"Cannot download {download_url}")
+        return zenodo_file, commit_fork
+    elif item == "data":
+        zenodo_file = archive_base + ".zip"
+        if not os.path.exists(zenodo_file):
+            # NEW CONVENTION: SHARED STORAGE
+            project_name = gh_get_project_name(github_client, repository_url)
+            shutil.make_archive(archive_base, 'zip', os.path.join(DATA_NFS_PATH, project_name))
+        return zenodo_file, commit_fork
+    elif item == "docker":
+        tar_file = archive_base + ".tar.gz"
+        if not os.path.exists(tar_file):
+            rees_resources = REES(dict(
+                registry_url=BINDER_REGISTRY,
+                gh_user_repo_name = f"{GH_ORGANIZATION}/{repo}",
+                gh_repo_commit_hash = commit_fork,
+                binder_image_tag = commit_fork,
+                binder_image_name = None,
+                dotenv = os.path.join(os.environ.get('HOME'),'full-stack-server','api')))
+            if not rees_resources.search_img_by_repo_name():
+                raise ValueError(f"Cannot find the docker image of {fork_url}")
+            rees_resources.pull_image()
+            # See zenodo_upload_docker_task for the registry url in the image name.
+            image_name = f"{BINDER_REGISTRY.split('https://')[-1]}/{rees_resources.found_image_name}:{commit_fork}"
+            r = docker_save(image_name, issue_id, commit_fork)
+            if not r[0]['status']:
+                raise ValueError(f"Cannot save the docker image {r[0]['message']}")
+            tar_file = r[1]
+        return tar_file, commit_fork
+    raise ValueError(f"Unrecognized archive type {item}.")
+
+@celery_app.task(bind=True)
+@handle_soft_timeout
+def zenodo_production_task(self, screening_dict):
+    """
+    Starts the production workflow of the reproducibility assets.
+    """
+    task = BaseNeuroLibreTask(self, screening_dict)
+    issue_id = task.screening.issue_id
+    repository_url = task.screening.target_repo_url
+    github_client = task.screening.github_client
+
+    fork_url = f"https://{task.provider_name}/{GH_ORGANIZATION}/{task.repo_name}"
+    commit_fork = format_commit_hash(fork_url, "HEAD")
+
+    deposit = get_zenodo_deposit(issue_id)
+    if deposit is None:
+        task.start("Creating Zenodo buckets.")
+        issue_tags = task.screening.gh_read_issue_tags()
+        paper_data = parse_front_matter(gh_get_paper_markdown(github_client, repository_url))
+        if not paper_data:
+            task.fail(f"Cannot extract metadata from the front-matter of the `paper.md` for {repository_url}.")
+            return
+        success, deposit = zenodo_create_buckets(paper_data,
+                                                 zenodo_archive_assets(issue_tags),
+                                                 repository_url,
+                                                 issue_id,
+                                                 lambda archive_type: task.start(f"Creating Zenodo buckets for {archive_type}"))
+        if not success:
+            task.fail(f"Could not create the Zenodo buckets: \n {deposit}")
+            return
+    elif zenodo_confirm_status(issue_id, "published")[0]:
+        task.succeed("Reproducibility assets have already been published. Use `roboneuro zenodo publish` to set the DOIs.")
+        return
+
+    # Items uploaded by a previous run (or command) are not uploaded again.
+    pending = [item for item in deposit if not zenodo_is_uploaded(issue_id, item)]
+    workflow_dict = task.screening.to_dict()
+    key = _zenodo_production_key(task.task_id)
+    pipe = get_redis().pipeline()
+    for item in deposit:
+        if item in pending:
+            pipe.hset(key, item, json.dumps(dict(status="queued", message="")))
+        else:
+            pipe.hset(key, item, json.dumps(dict(status="uploaded", message="Uploaded earlier")))
+    pipe.expire(key, 86400)
+    pipe.execute()
+
+    table, done, total = zenodo_production_table(task.task_id)
+    task.start(f"Uploading reproducibility assets ({done}/{total}).\n\n{table}")
+
+    publish = zenodo_production_publish_task.s(workflow_dict)
+    if not pending:
+        return publish.delay([])
+    uploads = [zenodo_production_upload_task.s(workflow_dict, item, deposit[item]['links']['bucket'], commit_fork) for item in pending]
+    # Returning the result keeps the event stream of the workflow open
+    # until the publish step (see publish_task_end).
+    return chord(uploads)(publish)
+
+@celery_app.task(bind=True, soft_time_limit=5000, time_limit=6000, max_retries=None)
+def zenodo_production_upload_task(self, screening_dict, item, bucket_url, commit_fork, attempt=1):
+    """
+    Uploads one reproducibility asset (header of the production chord).
+
+    Returns dict(item, status, message), status is "uploaded" or "failed".
+    Waits (retries) for a free upload slot of its kind, and retries
+    transient upload errors up to ZENODO_UPLOAD_MAX_RETRIES times.
+    """
+    issue_id = screening_dict['issue_id']
+    semaphore = RedisSemaphore(f"zenodo-upload:{item}", ZENODO_UPLOAD_CONCURRENCY.get(item, 1), ttl=6000)
+    if not semaphore.acquire(self.request.id):
+        zenodo_production_status(screening_dict, item, "waiting", "Waiting for an upload slot")
+        raise self.retry(kwargs=dict(attempt=attempt), countdown=ZENODO_UPLOAD_SLOT_WAIT)
+
+    result = dict(item=item, status="failed", message="")
+    try:
+        zenodo_production_status(screening_dict, item, "uploading", f"Attempt {attempt}")
+        with timed_phase("zenodo_production_upload_task", f"{item}_archive") as phase:
+            archive_path, commit = prepare_zenodo_archive(item, issue_id, screening_dict['target_repo_url'], commit_fork)
+            phase.nbytes = os.path.getsize(archive_path)
+        with timed_phase("zenodo_production_upload_task", f"{item}_upload") as phase:
+            response = zenodo_upload_item(archive_path, bucket_url, issue_id, commit, item)
+            phase.nbytes = os.path.getsize(archive_path)
+            if not (isinstance(response, requests.Response) and response.status_code < 300):
+                phase.outcome = OUTCOME_FAILURE
+        if isinstance(response, requests.Response) and response.status_code < 300:
+            zenodo_record_upload(issue_id, item, commit, response.json())
+            result = dict(item=item, status="uploaded", message=os.path.basename(archive_path))
+        else:
+            if isinstance(response, requests.Response):
+                message = f"{response.status_code}: {response.text}"
+                transient = response.status_code >= 500 or response.status_code == 429
+            else:
+                # Connection errors (str)
+                message = str(response)
+                transient = True
+            if transient and attempt < ZENODO_UPLOAD_MAX_RETRIES:
+                zenodo_production_status(screening_dict, item, "retrying", f"Attempt {attempt} failed: {message[:200]}")
+                raise self.retry(kwargs=dict(attempt=attempt + 1), countdown=ZENODO_UPLOAD_RETRY_DELAY * attempt)
+            result['message'] = message
+    except Retry:
+        raise
+    except ValueError as e:
+        result['message'] = str(e)
+    except SoftTimeLimitExceeded:
+        result['message'] = "Upload exceeded its time limit."
+    except Exception as e:
+        logging.exception(f"Upload of {item} for issue {issue_id} failed")
+        result['message'] = f"Unexpected error: {e}"
+    finally:
+        semaphore.release(self.request.id)
+
+    zenodo_production_status(screening_dict, item, result['status'], result['message'][:200])
+    return result
+
+@celery_app.task(bind=True)
+@handle_soft_timeout
+def zenodo_production_publish_task(self, results, screening_dict):
+    """
+    Publishes the Zenodo records once all the uploads have completed
+    (body of the production chord).
+    """
+    workflow_id = screening_dict['task_id']
+    task = BaseNeuroLibreTask(self, screening_dict)
+    # Report in the status comment of the workflow.
+    task.screening.task_id = workflow_id
+    issue_id = task.screening.issue_id
+    try:
+        table, done, total = zenodo_production_table(workflow_id)
+        failed = [result['item'] for result in results if result['status'] != "uploaded"]
+        if failed:
+            task.fail(f"Could not upload {', '.join(failed)}. Start the production workflow again to retry the failed items.\n\n{table}")
+            return
+
+        task.start(f"All reproducibility assets have been uploaded, publishing the Zenodo records.\n\n{table}")
+        response = zenodo_publish(issue_id)
+        if response == "no-record-found":
+            task.fail(f"I could not find any Zenodo-related records on {JOURNAL_NAME} servers.")
+            return
+        publish_status = zenodo_confirm_status(issue_id, "published")
+        if not publish_status[0]:
+            response.append(f"\n Looks like there's a problem. {publish_status[1]} reproducibility assets are archived.")
+            task.fail("\n".join(response))
+            return
+        task.succeed(f"Reproducibility assets have been successfully archived and published :rocket:\n\n{table}", collapsable=False)
+        gh_create_comment(task.screening.github_client, task.screening.review_repository, issue_id, zenodo_doi_commands_message(zenodo_collect_dois(issue_id)))
+    finally:
+        phase = task.outcome[0] if task.outcome else states.FAILURE
+        publish_task_event(workflow_id, EVENT_END, state=phase)
+
 ### DUPLICATION FOR NOW, SAVING THE DAY.
 
 @celery_app.task(bind=True)
@@ -1401,71 +1790,24 @@ def preview_build_book_test_task(self, payload):
 
     task_id = self.request.id
     owner,repo,provider = get_owner_repo_provider(payload['repo_url'],provider_full_name=True)
+    build_lock = BinderBuildLock(payload['repo_url'], task_id)
     binderhub_request = run_binder_build_preflight_checks(payload['repo_url'],
                                                           payload['commit_hash'],
                                                           payload['rate_limit'],
                                                           payload['binder_name'],
-                                                          payload['domain_name'])
-    lock_filename = get_lock_filename(payload['repo_url'])
-    response = requests.get(binderhub_request, stream=True)
+                                                          payload['domain_name'],
+                                                          build_lock)
     mail_body = f"Runtime environment build has been started <code>{task_id}</code> If successful, it will be followed by the Jupyter Book build."
     send_email_celery.delay(payload['email'],payload['mail_subject'],mail_body)
     now = get_time()
     self.update_state(state=states.STARTED, meta={'message': f"IN PROGRESS: Build for {owner}/{repo} at {payload['commit_hash']} has been running since {now}"})
-    #gh_template_respond(github_client,"started",payload['task_title'],payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], f"Running for: {binderhub_request}")
-    if response.ok:
-        # Create binder_stream generator object
-        def generate():
-            #start_time = time.time()
-            #messages = []
-            #n_updates = 0
-            for line in response.iter_lines():
-                if line:
-                    event_string = line.decode("utf-8")
-                    try:
-                        event = json.loads(event_string.split(': ', 1)[1])
-                        # https://binderhub.readthedocs.io/en/latest/api.html
-                        if event.get('phase') == 'failed':
-                            message = event.get('message')
-                            yield message
-                            response.close()
-                            #messages.append(message)
-                            #gh_template_respond(github_client,"failure","Binder build has failed &#129344;",payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], messages)
-                            # Remove the lock as binder build failed.
-                            #app.logger.info(f"[FAILED] BinderHub build {binderhub_request}.")
-                            if os.path.exists(lock_filename):
-                                os.remove(lock_filename)
-                            return
-                        message = event.get('message')
-                        if message:
-                            yield message
-                            #messages.append(message)
-                            #elapsed_time = time.time() - start_time
-                            # Update issue every two minutes
-                            #if elapsed_time >= 120:
-                            #    n_updates = n_updates + 1
-                            #    gh_template_respond(github_client,"started",payload['task_title'] + f" {n_updates*2} minutes passed",payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'], messages)
-                            #    start_time = time.time()
-                    except GeneratorExit:
-                        pass
-                    except:
-                        pass
-        # Use the generator object as the source of flask eventstream response
-        binder_response = Response(generate(), mimetype='text/event-stream')
-        # Fetch all the yielded messages
-    binder_logs = binder_response.get_data(as_text=True)
-    binder_logs = "".join(binder_logs)
+    # Renews the lock while streaming, releases it whatever happens.
+    binder_logs, _ = stream_binderhub_build(binderhub_request, build_lock)
     # After the upstream closes, check the server if there's
     # a book built successfully.
     book_status = book_get_by_params(commit_hash=payload['commit_hash'])
     exec_error = book_execution_errored(owner,repo,provider,payload['commit_hash'])
-    # For now, remove the block either way.
-    # The main purpose is to avoid triggering
-    # a build for the same request. Later on
-    # you may choose to add dead time after a successful build.
-    if os.path.exists(lock_filename):
-        os.remove(lock_filename)
-        # Append book-related response downstream
+    # Append book-related response downstream
     if not book_status or exec_error:
         # These flags will determine how the response will be
         # interpreted and returned outside the generator
@@ -1567,8 +1909,7 @@ def write_html_log(commit_sha, logs):
 @celery_app.task(bind=True)
 def preprint_build_pdf_draft(self, payload):
 
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = get_github_client()
     task_id = self.request.id
     gh_template_respond(github_client,"started",payload['task_title'], payload['review_repository'],payload['issue_id'],task_id,payload['comment_id'])
     target_path = os.path.join(f'{DATA_ROOT_PATH}/{DOI_PREFIX}/draft',f"{payload['issue_id']:05d}")
@@ -1622,61 +1963,80 @@ def preprint_build_pdf_draft(self, payload):
 @handle_soft_timeout
 def myst_upload_task(self, screening_dict):
     task = BaseNeuroLibreTask(self, screening_dict)
+
+    task.start("🔄 Checking if there's a myst build on the preview server.")
+    try:
+        with task.phase("archive") as phase:
+            zpath, latest_commit = prepare_myst_book_archive(task.screening.issue_id, task.repo_name, on_progress=task.start)
+            phase.nbytes = os.path.getsize(zpath)
+    except ValueError as e:
+        task.fail(f"⛔️ {e}")
+        return
+
+    # Upload to zenodo
+    with task.phase("upload") as phase:
+        response = zenodo_upload_item(zpath,task.screening.bucket_url,task.screening.issue_id,latest_commit,"book")
+        phase.nbytes = os.path.getsize(zpath)
+        if not (isinstance(response, requests.Response) and response.status_code < 300):
+            phase.outcome = OUTCOME_FAILURE
+    if (isinstance(response, requests.Response)):
+        if (response.status_code > 300):
+            task.fail(f"⛔️ Failed to upload book to Zenodo: {response.text}")
+        elif (response.status_code < 300):
+            zenodo_record_upload(task.screening.issue_id, "book", latest_commit, response.json())
+            task.succeed(f"🌺 Book upload for {task.owner_name}/{task.repo_name} at {latest_commit[0:6]} has succeeded.")
+    elif (isinstance(response, str)):
+        task.fail(f"⛔️ Failed to upload book to Zenodo: {response}")
+    elif response is None:
+        task.fail(f"⛔️ Failed to upload book to Zenodo: {response}")
+
+def prepare_myst_book_archive(issue_id, repo_name, on_progress=None):
+    """
+    Syncs the latest MyST build of the fork from the preview server
+    and archives it for Zenodo.
+
+    Returns (archive_path, commit_hash), raises ValueError on failure.
+    """
     # Check if there is a latest.txt file in the myst build folder of the forked repo on the preview server.
-    response = requests.get(f"{PREVIEW_SERVER}/{MYST_FOLDER}/{GH_ORGANIZATION}/{task.repo_name}/latest.txt")
-    latest_commit = None
+    http_session = get_http_session()
+    response = http_session.get(f"{PREVIEW_SERVER}/{MYST_FOLDER}/{GH_ORGANIZATION}/{repo_name}/latest.txt")
     record_name = item_to_record_name("book")
 
-    task.start("🔄 Checking if there's a myst build on the preview server.")
+    if response.status_code != 200:
+        raise ValueError(f"Failed to upload MyST build assets to zenodo as none found for {GH_ORGANIZATION}/{repo_name} {response.text}")
+
+    # If there is, double check that there's a myst website.
+    # Here response.text is the commit hash.
+    latest_commit = response.text
+    response = http_session.get(f"{PREVIEW_SERVER}/{MYST_FOLDER}/{GH_ORGANIZATION}/{repo_name}/{latest_commit}/_build/html/index.html")
+    if response.status_code != 200:
+        raise ValueError(f"MyST build of {GH_ORGANIZATION}/{repo_name} at {latest_commit[0:6]} has no webpage on the preview server.")
+
+    if on_progress is not None:
+        on_progress("🔄 Syncing MyST build to production server.")
+    remote_path = os.path.join("neurolibre-preview:", DATA_ROOT_PATH[1:], MYST_FOLDER,GH_ORGANIZATION, repo_name,latest_commit,"_build" + "*")
+    # Sync all the myst build files to the production server.
+    process = subprocess.Popen(["/usr/bin/rsync", "-avzR", remote_path, "/"], stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    ret = process.wait()
+    if ret != 0:
+        raise ValueError(f"Failed to sync production html/site/execute/template assets to production server: {output}")
 
-    if response.status_code == 200:
-        # If there is, double check that there's a myst website.
-        # Here response.text is the commit hash.
-        latest_commit = response.text
-        response = requests.get(f"{PREVIEW_SERVER}/{MYST_FOLDER}/{GH_ORGANIZATION}/{task.repo_name}/{latest_commit}/_build/html/index.html")
-        
-        if response.status_code == 200:
-            task.start("🔄 Syncing MyST build to production server.")
-            remote_path = os.path.join("neurolibre-preview:", DATA_ROOT_PATH[1:], MYST_FOLDER,GH_ORGANIZATION, task.repo_name,latest_commit,"_build" + "*")
-            # Sync all the myst build files to the production server.
-            process = subprocess.Popen(["/usr/bin/rsync", "-avzR", remote_path, "/"], stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
-            output = process.communicate()[0]
-            ret = process.wait()
-            if ret == 0:
-                local_path = os.path.join(DATA_ROOT_PATH,MYST_FOLDER,GH_ORGANIZATION,task.repo_name,latest_commit,"_build")
-                template = load_txt_file(os.path.join(os.path.dirname(__file__),'templates/serve_preprint.py.template'))
-                py_content = template.format(
-                    journal_name=JOURNAL_NAME,
-                    doi_prefix=DOI_PREFIX,
-                    doi_suffix=DOI_SUFFIX,
-                    issue_id=int(task.screening.issue_id),
-                    commit_fork=latest_commit[:6])
-
-                with open(os.path.join(local_path, 'serve_preprint.py'), 'w') as f:
-                    f.write(py_content)
-
-                zenodo_file = os.path.join(get_archive_dir(task.screening.issue_id),f"{record_name}_{DOI_PREFIX}_{JOURNAL_NAME}_{task.screening.issue_id:05d}_{latest_commit[0:6]}")
-                shutil.make_archive(zenodo_file, 'zip', local_path)
-                zpath = zenodo_file + ".zip"
-                # Upload to zenodo
-                response = zenodo_upload_item(zpath,task.screening.bucket_url,task.screening.issue_id,latest_commit,"book")
-                if (isinstance(response, requests.Response)):
-                    if (response.status_code > 300):
-                        task.fail(f"⛔️ Failed to upload book to Zenodo: {response.text}")
-                    elif (response.status_code < 300):
-                        tmp = f"zenodo_uploaded_book_{JOURNAL_NAME}_{task.screening.issue_id:05d}_{latest_commit[0:6]}.json"
-                        log_file = os.path.join(get_deposit_dir(task.screening.issue_id), tmp)
-                        with open(log_file, 'w') as outfile:
-                            json.dump(response.json(), outfile)
-                        task.succeed(f"🌺 Book upload for {task.owner_name}/{task.repo_name} at {latest_commit[0:6]} has succeeded.")
-                elif (isinstance(response, str)):
-                    task.fail(f"⛔️ Failed to upload book to Zenodo: {response}")
-                elif response is None:
-                    task.fail(f"⛔️ Failed to upload book to Zenodo: {response}")
-            else:
-                task.fail(f"⛔️ Failed to sync production html/site/execute/template assets to production server: {output}")
-    else:
-        task.fail(f"⛔️ Failed to upload MyST build assets to zenodo as none found for {GH_ORGANIZATION}/{task.repo_name} {response.text}")
+    local_path = os.path.join(DATA_ROOT_PATH,MYST_FOLDER,GH_ORGANIZATION,repo_name,latest_commit,"_build")
+    template = load_txt_file(os.path.join(os.path.dirname(__file__),'templates/serve_preprint.py.template'))
+    py_content = template.format(
+        journal_name=JOURNAL_NAME,
+        doi_prefix=DOI_PREFIX,
+        doi_suffix=DOI_SUFFIX,
+        issue_id=int(issue_id),
+        commit_fork=latest_commit[:6])
+
+    with open(os.path.join(local_path, 'serve_preprint.py'), 'w') as f:
+        f.write(py_content)
+
+    zenodo_file = os.path.join(get_archive_dir(issue_id),f"{record_name}_{DOI_PREFIX}_{JOURNAL_NAME}_{issue_id:05d}_{latest_commit[0:6]}")
+    shutil.make_archive(zenodo_file, 'zip', local_path)
+    return zenodo_file + ".zip", latest_commit
 
 @celery_app.task(bind=True, soft_time_limit=5000, time_limit=6000)
 @handle_soft_timeout
@@ -1693,23 +2053,27 @@ def binder_build_task(self, screening_dict):
         task.owner_name = GH_ORGANIZATION
         task.screening.commit_hash = format_commit_hash(task.screening.target_repo_url, "HEAD")
 
+    build_lock = BinderBuildLock(task.screening.target_repo_url, task.task_id)
     binderhub_request = run_binder_build_preflight_checks(
         task.screening.target_repo_url,
         task.screening.commit_hash,
         cur_config['RATE_LIMIT'],
         cur_config['BINDER_NAME'], 
-        cur_config['BINDER_DOMAIN'])
-
-    lock_filename = get_lock_filename(task.screening.target_repo_url)
+        cur_config['BINDER_DOMAIN'],
+        build_lock,
+        on_wait=lambda position: task.start(f"⏳ Another BinderHub build of this repository is in progress. Position in the queue: {position}"))
 
     task.start("▶️ Started BinderHub build.")
-    binder_logs, build_succeeded = stream_binderhub_build(binderhub_request, lock_filename)
+    with task.phase("binder_build") as phase:
+        binder_logs, build_succeeded = stream_binderhub_build(binderhub_request, build_lock, on_message=task.log)
+        if not build_succeeded:
+            phase.outcome = OUTCOME_FAILURE
 
     # tmp_log_path = f"/tmp/binder_build_{task.task_id}.log"
     # with open(tmp_log_path, "w") as f:
     #     f.write(binder_logs)
 
-    log_path = write_log(task.owner_name, task.repo_name, "binder", binder_logs)
+    log_path = task.write_log("binder", binder_logs)
 
     if build_succeeded:
         task.succeed(f"🌺 BinderHub build succeeded. See logs [here]({cur_server}/api/logs/{log_path})",collapsable=False)
@@ -1732,9 +2096,12 @@ def rsync_myst_prod_task(self, screening_dict):
     # Sync all versioned folders from preview to production
     # The wildcard pattern will match all version-suffixed folders (e.g., .v1, .v2, etc.)
     remote_path = os.path.join("neurolibre-preview:", DATA_ROOT_PATH[1:], DOI_PREFIX, f"{base_doi}.v*")
-    process = subprocess.Popen(["/usr/bin/rsync", "-avzR", remote_path, "/"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    output = process.communicate()[0]
-    ret = process.wait()
+    with task.phase("rsync") as phase:
+        process = subprocess.Popen(["/usr/bin/rsync", "-avzR", remote_path, "/"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        ret = process.wait()
+        if ret != 0:
+            phase.outcome = OUTCOME_FAILURE
 
     if ret != 0:
         task.fail(f"⛔️ Failed to sync MyST build to production server: {output}")
@@ -1789,6 +2156,31 @@ def rsync_myst_prod_task(self, screening_dict):
         f"All versions: {all_versions_str}\n",
         False)
 
+@celery_app.task(bind=True, soft_time_limit=1800, time_limit=2000)
+def image_prepull_task(self, repository, commit_hash, binder_hash):
+    """
+    Pulls the runtime image of a queued MyST build into the local
+    image cache, so that the build does not wait for it.
+    """
+    if binder_hash in ["noexec"]:
+        binder_hash = NOEXEC_CONTAINER_COMMIT_HASH
+        binder_image_name_override = NOEXEC_CONTAINER_REPOSITORY
+    else:
+        binder_image_name_override = None
+    rees_resources = REES(dict(
+        registry_url=BINDER_REGISTRY,
+        gh_user_repo_name = repository,
+        bh_project_name = BINDER_REGISTRY.split('https://')[-1],
+        gh_repo_commit_hash = commit_hash,
+        binder_image_tag = binder_hash or "latest",
+        binder_image_name_override = binder_image_name_override,
+        dotenv = os.path.join(os.environ.get('HOME'),'full-stack-server','api')))
+    with timed_phase("image_prepull_task", "image_pull") as phase:
+        hit = ensure_image(rees_resources)
+        if hit:
+            phase.outcome = "cached"
+    return f"{image_reference(rees_resources)} {'already cached' if hit else 'pulled'}"
+
 @celery_app.task(bind=True, soft_time_limit=5000, time_limit=6000)
 @handle_soft_timeout
 def preview_build_myst_task(self, screening_dict):
@@ -1812,34 +2204,26 @@ def preview_build_myst_task(self, screening_dict):
     all_logs_dict["commit_hash_requested"] = task.screening.commit_hash
     all_logs_dict["prod_version"] = task.screening.prod_version
 
-    # No docker archive signals no user-defined runtime.
-    if task.screening.issue_id is not None:
-        docker_archive_value = gh_read_from_issue_body(task.screening.github_client,REVIEW_REPOSITORY,task.screening.issue_id,"docker-archive")
-        if docker_archive_value == "N/A":
-            noexec = True
-
-    noexec = True if task.screening.binder_hash in ["noexec"] else False
-
     original_owner = task.owner_name
+    repository = f"{original_owner}/{task.repo_name}"
 
-    # Prevent concurrent builds of the same repo. Two parallel builds would
-    # race on the shared latest/ directory and the Book Theme template dir.
-    # Lock timeout matches the Celery time_limit (6000s) as a safety net.
-    lock_key = f"myst-build-lock:{original_owner}/{task.repo_name}"
-    build_lock = _lock_redis.lock(lock_key, timeout=6000)
-    if not build_lock.acquire(blocking=False):
-        msg = f"⏳ A MyST build for {original_owner}/{task.repo_name} is already in progress. Please wait for it to finish before starting another."
-        logging.warning(msg)
-        task.fail(msg)
-        return
-
-    hub = None
-    builder = None
+    alive = get_build_liveness(repository)
+    if alive is not None and alive['task_id'] == task.task_id:
+        logging.warning(f"MyST build {task.task_id} was redelivered while it is still running, ignoring.")
+        raise DuplicateDelivery()
 
+    # Until it starts, the build is queued in the registry (see build_coalescing.py).
+    started = is_prod
     try:
+        # No docker archive signals no user-defined runtime.
+        if task.screening.issue_id is not None:
+            docker_archive_value = gh_read_from_issue_body(task.screening.github_client,REVIEW_REPOSITORY,task.screening.issue_id,"docker-archive")
+            if docker_archive_value == "N/A":
+                noexec = True
+
+        noexec = True if task.screening.binder_hash in ["noexec"] else False
 
         if is_prod:
-            task.start("⚡️ Initiating PRODUCTION MyST build.")
             # Transform the target repo URL to point to the forked version.
             task.screening.target_repo_url = gh_forkify_it(task.screening.target_repo_url)
             task.owner_name = GH_ORGANIZATION
@@ -1852,18 +2236,6 @@ def preview_build_myst_task(self, screening_dict):
             prod_path = os.path.join(DATA_ROOT_PATH,DOI_PREFIX,f"{DOI_SUFFIX}.{task.screening.issue_id:05d}.{task.screening.prod_version}")
             os.makedirs(prod_path, exist_ok=True)
         else:
-            task.start("🔎 Initiating PREVIEW MyST build.")
-            template = load_txt_file(os.path.join(os.path.dirname(__file__),'templates/myst_build_started.html.template'))
-            email_content = template.format(
-                owner_name=task.owner_name,
-                repo_name=task.repo_name,
-                task_id=task.task_id,
-                commit_hash=task.screening.commit_hash,
-                binder_hash=task.screening.binder_hash
-            )
-            time.sleep(2) # Avoid rate limiting.
-            logging.info(f"Sending email notification re task start.")
-            task.email_user(email_content)
             task.screening.commit_hash = format_commit_hash(task.screening.target_repo_url, "HEAD") if task.screening.commit_hash in [None, "latest"] else task.screening.commit_hash
             base_url = os.path.join("/",MYST_FOLDER,task.owner_name,task.repo_name,task.screening.commit_hash,"_build","html")
 
@@ -1893,23 +2265,160 @@ def preview_build_myst_task(self, screening_dict):
             all_logs += f"\n ⚠️⚠️⚠️ Warning: MyST build cache preservation disabled. ⚠️⚠️⚠️"
             rees_resources.preserve_cache = False
 
+        # Same commit, same runtime image and same flags give the same webpage.
+        # Looked up before waiting for the repository lock, the index does not need it.
+        built_repository = f"{task.owner_name}/{task.repo_name}"
+        source_dir = task.join_myst_path(task.owner_name, task.repo_name, task.screening.commit_hash)
+        expected_webpage_path = os.path.join(source_dir, "_build", "html", "index.html")
+        build_outputs = [expected_webpage_path, f"{source_dir}.tar.gz"]
+        if is_prod:
+            build_outputs.append(os.path.join(prod_path, "index.html"))
+        image_digest = resolve_image_digest(rees_resources)
+        all_logs_dict["image_digest"] = image_digest
+        index_key = None
+        if image_digest is not None:
+            index_key = build_key(task.screening.commit_hash, image_digest, execute=not noexec, build_cache=preserve_cache, base_url=base_url)
+            previous_build = None if getattr(task.screening, 'force', False) else lookup_build(built_repository, index_key, build_outputs)
+            if previous_build is not None:
+                all_logs_dict["previous_build_task_id"] = previous_build['task_id']
+                task.succeed(f"{'🚀 PRODUCTION 🚀' if is_prod else '🧐 PREVIEW 🧐'} | ♻️ This commit has already been built with the same runtime image, nothing to rebuild. \n\n * 🔗 [Built webpage]({previous_build['url']}) \n * 📜 [Build logs]({PREVIEW_SERVER}/api/logs/{previous_build['log_path']}) \n\n Request the build with `force` to rebuild it anyway.", collapsable=False)
+                if not is_prod:
+                    template = load_txt_file(os.path.join(os.path.dirname(__file__), 'templates/myst_build_completion.html.template'))
+                    task.email_user(template.format(preview_url=previous_build['url'],
+                                                    build_logs_url=f"{PREVIEW_SERVER}/api/logs/{previous_build['log_path']}"))
+                return
+
+        # Prevent concurrent builds of the same repo. Two parallel builds would
+        # race on the shared latest/ directory and the Book Theme template dir.
+        # The lock is a short lease, extended by a watchdog while the build is
+        # alive (see build_watchdog.py), so that it does not outlive a dead or
+        # stalled build. Not thread local, as the watchdog greenlet extends it.
+        # Builds of the same repo wait for each other, unless a newer request
+        # supersedes the waiting one (see build_coalescing.py).
+        lock_key = f"myst-build-lock:{repository}"
+        build_lock = _lock_redis.lock(lock_key, timeout=MYST_BUILD_LOCK_LEASE, thread_local=False)
+        deadline = time.time() + MYST_BUILD_LOCK_WAIT
+        waiting = False
+        with task.phase("lock_wait") as phase:
+            while not build_lock.acquire(blocking=False):
+                if not is_prod and is_build_superseded(repository, task.task_id):
+                    phase.outcome = "superseded"
+                    task.succeed(f"⏭️ This build has been superseded by a newer build request for {repository}. Its results will be posted on this issue.")
+                    return
+                if time.time() > deadline:
+                    msg = f"⏳ A MyST build for {repository} has been in progress for too long. Please try again later."
+                    logging.warning(msg)
+                    task.fail(msg)
+                    return
+                if not waiting:
+                    task.start(f"⏳ Waiting for the ongoing MyST build of {repository} to finish.")
+                    waiting = True
+                cooperative_sleep(10)
+
+        if not is_prod and not start_build(repository, task.task_id):
+            build_lock.release()
+            task.succeed(f"⏭️ This build has been superseded by a newer build request for {repository}. Its results will be posted on this issue.")
+            return
+        started = True
+    finally:
+        if not started:
+            abandon_myst_build(task, repository)
+
+    watchdog = BuildLockWatchdog(build_lock, repository, task.task_id)
+    watchdog.start()
+
+    hub = None
+    builder = None
+    admission = None
+    warm_key = None
+
+    try:
+
+        if is_prod:
+            task.start("⚡️ Initiating PRODUCTION MyST build.")
+        else:
+            task.start("🔎 Initiating PREVIEW MyST build.")
+            template = load_txt_file(os.path.join(os.path.dirname(__file__),'templates/myst_build_started.html.template'))
+            email_content = template.format(
+                owner_name=task.owner_name,
+                repo_name=task.repo_name,
+                task_id=task.task_id,
+                commit_hash=task.screening.commit_hash,
+                binder_hash=task.screening.binder_hash
+            )
+            time.sleep(2) # Avoid rate limiting.
+            logging.info(f"Sending email notification re task start.")
+            task.email_user(email_content)
+
+        cpu_limit = CONTAINER_CPU_LIMIT
+        memory_limit = CONTAINER_MEMORY_LIMIT
+        if BUILD_ADMISSION_ENABLED:
+            # Wait until the host has room for this build.
+            admission = BuildAdmission(task.task_id, f"{original_owner}/{task.repo_name}")
+            with task.phase("admission_wait"):
+                admitted = admission.acquire(
+                    on_wait=lambda position: task.start(f"⏳ Waiting for build resources. Position in the build queue: {position}"))
+                if not admitted:
+                    task.fail(f"⛔️ Build resources did not become available in time, please try again later.")
+                    return
+            cpu_limit = admission.cpu_limit
+            memory_limit = admission.memory_limit
+            all_logs += f"\n ✔️ Build resources reserved: {cpu_limit} CPUs, {memory_limit} memory"
+        all_logs_dict["cpu_limit"] = cpu_limit
+        all_logs_dict["memory_limit"] = memory_limit
+
         hub = JupyterHubLocalSpawner(rees_resources,
                                 host_build_source_parent_dir = task.join_myst_path(),
                                 container_build_source_mount_dir = CONTAINER_MYST_SOURCE_PATH, #default
                                 host_data_parent_dir = DATA_ROOT_PATH, #optional
                                 container_data_mount_dir = CONTAINER_MYST_DATA_PATH,
-                                cpu_limit = CONTAINER_CPU_LIMIT,
-                                memory_limit = CONTAINER_MEMORY_LIMIT)
-
-        task.start("Cloning repository, pulling binder image, spawning JupyterHub...")
-        try:
-            hub_logs = hub.spawn_jupyter_hub()
-            all_logs += ''.join(hub_logs)
-        except Exception as e:
-            all_logs += f"\n ⚠️ Warning: Failed to spawn JupyterHub: {str(e)}"
-            log_path = write_log(task.owner_name, task.repo_name, "myst", all_logs, all_logs_dict)
-            task.fail(f"⛔️ Build failed: {str(e)} See logs [here]({PREVIEW_SERVER}/api/logs/{log_path})")
-            task.email_user(f"⛔️ Build failed: {str(e)} See logs <a href='{PREVIEW_SERVER}/api/logs/{log_path}'>here</a>")
+                                cpu_limit = cpu_limit,
+                                memory_limit = memory_limit)
+
+        # Keyed on the directory mounted in the container: production builds
+        # mount the fork (GH_ORGANIZATION), preview builds the user's repository.
+        warm_key = pool_key(task.join_myst_path(task.owner_name, task.repo_name, 'latest'), f"{rees_resources.found_image_name}:{rees_resources.binder_image_tag}", cpu_limit, memory_limit)
+        warm = WARM_POOL_ENABLED and claim_container(hub, warm_key)
+        all_logs_dict["warm_container"] = warm
+
+        task.start("Cloning repository, pulling binder image, spawning JupyterHub..." if not warm else "Updating the repository, reusing a running JupyterHub...")
+        spawn_error = None
+        with task.phase("spawn_hub") as phase:
+            try:
+                if warm:
+                    # The container already mounts latest/, which is updated in place.
+                    rees_resources.git_clone_repo(task.join_myst_path())
+                    rees_resources.git_checkout_commit()
+                    # As in JupyterHubLocalSpawner._prepare_repository, the dataset
+                    # is declared by the sources of this commit.
+                    if not rees_resources.dataset_name:
+                        rees_resources.get_project_name()
+                    hub._prepare_data_directory()
+                    if dataset_matches(hub):
+                        all_logs += f"\n ♨️ Reusing warm container {hub.container.short_id}"
+                    else:
+                        # The dataset of this commit is not the one mounted in the container.
+                        all_logs += f"\n ♨️ Warm container {hub.container.short_id} mounts another dataset, spawning a new one"
+                        discard_container(hub)
+                        warm = False
+                        all_logs_dict["warm_container"] = False
+                if not warm:
+                    if IMAGE_CACHE_ENABLED:
+                        # Usually pre-pulled when the build was queued.
+                        cached = ensure_image(rees_resources)
+                        all_logs_dict["image_cached"] = cached
+                        all_logs += f"\n 🐳 {image_reference(rees_resources)} {'found in the image cache' if cached else 'pulled'}"
+                    hub_logs = hub.spawn_jupyter_hub()
+                    all_logs += ''.join(hub_logs)
+            except Exception as e:
+                # Failure is reported after the phase, so that the log header has its timing.
+                phase.outcome = OUTCOME_FAILURE
+                spawn_error = str(e)
+                all_logs += f"\n ⚠️ Warning: Failed to spawn JupyterHub: {spawn_error}"
+        if spawn_error is not None:
+            log_path = task.write_log("myst", all_logs, all_logs_dict)
+            task.fail(f"⛔️ Build failed: {spawn_error} See logs [here]({PREVIEW_SERVER}/api/logs/{log_path})")
+            task.email_user(f"⛔️ Build failed: {spawn_error} See logs <a href='{PREVIEW_SERVER}/api/logs/{log_path}'>here</a>")
             return
 
         # CHANGED: Check for 'latest' directory instead of commit hash
@@ -1956,34 +2465,67 @@ def preview_build_myst_task(self, screening_dict):
         logging.info(f" -- Current commit: {task.screening.commit_hash}")
         all_logs += f"\n -- Current commit: {task.screening.commit_hash}"
 
+        # Outputs of notebooks executed with the same image and data are reused.
+        execution_key = None
+        if EXECUTION_CACHE_ENABLED and not noexec and image_digest is not None:
+            dataset_dir = os.path.join(DATA_ROOT_PATH, rees_resources.dataset_name) if rees_resources.dataset_name else None
+            execution_key = execution_cache_key(image_digest, data_manifest_hash(dataset_dir))
+            all_logs_dict["execution_cache_key"] = execution_key
+            if preserve_cache:
+                try:
+                    with task.phase("execution_cache_restore") as phase:
+                        restored, phase.nbytes = restore_executions(expected_source_path, execution_key)
+                    all_logs += f"\n 💾 Restored {restored} cached notebook executions for this runtime image and dataset"
+                except OSError as e:
+                    all_logs += f"\n ⚠️ Warning: Could not restore cached notebook executions: {e}"
+
         builder.setenv('BASE_URL', base_url)
         # builder.setenv('CONTENT_CDN_PORT', "3102")
 
+        if MYST_EXECUTE_PARALLEL == "auto":
+            # Chosen when the build starts, from the load of the host.
+            execute_parallel, parallel_details = get_execute_parallel(cpu_limit, memory_limit)
+            all_logs_dict["execute_parallel_details"] = parallel_details
+        else:
+            execute_parallel = MYST_EXECUTE_PARALLEL
+        all_logs_dict["execute_parallel"] = execute_parallel
+        all_logs += f"\n ⚙️ Executing up to {execute_parallel} notebooks in parallel"
+
         task.start(f"Issuing MyST build command, execution environment: {rees_resources.found_image_name}")
         try:
             # CHANGED: builder.build() now automatically calls save_successful_build() on success
-            myst_logs = builder.build('--execute', '--execute-parallel', str(MYST_EXECUTE_PARALLEL), '--html', user="ubuntu", group="ubuntu", timeout=MYST_BUILD_TIMEOUT)
+            # Notebook execution and HTML build are a single myst command.
+            with task.phase("myst_build"), watchdog.watching(expected_source_path):
+                myst_logs = builder.build('--execute', '--execute-parallel', str(execute_parallel), '--html', user="ubuntu", group="ubuntu", timeout=MYST_BUILD_TIMEOUT)
             all_logs += f"\n {myst_logs}"
+            if watchdog.stalled or watchdog.lost:
+                all_logs += f"\n ⚠️ Warning: The build lock of {repository} was released before the build ended, another build may have run concurrently."
         except Exception as e:
             all_logs += f"\n ⚠️ Warning: Failed to build MyST: {str(e)}"
-            log_path = write_log(task.owner_name, task.repo_name, "myst", all_logs, all_logs_dict)
+            log_path = task.write_log("myst", all_logs, all_logs_dict)
             task.fail(f"⛔️ MyST build failed {str(e)}. See logs [here]({PREVIEW_SERVER}/api/logs/{log_path})")
             task.email_user(f"⛔️ MyST build failed. See logs <a href='{PREVIEW_SERVER}/api/logs/{log_path}'>here</a>")
             return
 
         # CHANGED: After successful build, save_successful_build() has already been called by MystBuilder
         # The commit-specific directory now exists at the commit hash path
-        expected_webpage_path = task.join_myst_path(task.owner_name, task.repo_name, task.screening.commit_hash, "_build", "html", "index.html")
         if os.path.exists(expected_webpage_path):
 
-            source_dir = task.join_myst_path(task.owner_name, task.repo_name, task.screening.commit_hash)
+            if execution_key is not None:
+                try:
+                    recorded, recorded_bytes = record_executions(expected_source_path, execution_key)
+                    all_logs += f"\n 💾 Cached {recorded} new notebook executions ({recorded_bytes} bytes)"
+                except OSError as e:
+                    all_logs += f"\n ⚠️ Warning: Could not cache notebook executions: {e}"
+
             archive_path = f"{source_dir}.tar.gz"
+            archived = False
 
             try:
-                source_dir = task.join_myst_path(task.owner_name, task.repo_name, task.screening.commit_hash)
-                archive_path = f"{source_dir}.tar.gz"
-                with tarfile.open(archive_path, "w:gz") as tar:
-                    tar.add(source_dir, arcname=os.path.basename(source_dir))
+                with task.phase("archive") as phase:
+                    with tarfile.open(archive_path, "w:gz") as tar:
+                        tar.add(source_dir, arcname=os.path.basename(source_dir))
+                    phase.nbytes = os.path.getsize(archive_path)
                 task.start(f"Created archive at {archive_path}")
                 all_logs += f"\n ✔️ Created archive at {archive_path}"
 
@@ -1995,13 +2537,15 @@ def preview_build_myst_task(self, screening_dict):
                     html_source = task.join_myst_path(task.owner_name, task.repo_name, task.screening.commit_hash, "_build", "html")
                     temp_archive = os.path.join(prod_path, "temp.tar.gz")
                     try:
-                        # Create tar archive
-                        with tarfile.open(temp_archive, "w:gz") as tar:
-                            tar.add(html_source, arcname=".")
+                        with task.phase("prod_copy") as phase:
+                            # Create tar archive
+                            with tarfile.open(temp_archive, "w:gz") as tar:
+                                tar.add(html_source, arcname=".")
+                            phase.nbytes = os.path.getsize(temp_archive)
 
-                        # Extract archive
-                        with tarfile.open(temp_archive, "r:gz") as tar:
-                            tar.extractall(prod_path)
+                            # Extract archive
+                            with tarfile.open(temp_archive, "r:gz") as tar:
+                                tar.extractall(prod_path)
 
                         task.start(f"Copied HTML contents to production path at {prod_path}")
                         all_logs += f"\n ✔️ Copied HTML contents to production path at {prod_path}"
@@ -2009,24 +2553,31 @@ def preview_build_myst_task(self, screening_dict):
                         # Clean up temp archive
                         if os.path.exists(temp_archive):
                             os.remove(temp_archive)
+                archived = True
 
             except Exception as e:
                 task.start(f"Warning: Failed to create archive: {str(e)}")
                 all_logs += f"\n ⚠️ Warning: Failed to create archive: {str(e)}"
 
-            log_path = write_log(task.owner_name, task.repo_name, "myst", all_logs, all_logs_dict)
+            log_path = task.write_log("myst", all_logs, all_logs_dict)
+            if is_prod:
+                webpage_url = f"{PREVIEW_SERVER}/{DOI_PREFIX}/{DOI_SUFFIX}.{task.screening.issue_id:05d}.{task.screening.prod_version}"
+            else:
+                webpage_url = f"{PREVIEW_SERVER}/myst/{task.owner_name}/{task.repo_name}/{task.screening.commit_hash}/_build/html/index.html"
+            if archived and index_key is not None:
+                record_build(built_repository, index_key, task_id=task.task_id, url=webpage_url, log_path=log_path)
             if is_prod:
-                task.succeed(f"🚀 PRODUCTION 🚀 | 🌺 MyST build has been completed! \n\n * 🔗 [Built webpage]({PREVIEW_SERVER}/{DOI_PREFIX}/{DOI_SUFFIX}.{task.screening.issue_id:05d}.{task.screening.prod_version}) \n\n > [!IMPORTANT] \n > Remember to take a look at the [**build logs**]({PREVIEW_SERVER}/api/logs/{log_path}) to check if all the notebooks have been executed successfully, as well as other warnings and errors from the MyST build.", collapsable=False)
+                task.succeed(f"🚀 PRODUCTION 🚀 | 🌺 MyST build has been completed! \n\n * 🔗 [Built webpage]({webpage_url}) \n\n > [!IMPORTANT] \n > Remember to take a look at the [**build logs**]({PREVIEW_SERVER}/api/logs/{log_path}) to check if all the notebooks have been executed successfully, as well as other warnings and errors from the MyST build.", collapsable=False)
             else:
-                task.succeed(f"🧐 PREVIEW 🧐 | 🌺 MyST build has been completed! \n\n * 🔗 [Built webpage]({PREVIEW_SERVER}/myst/{task.owner_name}/{task.repo_name}/{task.screening.commit_hash}/_build/html/index.html) \n\n > [!IMPORTANT] \n > Remember to take a look at the [**build logs**]({PREVIEW_SERVER}/api/logs/{log_path}) to check if all the notebooks have been executed successfully, as well as other warnings and errors from the MyST build.", collapsable=False)
+                task.succeed(f"🧐 PREVIEW 🧐 | 🌺 MyST build has been completed! \n\n * 🔗 [Built webpage]({webpage_url}) \n\n > [!IMPORTANT] \n > Remember to take a look at the [**build logs**]({PREVIEW_SERVER}/api/logs/{log_path}) to check if all the notebooks have been executed successfully, as well as other warnings and errors from the MyST build.", collapsable=False)
                 template = load_txt_file(os.path.join(os.path.dirname(__file__), 'templates/myst_build_completion.html.template'))
                 email_content = template.format(
-                    preview_url=f"{PREVIEW_SERVER}/myst/{task.owner_name}/{task.repo_name}/{task.screening.commit_hash}/_build/html/index.html",
+                    preview_url=webpage_url,
                     build_logs_url=f"{PREVIEW_SERVER}/api/logs/{log_path}"
                 )
                 task.email_user(email_content)
         else:
-            log_path = write_log(task.owner_name, task.repo_name, "myst", all_logs, all_logs_dict)
+            log_path = task.write_log("myst", all_logs, all_logs_dict)
             task.fail(f"⛔️ MyST build did not produce the expected webpage \n\n > [!CAUTION] \n > Please take a look at the [**build logs**]({PREVIEW_SERVER}/api/logs/{log_path}) to locate the error.")
             template = load_txt_file(os.path.join(os.path.dirname(__file__), 'templates/build_error.html.template'))
             email_content = template.format(
@@ -2040,11 +2591,22 @@ def preview_build_myst_task(self, screening_dict):
         # JupyterHub container, regardless of success or failure.
         if builder is not None:
             builder.cleanup()
-        cleanup_hub(hub)
+        # Containers of successful builds are kept for the next build of
+        # the repository (see warm_pool.py).
+        if not (warm_key is not None and WARM_POOL_ENABLED and task.outcome and task.outcome[0] == "SUCCESS" and park_container(hub, warm_key)):
+            cleanup_hub(hub)
+        watchdog.stop()
+        if admission is not None:
+            admission.release()
+        if not is_prod:
+            followers = finish_build(repository, task.task_id)
+            if followers:
+                phase, message, collapsable = task.outcome or ("FAILURE", "⛔️ MyST build ended unexpectedly, please try again.", False)
+                notify_followers(followers, task.task_id, phase, message, collapsable)
         try:
             build_lock.release()
         except redis_lib.exceptions.LockNotOwnedError:
-            # Lock expired (build exceeded timeout) and was auto-released.
+            # Lease expired (build stalled or watchdog stopped) and was auto-released.
             logging.warning(f"Build lock {lock_key} already expired.")
         except Exception:
             pass
@@ -2234,6 +2796,16 @@ def preview_download_data(self, screening_dict):
 # Consider moving elsewhere conviniently.
 # -------------------------------------------------------------------------------------------------
 
+def abandon_myst_build(task, repository):
+    """
+    Removes a MyST build that ends before it starts from the build
+    registry, and sends its outcome to the requests attached to it.
+    """
+    followers = abandon_build(repository, task.task_id)
+    if followers:
+        phase, message, collapsable = task.outcome or ("FAILURE", "⛔️ MyST build ended unexpectedly, please try again.", False)
+        notify_followers(followers, task.task_id, phase, message, collapsable)
+
 def cleanup_hub(hub):
     """Helper function to clean up JupyterHub resources"""
     if hub:
@@ -2243,21 +2815,29 @@ def cleanup_hub(hub):
         hub.delete_stopped_containers() 
         logging.info("Cleanup successful...")
 
-def stream_binderhub_build(binderhub_request, lock_filename):
+def stream_binderhub_build(binderhub_request, build_lock, on_message=None):
     """
     Streams the BinderHub build process and collects logs.
+    The build lock is renewed while streaming and released at the end.
     
     Args:
         binderhub_request (str): The BinderHub API request URL
-        lock_filename (str): Path to the lock file
+        build_lock (BinderBuildLock): Acquired lock of the repository
+        on_message (callable): Called with each build message as it arrives
         
     Returns:
         tuple: (logs: str, success: bool)
             - logs: Concatenated build logs
             - success: False if build failed or errored, True otherwise
     """
-    response = requests.get(binderhub_request, stream=True)
+    build_lock.keep_alive()
+    try:
+        response = get_http_session().get(binderhub_request, stream=True, timeout=HTTP_LONG_TIMEOUT)
+    except requests.exceptions.RequestException:
+        build_lock.release()
+        raise
     if not response.ok:
+        build_lock.release()
         return "", False
     
     build_failed = False
@@ -2276,16 +2856,18 @@ def stream_binderhub_build(binderhub_request, lock_filename):
                         build_failed = True
                         message = event.get('message')
                         collected_messages.append(message)
+                        if on_message is not None:
+                            on_message(message)
                         yield message
                         response.close()
-                        if os.path.exists(lock_filename):
-                            os.remove(lock_filename)
                         return
                         
                     # Stream build messages
                     message = event.get('message')
                     if message:
                         collected_messages.append(message)
+                        if on_message is not None:
+                            on_message(message)
                         yield message
                 except GeneratorExit:
                     pass
@@ -2294,50 +2876,14 @@ def stream_binderhub_build(binderhub_request, lock_filename):
 
     # Collect all build logs
     binder_response = Response(generate(), mimetype='text/event-stream')
-    binder_response.get_data(as_text=True)  # Ensure generator runs to completion
+    try:
+        binder_response.get_data(as_text=True)  # Ensure generator runs to completion
+    finally:
+        build_lock.release()
     
     logs = "\n".join(collected_messages)
     return logs, not build_failed
 
-def get_repository_license(github_client, repo_url):
-    """
-    Get the license of a GitHub repository.
-    
-    Args:
-        github_client: Authenticated GitHub client
-        repo_url: URL of the repository
-        
-    Returns:
-        dict: Status and license info with keys:
-            - status (bool): Whether license was found
-            - message (str): Description of result
-            - license (str): License key/name if found
-    """
-    try:
-        owner, repo, _ = get_owner_repo_provider(repo_url)
-        repository = github_client.get_repo(f"{owner}/{repo}")
-        license_info = repository.get_license()
-        
-        if license_info:
-            return {
-                "status": True,
-                "message": "License found",
-                "license": license_info.license.spdx_id
-            }
-        else:
-            return {
-                "status": False, 
-                "message": "No license found in repository",
-                "license": None
-            }
-            
-    except Exception as e:
-        return {
-            "status": False,
-            "message": f"Error getting repository license: {str(e)}",
-            "license": None
-        }
-
 def local_to_nfs(source_path, dest_path):
     """
     Transfer data from source to destination using compression for efficiency.
@@ -1,4 +1,4 @@
-from flask import Blueprint, jsonify, request, current_app, make_response, render_template
+from flask import Blueprint, jsonify, request, current_app, make_response, render_template, Response, stream_with_context
 from common import *
 from flask_apispec import marshal_with, doc, use_kwargs
 from urllib.parse import urlparse
@@ -6,7 +6,12 @@ from schema import UnlockSchema, StatusSchema, BookSchema, TaskSchema
 from flask_htpasswd import HtPasswdAuth
 from neurolibre_celery_tasks import celery_app, sleep_task
 from werkzeug.exceptions import HTTPException
+from task_events import task_event_stream
+from binder_locks import get_lock_status, force_release
+from task_metrics import generate_metrics
+from image_cache import ImageCacheCollector
 import traceback
+import functools
 
 common_api = Blueprint('common_api', __name__,
                         template_folder='./')
@@ -32,6 +37,8 @@ def setup_htpasswd_auth():
 # Decorate to require HTTP Basic Authentication for
 # common-api endpoints
 def require_http_auth(view_func):
+    # functools.wraps keeps distinct endpoint names for the decorated views.
+    @functools.wraps(view_func)
     def wrapper(*args, **kwargs):
         return common_api.htpasswd_auth.required(view_func)(*args, **kwargs)
     return wrapper
@@ -99,19 +106,43 @@ def api_get_book(user_name=None,commit_hash=None,repo_name=None):
 @marshal_with(None,code=422,description="Cannot validate the payload, missing or invalid entries.")
 @marshal_with(None,code=200,description="Build lock has been removed.")
 @marshal_with(None,code=404,description="Lock does not exist.")
-@doc(description='Remove the build lock that prevents recurrent or simultaneous build requests (rate limit 30 mins).', tags=['Book'])
+@doc(description='Remove the build lock of a repository, the next build waiting for it (if any) starts.', tags=['Book'])
 @use_kwargs(UnlockSchema())
 def api_unlock_build(user, repo_url):
-    lock_filename = get_lock_filename(repo_url)
-    if os.path.isfile(lock_filename):
-        os.remove(lock_filename)
-        response = make_response(f"Removed the lock for {repo_url}",200)
+    holder, _, waiting = get_lock_status(repo_url)
+    if force_release(repo_url):
+        response = make_response(f"Removed the lock of build {holder} for {repo_url} ({waiting} build(s) waiting)",200)
     else:
         response =  make_response(f"No build lock found for {repo_url}",404)
     
     response.mimetype = "text/plain"
     return response
 
+@common_api.route('/api/task/<task_id>/events', methods=['GET'])
+@require_http_auth
+@marshal_with(None,code=200,description="Accept text/event-stream. Events: state, progress, log and end. Keepalive comments while idle.")
+@doc(description='Stream the progress of a task as server-sent events (replaces polling the task status).', tags=['Tasks'])
+def api_task_events(user, task_id):
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID', 0))
+    except ValueError:
+        last_event_id = 0
+    stream = task_event_stream(task_id, last_event_id, get_task_state=lambda tid: celery_app.AsyncResult(tid).state)
+    response = Response(stream_with_context(stream), content_type='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Disables nginx response buffering for this response, in case
+    # proxy_buffering is not turned off for the location.
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@common_api.route('/api/metrics', methods=['GET'])
+@require_http_auth
+@marshal_with(None,code=200,description="Prometheus text exposition format.")
+@doc(description='Durations of tasks and of their phases (e.g., spawning JupyterHub, MyST build, archiving) as Prometheus histograms, and image cache hits, misses and evictions.', tags=['Tasks'])
+def api_metrics(user):
+    body, content_type = generate_metrics(ImageCacheCollector())
+    return Response(body, content_type=content_type)
+
 @common_api.route('/public/data', methods=['GET'])
 @doc(description='List the name of folders under DATA_ROOT_PATH.', tags=['Data'])
 def api_preview_list():
@@ -176,7 +207,7 @@ def chat():
             }
         ]
 
-        response = requests.post(
+        response = get_http_session().post(
             "https://api.groq.com/openai/v1/chat/completions",
             headers={
                 "Authorization": f"Bearer {api_key}",
@@ -2,7 +2,6 @@
 from flask import abort, Response, jsonify, make_response
 import os
 import json
-import requests
 import shutil
 import git
 import logging
@@ -20,8 +19,8 @@ from dotenv import load_dotenv
 from werkzeug.middleware.proxy_fix import ProxyFix
 from neurolibre_celery_tasks import celery_app, rsync_data_task, sleep_task, rsync_book_task, fork_configure_repository_task, \
      zenodo_create_buckets_task, zenodo_upload_book_task, zenodo_upload_repository_task, zenodo_upload_docker_task, zenodo_publish_task, \
-     preprint_build_pdf_draft, zenodo_upload_data_task, zenodo_flush_task, binder_build_task, rsync_myst_prod_task, myst_upload_task
-from github import Github
+     preprint_build_pdf_draft, zenodo_upload_data_task, zenodo_flush_task, binder_build_task, rsync_myst_prod_task, myst_upload_task, \
+     zenodo_production_task
 import yaml
 from screening_client import ScreeningClient
 from neurolibre_api import NeuroLibreAPI
@@ -68,10 +67,6 @@ app.logger.info(f"Server running https://{SERVER_NAME}.{SERVER_DOMAIN}.")
 Configuration END
 """
 
-# Create a build_locks folder to control rate limits
-if not os.path.exists(os.path.join(os.getcwd(),'build_locks')):
-    os.makedirs(os.path.join(os.getcwd(),'build_locks'))
-
 
 """
 API Endpoints START
@@ -83,15 +78,15 @@ API Endpoints START
 @doc(description=f'Copy summary PDF from {PAPERS_REPOSITORY} to {JOURNAL_NAME} server.', tags=['Production'])
 @use_kwargs(IDSchema())
 def summary_pdf_sync_post(user,id):
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = get_github_client()
     issue_id = id
     url_branch = f"https://raw.githubusercontent.com/{PAPERS_REPOSITORY}/{DOI_SUFFIX}.{issue_id:05d}/{DOI_SUFFIX}.{issue_id:05d}/{DOI_PREFIX}.{DOI_SUFFIX}.{issue_id:05d}.pdf"
     url_master = f"https://raw.githubusercontent.com/{PAPERS_REPOSITORY}/master/{DOI_SUFFIX}.{issue_id:05d}/{DOI_PREFIX}.{DOI_SUFFIX}.{issue_id:05d}.pdf"
 
-    if requests.head(url_branch).status_code == 200:
+    http_session = get_http_session()
+    if http_session.head(url_branch).status_code == 200:
         download_url = url_branch
-    elif requests.head(url_master).status_code == 200:
+    elif http_session.head(url_master).status_code == 200:
         # In case where both exist, this should be the one
         download_url = url_master
     else:
@@ -101,7 +96,7 @@ def summary_pdf_sync_post(user,id):
     
     # PDF pool
     file_path = os.path.join(app.config['DATA_ROOT_PATH'],DOI_PREFIX,f"{DOI_SUFFIX}.{issue_id:05d}.pdf")
-    response = requests.get(download_url)
+    response = http_session.get(download_url)
 
     if response.status_code == 200:
         # Delete the old one if exists.
@@ -126,8 +121,7 @@ docs.register(summary_pdf_sync_post)
 @doc(description='Upload the repository to the respective zenodo deposit.', tags=['Zenodo'])
 @use_kwargs(IdUrlSchema())
 def zenodo_upload_repository_post(user,id,repository_url):
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = get_github_client()
     issue_id = id
 
     # Fetch zenodo deposit record
@@ -171,8 +165,7 @@ docs.register(zenodo_upload_repository_post)
 @doc(description='Upload the built book to the respective zenodo deposit.', tags=['Zenodo'])
 @use_kwargs(IdUrlSchema())
 def zenodo_upload_book_post(user,id,repository_url):
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = get_github_client()
     issue_id = id
 
     fname = f"zenodo_deposit_{JOURNAL_NAME}_{issue_id:05d}.json"
@@ -211,8 +204,7 @@ docs.register(zenodo_upload_book_post)
 @doc(description='Upload the submission data for zenodo deposit.', tags=['Zenodo'])
 @use_kwargs(IdUrlSchema())
 def zenodo_upload_data_post(user,id,repository_url):
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = get_github_client()
     issue_id = id
 
     fname = f"zenodo_deposit_{JOURNAL_NAME}_{issue_id:05d}.json"
@@ -253,8 +245,7 @@ docs.register(zenodo_upload_data_post)
 @doc(description='Get zenodo status for a submission.', tags=['Zenodo'])
 @use_kwargs(IDSchema())
 def api_zenodo_status(user,id):
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = get_github_client()
     status_msg = zenodo_get_status(id)
     response = gh_create_comment(github_client,REVIEW_REPOSITORY,id,status_msg)
     if response:
@@ -270,8 +261,7 @@ def api_zenodo_status(user,id):
 @use_kwargs(IdUrlSchema())
 def api_zenodo_publish(user,id,repository_url):
 
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = get_github_client()
     issue_id = id
 
     task_title = "Publish Reproducibility Assets"
@@ -306,25 +296,13 @@ docs.register(api_zenodo_status)
 @use_kwargs(IdUrlSchema())
 def api_zenodo_post(user,id,repository_url):
 
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = get_github_client()
     issue_id = id
 
     # data_archive_exists = gh_read_from_issue_body(github_client,REVIEW_REPOSITORY,issue_id,"data-archive")
-    data_archive_value = gh_read_from_issue_body(github_client,REVIEW_REPOSITORY,issue_id,"data-archive")
-    docker_archive_value = gh_read_from_issue_body(github_client,REVIEW_REPOSITORY,issue_id,"docker-archive")
-
-    archive_assets = ['repository', 'book']
-
-    if docker_archive_value is None:
-        # The value is None only when the value on the issue body is Pending.
-        # If anything else, it will not be considered for archival.
-        archive_assets.append('docker')
-
-    if data_archive_value is None:
-        # The value is None only when the value on the issue body is Pending.
-        # If anything else, it will not be considered for archival.
-        archive_assets.append('data')
+    # Single fetch of the issue body for both tags
+    issue_tags = gh_read_issue_tags(github_client,REVIEW_REPOSITORY,issue_id)
+    archive_assets = zenodo_archive_assets(issue_tags)
 
     # We need the list of authors and their ORCID, this will 
     # be fetched from the paper.md in the tarhet repository
@@ -396,9 +374,10 @@ def api_upload_post(user,issue_id,repository_address,item,item_arg,fork_url,comm
            zpath = zenodo_file + ".zip"
         
            with open(zpath, "rb") as fp:
-            r = requests.put(f"{bucket_url}/LivingPreprint_{DOI_PREFIX}_{JOURNAL_NAME}_{'%05d'%issue_id}_{commit_fork[0:6]}.zip",
+            r = get_http_session().put(f"{bucket_url}/LivingPreprint_{DOI_PREFIX}_{JOURNAL_NAME}_{'%05d'%issue_id}_{commit_fork[0:6]}.zip",
                                     params=params,
-                                    data=fp)
+                                    data=fp,
+                                    timeout=HTTP_LONG_TIMEOUT)
            if not r:
             error = {"reason":f"404: Cannot upload {zpath} to {bucket_url}", "commit_hash":commit_fork, "repo_url":fork_repo,"issue_id":issue_id}
             yield "\n" + json.dumps(error)
@@ -422,9 +401,10 @@ def api_upload_post(user,issue_id,repository_address,item,item_arg,fork_url,comm
                 yield f"\n already exists {expect}"
                 yield f"\n uploading to zenodo"
                 with open(expect, "rb") as fp:
-                        r = requests.put(f"{bucket_url}/DockerImage_{DOI_PREFIX}_{JOURNAL_NAME}_{'%05d'%issue_id}_{commit_fork[0:6]}.zip",
+                        r = get_http_session().put(f"{bucket_url}/DockerImage_{DOI_PREFIX}_{JOURNAL_NAME}_{'%05d'%issue_id}_{commit_fork[0:6]}.zip",
                                         params=params,
-                                        data=fp)
+                                        data=fp,
+                                        timeout=HTTP_LONG_TIMEOUT)
                 # TO_DO: Write a function to handle this, too many repetitions rn.
                 if not r:
                     error = {"reason":f"404: Cannot upload {in_r[1]} to {bucket_url}", "commit_hash":commit_fork, "repo_url":fork_repo,"issue_id":issue_id}
@@ -449,9 +429,10 @@ def api_upload_post(user,issue_id,repository_address,item,item_arg,fork_url,comm
                 if in_r[0] == 0:
                     # Means that saved successfully, upload to zenodo.
                     with open(in_r[1], "rb") as fp:
-                        r = requests.put(f"{bucket_url}/DockerImage_{DOI_PREFIX}_{JOURNAL_NAME}_{'%05d'%issue_id}_{commit_fork[0:6]}.zip",
+                        r = get_http_session().put(f"{bucket_url}/DockerImage_{DOI_PREFIX}_{JOURNAL_NAME}_{'%05d'%issue_id}_{commit_fork[0:6]}.zip",
                                         params=params,
-                                        data=fp)
+                                        data=fp,
+                                        timeout=HTTP_LONG_TIMEOUT)
                     # TO_DO: Write a function to handle this, too many repetitions rn.
                     if not r:
                         error = {"reason":f"404: Cannot upload {in_r[1]} to {bucket_url}", "commit_hash":commit_fork, "repo_url":fork_repo,"issue_id":issue_id}
@@ -480,11 +461,9 @@ def api_upload_post(user,issue_id,repository_address,item,item_arg,fork_url,comm
             
             # REFACTOR HERE AND MANAGE CONDITIONS CLEANER.
             # Try main first
-            resp = os.system(f"wget -O {zenodo_file} {download_url_main}")
-            if resp != 0:
+            if not download_file(download_url_main, zenodo_file):
                 # Try master 
-                resp2 = os.system(f"wget -O {zenodo_file} {download_url_master}")
-                if resp2 != 0:
+                if not download_file(download_url_master, zenodo_file):
                     error = {"reason":f"404: Cannot download repository at {download_url_main} or from master branch.", "commit_hash":commit_fork, "repo_url":fork_repo,"issue_id":issue_id}
                     yield "\n" + json.dumps(error)
                     yield ""
@@ -492,9 +471,10 @@ def api_upload_post(user,issue_id,repository_address,item,item_arg,fork_url,comm
                 else:
                     # Upload to Zenodo
                     with open(zenodo_file, "rb") as fp:
-                        r = requests.put(f"{bucket_url}/GitHubRepo_{DOI_PREFIX}_{JOURNAL_NAME}_{'%05d'%issue_id}_{commit_fork[0:6]}.zip",
+                        r = get_http_session().put(f"{bucket_url}/GitHubRepo_{DOI_PREFIX}_{JOURNAL_NAME}_{'%05d'%issue_id}_{commit_fork[0:6]}.zip",
                                         params=params,
-                                        data=fp)
+                                        data=fp,
+                                        timeout=HTTP_LONG_TIMEOUT)
                         if not r:
                             error = {"reason":f"404: Cannot upload {zenodo_file} to {bucket_url}", "commit_hash":commit_fork, "repo_url":fork_repo,"issue_id":issue_id}
                             yield "\n" + json.dumps(error)
@@ -511,9 +491,10 @@ def api_upload_post(user,issue_id,repository_address,item,item_arg,fork_url,comm
                 # main worked
                 # Upload to Zenodo
                 with open(zenodo_file, "rb") as fp:
-                    r = requests.put(f"{bucket_url}/GitHubRepo_{DOI_PREFIX}_{JOURNAL_NAME}_{'%05d'%issue_id}_{commit_fork[0:6]}.zip",
+                    r = get_http_session().put(f"{bucket_url}/GitHubRepo_{DOI_PREFIX}_{JOURNAL_NAME}_{'%05d'%issue_id}_{commit_fork[0:6]}.zip",
                                     params=params,
-                                    data=fp)
+                                    data=fp,
+                                    timeout=HTTP_LONG_TIMEOUT)
                     if not r:
                             error = {"reason":f"404: Cannot upload {zenodo_file} to {bucket_url}", "commit_hash":commit_fork, "repo_url":fork_repo,"issue_id":issue_id}
                             yield "\n" + json.dumps(error)
@@ -548,9 +529,10 @@ def api_upload_post(user,issue_id,repository_address,item,item_arg,fork_url,comm
            # UPLOAD data to zenodo
            yield f"\n Attempting zenodo upload."
            with open(zpath, "rb") as fp:
-            r = requests.put(f"{bucket_url}/Dataset_{DOI_PREFIX}_{JOURNAL_NAME}_{'%05d'%issue_id}_{commit_fork[0:6]}.zip",
+            r = get_http_session().put(f"{bucket_url}/Dataset_{DOI_PREFIX}_{JOURNAL_NAME}_{'%05d'%issue_id}_{commit_fork[0:6]}.zip",
                                     params=params,
-                                    data=fp)
+                                    data=fp,
+                                    timeout=HTTP_LONG_TIMEOUT)
 
             if not r:
                 error = {"reason":f"404: Cannot upload {zenodo_file} to {bucket_url}", "commit_hash":commit_fork, "repo_url":fork_repo,"issue_id":issue_id}
@@ -618,8 +600,7 @@ docs.register(api_zenodo_flush_post)
 def api_data_sync_post(user,id,repository_url):
     # Create a comment in the review issue. 
     # The worker will update that depending on the  state of the task.
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = get_github_client()
     issue_id = id
     #app.logger.debug(f'{issue_id} {repository_url}')
     project_name = gh_get_project_name(github_client,repository_url)
@@ -669,8 +650,7 @@ def api_books_sync_post(user,id,repository_url,commit_hash="HEAD"):
     server = f"https://{SERVER_NAME}.{SERVER_DOMAIN}"
     # TODO: Implement this into a class not to 
     # repeat this, make sure that async call friendly
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = get_github_client()
     # Task name
     task_title = "REPRODUCIBLE PREPRINT TRANSFER (Preview --> Preprint)"
     # Make comment under the issue
@@ -699,8 +679,7 @@ docs.register(api_books_sync_post)
 def api_production_start_post(user,id,repository_url,commit_hash="HEAD"):
 
     issue_id = id
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = get_github_client()
     task_title = "INITIATE PRODUCTION (Fork and Configure)"
     comment_id = gh_template_respond(github_client,"pending",task_title,REVIEW_REPOSITORY,issue_id)
     # Start BG process
@@ -786,6 +765,20 @@ def api_zenodo_upload_myst(user,id,repository_url):
     return response
 
 
+@app.route('/api/zenodo/production', methods=['POST'],endpoint='zenodo_production')
+@preprint_api.auth_required
+@marshal_with(None,code=422,description="Cannot validate the payload, missing or invalid entries.")
+@doc(description='Create the Zenodo buckets, upload all the reproducibility assets in parallel and publish them. Items uploaded earlier are skipped.', tags=['Zenodo'])
+@use_kwargs(IdUrlSchema())
+def api_zenodo_production(user,id,repository_url):
+    screening = ScreeningClient(task_name="Reproducibility Assets - Production workflow", 
+                                issue_id=id, 
+                                target_repo_url=repository_url)
+    response = screening.start_celery_task(zenodo_production_task)
+    return response
+
+docs.register(api_zenodo_production)
+
 @app.route('/api/pdf/draft', methods=['POST'])
 @preprint_api.auth_required
 @marshal_with(None,code=422,description="Cannot validate the payload, missing or invalid entries.")
@@ -793,8 +786,7 @@ def api_zenodo_upload_myst(user,id,repository_url):
 @use_kwargs(IdUrlSchema())
 def api_pdf_draft(user,id,repository_url):
 
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = get_github_client()
     issue_id = id
 
     task_title = "Extended PDF - Build draft"
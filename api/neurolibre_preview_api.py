@@ -1,9 +1,10 @@
-import os
 from flask import jsonify, make_response, render_template, Response, stream_with_context, request
 from urllib.parse import urlparse
 import time
 import requests
 import json
+import gevent
+import redis as redis_lib
 from common import *
 from schema import BuildSchema, BuildTestSchema, DownloadSchema, MystBuildSchema,IdUrlPreprintVersionSchema
 from flask_htpasswd import HtPasswdAuth
@@ -13,9 +14,12 @@ from flask_apispec import FlaskApiSpec, marshal_with, doc, use_kwargs
 from apispec import APISpec
 from apispec.ext.marshmallow import MarshmallowPlugin
 from github_client import *
-from neurolibre_celery_tasks import celery_app, sleep_task, preview_build_book_task, preview_build_book_test_task, preview_download_data,preview_build_myst_task, sync_fork_from_upstream_task
+from neurolibre_celery_tasks import celery_app, sleep_task, preview_build_book_task, preview_build_book_test_task, preview_download_data,preview_build_myst_task, sync_fork_from_upstream_task, image_prepull_task
 from celery.events.state import State
-from github import Github, UnknownObjectException
+from celery import uuid
+from build_coalescing import register_build, BUILD_ATTACHED, BUILD_SUPERSEDED
+from image_cache import IMAGE_CACHE_ENABLED
+from github import UnknownObjectException
 from screening_client import ScreeningClient
 """
 Configuration START
@@ -43,6 +47,8 @@ SERVER_LOGO = app.config['SERVER_LOGO']
 DATA_ROOT_PATH = app.config['DATA_ROOT_PATH']
 MYST_FOLDER = app.config['MYST_FOLDER']
 REVIEW_REPOSITORY = app.config['REVIEW_REPOSITORY']
+# Seconds a repository validation result (per HEAD commit) is cached.
+VALIDATION_CACHE_TTL = app.config.get('VALIDATION_CACHE_TTL', 86400)
 
 # Set server name and about information
 SERVER_NAME  = SERVER_SLUG
@@ -55,10 +61,6 @@ app.logger.info(f"Using {BINDER_NAME}.{BINDER_DOMAIN} as BinderHub.")
 Configuration END
 """
 
-# Create a directory for build locks (used for rate limiting)
-if not os.path.exists(os.path.join(os.getcwd(),'build_locks')):
-    os.makedirs(os.path.join(os.getcwd(),'build_locks'))
-
 """
 API Endpoints START
 """
@@ -96,8 +98,7 @@ def api_book_build(user, id, repo_url, commit_hash):
     """
     This endpoint is to build books via GitHub (technical screening) requests.
     """
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = get_github_client()
     issue_id = id
 
     task_title = "Book Build (Preview)"
@@ -226,24 +227,55 @@ def api_sync_fork_from_upstream(user, id, repository_url, preprint_version="v2")
     response = screening.start_celery_task(sync_fork_from_upstream_task)
     return response
 
+def start_myst_build(screening):
+    """
+    Queues a preview MyST build, or attaches the request to an identical
+    (same repository, commit and binder hash) running or queued build.
+    A forced request only attaches to a forced build.
+    A request for a newer commit replaces the queued build of the repository.
+    """
+    owner, repo, _ = get_owner_repo_provider(screening.target_repo_url)
+    if screening.commit_hash in [None, "latest", "HEAD"]:
+        screening.commit_hash = format_commit_hash(screening.target_repo_url, "HEAD")
+    task_id = uuid()
+    action, build_task_id = register_build(f"{owner}/{repo}", screening.commit_hash, screening.binder_hash, task_id, screening.to_dict(),
+                                           force=getattr(screening, 'force', False))
+    if action == BUILD_ATTACHED:
+        message = f"An identical MyST build of {owner}/{repo} ({screening.commit_hash[:7]}) is already queued or in progress (Task ID: {build_task_id}). Its results will be sent to you when it finishes."
+        app.logger.info(message)
+        return make_response(jsonify(message), 200)
+    if action == BUILD_SUPERSEDED:
+        # Dropped by the worker if not started yet, otherwise the task
+        # notices it has been superseded while waiting for the repo lock.
+        celery_app.control.revoke(build_task_id)
+        app.logger.info(f"MyST build {build_task_id} of {owner}/{repo} superseded by {task_id}.")
+    if IMAGE_CACHE_ENABLED:
+        # Pulled while the build waits in the queue.
+        image_prepull_task.delay(f"{owner}/{repo}", screening.commit_hash, screening.binder_hash)
+    return screening.start_celery_task(preview_build_myst_task, task_id=task_id)
+
 @app.route('/api/myst/build', methods=['POST'],endpoint='api_myst_build')
 @preview_api.auth_required
 @marshal_with(None,code=422,description="Cannot validate the payload, missing or invalid entries.")
 @use_kwargs(MystBuildSchema())
 @doc(description='Endpoint for building myst formatted articles.', tags=['Myst'])
-def api_myst_build(user, id, repository_url, commit_hash=None, binder_hash=None, build_cache=True, is_prod=False, prod_version="v1"):
+def api_myst_build(user, id, repository_url, commit_hash=None, binder_hash=None, build_cache=True, is_prod=False, prod_version="v1", force=False):
     """
     This endpoint is to download data from GitHub (technical screening) requests.
     """
     app.logger.info(f'Entered MyST build endpoint')
     
-    extra_payload = dict(commit_hash=commit_hash, binder_hash=binder_hash, build_cache=build_cache,is_prod=is_prod, prod_version=prod_version)
+    extra_payload = dict(commit_hash=commit_hash, binder_hash=binder_hash, build_cache=build_cache,is_prod=is_prod, prod_version=prod_version, force=force)
 
     screening = ScreeningClient(task_name="Build MyST article", 
                                 issue_id=id, 
                                 target_repo_url=repository_url,
                                 **extra_payload)
-    response = screening.start_celery_task(preview_build_myst_task)
+    if is_prod:
+        # Production builds always run on the latest commit of the fork.
+        response = screening.start_celery_task(preview_build_myst_task)
+    else:
+        response = start_myst_build(screening)
     return response
 
 @app.route('/api/book/build/test', methods=['POST'],endpoint='api_myst_build_robo')
@@ -267,7 +299,7 @@ def api_myst_build_robo(user, repo_url, commit_hash, email):
                                 email_address=email,
                                 target_repo_url=repo_url,
                                 **extra_payload)
-    response = screening.start_celery_task(preview_build_myst_task)
+    response = start_myst_build(screening)
     return response
 
 
@@ -318,97 +350,142 @@ def process():
     if not repo_url:
         return jsonify({"error": "No repo_url provided"}), 400
 
+    def event(message, status):
+        return f"data: {json.dumps({'message': message, 'status': status})}\n\n"
+
+    def validation_events(contents, binder_job, content_job):
+        """
+        Yields the validation events given the root listing and the
+        (concurrently fetched) binder and content folder listings.
+        """
+        has_binder_folder = False
+        has_data_requirement = False
+        has_content_folder = False
+        has_toc_yml = False
+        has_config_yml = False
+        has_myst_yml = False
+
+        yield event('🗂️ Listing repository contents:', 'info')
+        for item in contents:
+            if item['type'] == 'dir' and item['name'] == 'binder':
+                has_binder_folder = True
+                binder_contents = binder_job.get() or []
+                yield event('📁 Listing binder folder contents:', 'info')
+                for binder_item in binder_contents:
+                    yield event('- 📄 ' + binder_item['name'], 'info')
+                    if binder_item['name'] == 'data_requirement.json':
+                        has_data_requirement = True
+            elif item['type'] == 'dir' and item['name'] == 'content':
+                has_content_folder = True
+                content_contents = content_job.get() or []
+                yield event('📁 Listing content folder contents:', 'info')
+                for content_item in content_contents:
+                    if content_item['name'] == '_toc.yml':
+                        has_toc_yml = True
+                        yield event('- ⚙️ ' + content_item['name'], 'positive')
+                    elif content_item['name'] == '_config.yml':
+                        has_config_yml = True
+                        yield event('- ⚙️ ' + content_item['name'], 'positive')
+                    else:
+                        yield event('- 📄 ' + content_item['name'], 'info')
+            elif item['type'] == 'file' and item['name'] == 'myst.yml':
+                has_myst_yml = True
+                yield event('- ⚙️ ' + item['name'], 'positive')
+            else:
+                yield event('- 📄 ' + item['name'], 'info')
+
+        # Perform validation checks
+        if not has_binder_folder:
+            yield event('Error: binder folder not found at the root.', 'error')
+            yield event('Repository structure is invalid.', 'failure')
+            return
+
+        if not has_data_requirement:
+            yield event('Warning: data_requirement.json not found in binder folder.', 'warning')
+
+        if has_myst_yml:
+            yield event('Repository follows MyST format.', 'positive')
+            yield event('Repository structure is valid.', 'success')
+        elif has_content_folder and has_toc_yml and has_config_yml:
+            yield f"data: {json.dumps({'message': 'Repository follows Jupyter Book format.', 'info': 'positive'})}\n\n"
+            yield event('Repository structure is valid.', 'success')
+        else:
+            missing_items = []
+            if not has_content_folder:
+                missing_items.append("content folder")
+            if not has_toc_yml:
+                missing_items.append("_toc.yml")
+            if not has_config_yml:
+                missing_items.append("_config.yml")
+
+            error_message = f"Error: Repository does not meet Jupyter Book or MyST format requirements. Missing: {', '.join(missing_items)}."
+            yield event(error_message, 'error')
+            yield event('Repository structure is invalid.', 'failure')
+
     def generate():
         try:
-            yield f"data: {json.dumps({'message': f'Fetching repository contents: {repo_url}', 'status': 'info'})}\n\n"
-            
+            yield event(f'Fetching repository contents: {repo_url}', 'info')
+
             parsed_url = urlparse(repo_url)
             path_parts = parsed_url.path.strip('/').split('/')
             if len(path_parts) < 2:
                 raise ValueError("Invalid GitHub URL")
             owner, repo = path_parts[:2]
 
-            api_url = f"https://api.github.com/repos/{owner}/{repo}/contents"
-            
             def fetch_contents(path=''):
-                response = requests.get(f"{api_url}/{path}")
-                response.raise_for_status()
-                return response.json()
-
-            contents = fetch_contents()
-            has_binder_folder = False
-            has_data_requirement = False
-            has_content_folder = False
-            has_toc_yml = False
-            has_config_yml = False
-            has_myst_yml = False
-
-            yield f"data: {json.dumps({'message': '🗂️ Listing repository contents:', 'status': 'info'})}\n\n"
-            for item in contents:
-                if item['type'] == 'dir' and item['name'] == 'binder':
-                    has_binder_folder = True
-                    binder_contents = fetch_contents('binder')
-                    yield f"data: {json.dumps({'message': '📁 Listing binder folder contents:', 'status': 'info'})}\n\n"
-                    for binder_item in binder_contents:
-                        yield f"data: {json.dumps({'message': '- 📄 ' + binder_item['name'], 'status': 'info'})}\n\n"
-                        if binder_item['name'] == 'data_requirement.json':
-                            has_data_requirement = True
-                elif item['type'] == 'dir' and item['name'] == 'content':
-                    has_content_folder = True
-                    content_contents = fetch_contents('content')
-                    yield f"data: {json.dumps({'message': '📁 Listing content folder contents:', 'status': 'info'})}\n\n"
-                    for content_item in content_contents:
-                        if content_item['name'] == '_toc.yml':
-                            has_toc_yml = True
-                            yield f"data: {json.dumps({'message': '- ⚙️ ' + content_item['name'], 'status': 'positive'})}\n\n"
-                        elif content_item['name'] == '_config.yml':
-                            has_config_yml = True
-                            yield f"data: {json.dumps({'message': '- ⚙️ ' + content_item['name'], 'status': 'positive'})}\n\n"
-                        else:
-                            yield f"data: {json.dumps({'message': '- 📄 ' + content_item['name'], 'status': 'info'})}\n\n"
-                elif item['type'] == 'file' and item['name'] == 'myst.yml':
-                    has_myst_yml = True
-                    yield f"data: {json.dumps({'message': '- ⚙️ ' + content_item['name'], 'status': 'positive'})}\n\n"
-                else:
-                    yield f"data: {json.dumps({'message': '- 📄 ' + item['name'], 'status': 'info'})}\n\n"
-
-            # Perform validation checks
-            if not has_binder_folder:
-                yield f"data: {json.dumps({'message': 'Error: binder folder not found at the root.', 'status': 'error'})}\n\n"
-                yield f"data: {json.dumps({'message': 'Repository structure is invalid.', 'status': 'failure'})}\n\n"
+                # Authenticated, conditional request (see gh_cached_get)
+                listing = gh_cached_get(f"/repos/{owner}/{repo}/contents/{path}")
+                return json.loads(listing) if listing is not None else None
+
+            # Start fetching all the listings right away, in parallel
+            # with the HEAD lookup.
+            root_job = gevent.spawn(fetch_contents)
+            binder_job = gevent.spawn(fetch_contents, 'binder')
+            content_job = gevent.spawn(fetch_contents, 'content')
+
+            # Validation result only depends on the repository state at HEAD.
+            head_sha = gh_cached_get(f"/repos/{owner}/{repo}/commits/HEAD", accept="application/vnd.github.sha")
+            if head_sha is None:
+                raise ValueError(f"Repository {owner}/{repo} not found")
+            cache_key = f"repo-validation:{owner}/{repo}:{head_sha.strip()}"
+            cached_events = None
+            try:
+                cached_events = get_redis().lrange(cache_key, 0, -1)
+            except redis_lib.exceptions.RedisError as e:
+                app.logger.warning(f"Validation cache unavailable: {e}")
+            if cached_events:
+                gevent.killall([root_job, binder_job, content_job], block=False)
+                for cached_event in cached_events:
+                    yield cached_event.decode()
                 return
 
-            if not has_data_requirement:
-                yield f"data: {json.dumps({'message': 'Warning: data_requirement.json not found in binder folder.', 'status': 'warning'})}\n\n"
+            contents = root_job.get()
+            if contents is None:
+                raise ValueError(f"Repository {owner}/{repo} not found")
 
-            if has_myst_yml:
-                yield f"data: {json.dumps({'message': 'Repository follows MyST format.', 'status': 'positive'})}\n\n"
-                yield f"data: {json.dumps({'message': 'Repository structure is valid.', 'status': 'success'})}\n\n"
-            elif has_content_folder and has_toc_yml and has_config_yml:
-                yield f"data: {json.dumps({'message': 'Repository follows Jupyter Book format.', 'info': 'positive'})}\n\n"
-                yield f"data: {json.dumps({'message': 'Repository structure is valid.', 'status': 'success'})}\n\n"
-            else:
-                missing_items = []
-                if not has_content_folder:
-                    missing_items.append("content folder")
-                if not has_toc_yml:
-                    missing_items.append("_toc.yml")
-                if not has_config_yml:
-                    missing_items.append("_config.yml")
-                
-                error_message = f"Error: Repository does not meet Jupyter Book or MyST format requirements. Missing: {', '.join(missing_items)}."
-                yield f"data: {json.dumps({'message': error_message, 'status': 'error'})}\n\n"
-                yield f"data: {json.dumps({'message': 'Repository structure is invalid.', 'status': 'failure'})}\n\n"
+            events = []
+            for validation_event in validation_events(contents, binder_job, content_job):
+                events.append(validation_event)
+                yield validation_event
+
+            try:
+                pipe = get_redis().pipeline()
+                pipe.delete(cache_key)
+                pipe.rpush(cache_key, *events)
+                pipe.expire(cache_key, VALIDATION_CACHE_TTL)
+                pipe.execute()
+            except redis_lib.exceptions.RedisError as e:
+                app.logger.warning(f"Could not cache validation of {owner}/{repo}: {e}")
 
         except requests.RequestException as e:
-            yield f"data: {json.dumps({'message': f'Error fetching repository contents: {str(e)}', 'status': 'error'})}\n\n"
-            yield f"data: {json.dumps({'message': 'Process failed.', 'status': 'failure'})}\n\n"
+            yield event(f'Error fetching repository contents: {str(e)}', 'error')
+            yield event('Process failed.', 'failure')
         except ValueError as e:
-            yield f"data: {json.dumps({'message': f'Error: {str(e)}', 'status': 'error'})}\n\n"
-            yield f"data: {json.dumps({'message': 'Process failed.', 'status': 'failure'})}\n\n"
+            yield event(f'Error: {str(e)}', 'error')
+            yield event('Process failed.', 'failure')
         except Exception as e:
-            yield f"data: {json.dumps({'message': f'Unexpected error: {str(e)}', 'status': 'error'})}\n\n"
-            yield f"data: {json.dumps({'message': 'Process failed.', 'status': 'failure'})}\n\n"
+            yield event(f'Unexpected error: {str(e)}', 'error')
+            yield event('Process failed.', 'failure')
 
     return Response(stream_with_context(generate()), content_type='text/event-stream')
 
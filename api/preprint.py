@@ -1,12 +1,14 @@
 import os
 import sys
+import logging
+import gevent
 import requests
 import json
 from common import *
 from dotenv import load_dotenv
 import re
-from github import Github
-from github_client import gh_read_from_issue_body
+from github_client import gh_read_issue_tags, get_github_client
+from ratelimit import ApiRateBudget
 import csv
 import subprocess
 import nbformat
@@ -41,12 +43,27 @@ SERVER_SLUG = preprint_config['SERVER_SLUG']
 
 PREPRINT_SERVER = f"https://{preprint_config['SERVER_SLUG']}.{common_config['SERVER_DOMAIN']}"
 
+# Zenodo API requests of all processes share one budget (see ratelimit.py).
+# Zenodo reports its limits with X-RateLimit-* headers as well.
+zenodo_rate_budget = ApiRateBudget("zenodo",
+                                   per_hour=common_config.get('ZENODO_RATE_LIMIT_PER_HOUR', 5000),
+                                   burst=common_config.get('ZENODO_RATE_BURST', 10))
+
+def zenodo_request(method, url, **kwargs):
+    """
+    Zenodo API request through the shared session and rate budget.
+    """
+    zenodo_rate_budget.acquire()
+    response = get_http_session().request(method, url, **kwargs)
+    zenodo_rate_budget.record(response.status_code, response.headers)
+    return response
+
 """
 Helper functions for the tasks
 performed by the preprint (production server).
 """
 
-def zenodo_create_bucket(title, archive_type, creators, repository_url, issue_id):
+def zenodo_create_bucket(title, archive_type, creators, repository_url, issue_id, commit_user=None, commit_fork=None):
 
     [owner,repo,provider] =  get_owner_repo_provider(repository_url,provider_full_name=True)
 
@@ -64,8 +81,11 @@ def zenodo_create_bucket(title, archive_type, creators, repository_url, issue_id
     # book build. That may not be the case. Requires better
     # data handling or extra functionality to retrieve the latest successful
     # book commit.
-    commit_user = format_commit_hash(repository_url,"HEAD")
-    commit_fork = format_commit_hash(fork_url,"HEAD")
+    # Resolved once by the caller when several buckets are created.
+    if commit_user is None:
+        commit_user = format_commit_hash(repository_url,"HEAD")
+    if commit_fork is None:
+        commit_fork = format_commit_hash(fork_url,"HEAD")
 
     libre_text = f"<a href=\"{fork_url}/commit/{commit_fork}\"> reference repository/commit by roboneuro</a>"
     user_text = f"<a href=\"{repository_url}/commit/{commit_user}\">latest change by the author</a>"
@@ -143,11 +163,12 @@ def zenodo_create_bucket(title, archive_type, creators, repository_url, issue_id
             commit_fork=commit_fork[:6])
 
     # Make an empty deposit to create the bucket
-    r = requests.post("https://zenodo.org/api/deposit/depositions",
+    r = zenodo_request("POST", "https://zenodo.org/api/deposit/depositions",
                 params=params,
                 json=data)
 
-    print(f"Error: {r.status_code} - {r.text}")
+    if not r:
+        logging.error(f"Cannot create {archive_type} bucket: {r.status_code} - {r.text}")
     # response_dict = json.loads(r.text)
 
     # for i in response_dict:
@@ -158,10 +179,109 @@ def zenodo_create_bucket(title, archive_type, creators, repository_url, issue_id
     else:
         return r.json()
 
+def zenodo_archive_assets(issue_tags):
+    """
+    Returns the archive types (Zenodo buckets) of a submission,
+    given the tags of its review issue (see gh_read_issue_tags).
+    """
+    archive_assets = ['repository', 'book']
+    # The values are None only when the value on the issue body is Pending.
+    # If anything else, they will not be considered for archival.
+    if issue_tags.get("docker-archive") is None:
+        archive_assets.append('docker')
+    if issue_tags.get("data-archive") is None:
+        archive_assets.append('data')
+    return archive_assets
+
+def zenodo_normalize_authors(authors, affiliations):
+    """
+    Keeps the first affiliation of each author (by name) and the fields
+    Zenodo accepts for creators (fixing some typos, e.g., orchid).
+    """
+    # We need to go through some affiliation mapping here.
+    affiliation_mapping = {str(affiliation['index']): affiliation['name'] for affiliation in affiliations}
+    for author in authors:
+        if isinstance(author['affiliation'],int):
+            affiliation_index = author['affiliation']
+        else:
+            affiliation_index = author['affiliation'].split(',')[0]
+        author['affiliation'] = affiliation_mapping[str(affiliation_index)]
+
+    valid_field_names = {'name', 'orcid', 'affiliation'}
+    for author in authors:
+        invalid_fields = [field for field in author if field not in valid_field_names]
+        for invalid_field in invalid_fields:
+            valid_field = None
+            for valid_name in valid_field_names:
+                if valid_name.lower() in invalid_field.lower() or (valid_name == 'orcid' and invalid_field.lower() == 'orchid'):
+                    valid_field = valid_name
+                    break
+            if valid_field:
+                author[valid_field] = author.pop(invalid_field)
+
+        author.pop('equal-contrib', None)
+        author.pop('corresponding', None)
+    return authors
+
+def zenodo_create_buckets(paper_data, archive_assets, repository_url, issue_id, on_progress=None):
+    """
+    Creates a Zenodo deposit (bucket) per archive asset concurrently and
+    writes the deposit record of the submission. If any of them fails,
+    the ones created are deleted (concurrently) and no record is written.
+
+    on_progress
+        Called with the archive types before the buckets are created.
+
+    Returns (success, collect), collect maps archive types to the
+    Zenodo responses (or failure reasons).
+    """
+    authors = zenodo_normalize_authors(paper_data['authors'], paper_data['affiliations'])
+
+    # Same commits for all the buckets.
+    owner, repo, provider = get_owner_repo_provider(repository_url, provider_full_name=True)
+    commit_user = format_commit_hash(repository_url, "HEAD")
+    commit_fork = format_commit_hash(f"https://{provider}/roboneurolibre/{repo}", "HEAD")
+
+    def create(archive_type):
+        try:
+            return zenodo_create_bucket(paper_data['title'], archive_type, authors, repository_url,
+                                        issue_id, commit_user, commit_fork)
+        except Exception as e:
+            return {"reason": f"Cannot create {archive_type} bucket: {e}", "commit_hash": commit_fork}
+
+    if on_progress is not None:
+        on_progress(", ".join(archive_assets))
+    # Requests are paced by zenodo_rate_budget.
+    jobs = {archive_type: gevent.spawn(create, archive_type) for archive_type in archive_assets}
+    gevent.joinall(list(jobs.values()))
+    collect = {archive_type: job.value for archive_type, job in jobs.items()}
+
+    if {k: v for k, v in collect.items() if 'reason' in v}:
+        # This means at least one of the deposits has failed.
+        logging.info(f"Caught an issue with the deposit. A record (JSON) will not be created.")
+
+        # Delete deposition if succeeded for a certain resource
+        remove_dict = {k: v for k, v in collect.items() if not 'reason' in v }
+        for key in remove_dict:
+            logging.info("Deleting " + remove_dict[key]["links"]["self"])
+        jobs = {key: gevent.spawn(zenodo_delete_bucket, remove_dict[key]["links"]["self"]) for key in remove_dict}
+        gevent.joinall(list(jobs.values()))
+        for key, job in jobs.items():
+            # Returns 204 if successful, cast str to display
+            collect[key + "_deleted"] = str(job.value if job.successful() else job.exception)
+        return False, collect
+
+    # This means that all requested deposits are successful
+    local_file = os.path.join(get_deposit_dir(issue_id), f"zenodo_deposit_{JOURNAL_NAME}_{issue_id:05d}.json")
+    logging.info(f'Writing {local_file}...')
+    with open(local_file, 'w') as outfile:
+        json.dump(collect, outfile)
+    return True, collect
+
 def zenodo_delete_bucket(remove_link):
     ZENODO_TOKEN = os.getenv('ZENODO_API')
     headers = {"Content-Type": "application/json", "Authorization": "Bearer {}".format(ZENODO_TOKEN)}
-    response = requests.delete(remove_link, headers=headers)
+    response = zenodo_request("DELETE", remove_link, headers=headers)
     return response
 
 def execute_subprocess(command):
@@ -306,11 +426,12 @@ def zenodo_get_status(issue_id):
     file_list = [f for f in os.listdir(zenodo_dir) if os.path.isfile(os.path.join(zenodo_dir,f))]
     res = ','.join(file_list)
 
-    GH_BOT=os.getenv('GH_BOT')
-    github_client = Github(GH_BOT)
+    github_client = get_github_client()
 
-    data_archive_value = gh_read_from_issue_body(github_client,REVIEW_REPOSITORY,issue_id,"data-archive")
-    docker_archive_value = gh_read_from_issue_body(github_client,REVIEW_REPOSITORY,issue_id,"docker-archive")
+    # Single fetch of the issue body for both tags
+    issue_tags = gh_read_issue_tags(github_client,REVIEW_REPOSITORY,issue_id)
+    data_archive_value = issue_tags.get("data-archive")
+    docker_archive_value = issue_tags.get("docker-archive")
 
     regex_repository_upload = re.compile(r"(zenodo_uploaded_repository)(.*?)(?=.json)")
     regex_data_upload = re.compile(r"(zenodo_uploaded_data)(.*?)(?=.json)")
@@ -393,9 +514,10 @@ def zenodo_upload_item(upload_file,bucket_url,issue_id,commit_fork,item_name):
     if record_name:
         try:
             with open(upload_file, "rb") as fp:
-                r = requests.put(f"{bucket_url}/{record_name}_{DOI_PREFIX}_{JOURNAL_NAME}_{issue_id:05d}_{commit_fork[0:6]}.{extension}",
+                r = get_http_session().put(f"{bucket_url}/{record_name}_{DOI_PREFIX}_{JOURNAL_NAME}_{issue_id:05d}_{commit_fork[0:6]}.{extension}",
                                         params=params,
-                                        data=fp)
+                                        data=fp,
+                                        timeout=HTTP_LONG_TIMEOUT)
         except requests.exceptions.RequestException as e:
             r = str(e)
     else:
@@ -405,6 +527,20 @@ def zenodo_upload_item(upload_file,bucket_url,issue_id,commit_fork,item_name):
     return r
 
 
+def zenodo_record_upload(issue_id, item, commit_fork, record):
+    """
+    Writes the Zenodo response of a successful upload, which marks the
+    item as uploaded (see zenodo_confirm_status).
+    """
+    tmp = f"zenodo_uploaded_{item}_{JOURNAL_NAME}_{issue_id:05d}_{commit_fork[0:6]}.json"
+    log_file = os.path.join(get_deposit_dir(issue_id), tmp)
+    with open(log_file, 'w') as outfile:
+        json.dump(record, outfile)
+    return log_file
+
+def zenodo_is_uploaded(issue_id, item):
+    return bool(glob.glob(os.path.join(get_deposit_dir(issue_id),f"zenodo_uploaded_{item}_{JOURNAL_NAME}_{issue_id:05d}_*.json")))
+
 def find_resource_idx(lst, repository_url):
     """
     Helper function for get_resource_lookup.
@@ -444,7 +580,7 @@ def get_test_book_build(preview_server,verify_ssl,commit_hash):
     auth = (API_USER, API_PASS)
     params = {"commit_hash": commit_hash}
     # Send GET request
-    response = requests.get(url, headers=headers, auth=auth, params=params, verify=verify_ssl)
+    response = get_http_session().get(url, headers=headers, auth=auth, params=params, verify=verify_ssl)
     if response.status_code == 200:
         return {'status': True, 'book_url': json.loads(response.text)[0]['book_url']}
     else:
@@ -471,7 +607,7 @@ def get_resource_lookup(preview_server,verify_ssl,repository_address):
     auth = (API_USER, API_PASS)
 
     # Send GET request
-    response = requests.get(url, headers=headers, auth=auth, verify=verify_ssl)
+    response = get_http_session().get(url, headers=headers, auth=auth, verify=verify_ssl)
 
     # Process response
     if response.ok:
@@ -511,18 +647,24 @@ def zenodo_publish(issue_id):
 
     if upload_status[0]:
         zenodo_record = get_zenodo_deposit(issue_id)
-        # We need self links from each record to publish.
-        for item in zenodo_record.keys():
-            publish_link = zenodo_record[item]['links']['publish']
+        # We need self links from each record to publish. Records are
+        # published concurrently, paced by zenodo_rate_budget.
+        jobs = {item: gevent.spawn(zenodo_request, "POST", zenodo_record[item]['links']['publish'], params=params)
+                for item in zenodo_record.keys()}
+        gevent.joinall(list(jobs.values()))
+        for item, job in jobs.items():
             message.append(f"\n :ice_cube: {item_to_record_name(item)} publish status:")
-            r = requests.post(publish_link,params=params)
+            if not job.successful():
+                message.append(f"\n <details><summary> :wilted_flower: Could not publish {item_to_record_name(item)} </summary><pre><code>{job.exception}</code></pre></details>")
+                continue
+            r = job.value
             response = r.json()
             if r.status_code==202:
                 message.append(f"\n :confetti_ball: <a href=\"{response['doi_url']}\"><img src=\"{response['links']['badge']}\"></a>")
                 tmp = f"zenodo_published_{item}_{JOURNAL_NAME}_{issue_id:05d}.json"
                 log_file = os.path.join(get_deposit_dir(issue_id), tmp)
                 with open(log_file, 'w') as outfile:
-                    json.dump(r.json(), outfile)
+                    json.dump(response, outfile)
             else:
                 message.append(f"\n <details><summary> :wilted_flower: Could not publish {item_to_record_name(item)} </summary><pre><code>{r.json()}</code></pre></details>")
     else:
@@ -0,0 +1,219 @@
+import time
+import logging
+import contextvars
+from contextlib import contextmanager
+import redis as redis_lib
+from gevent import sleep as cooperative_sleep
+from common import get_redis
+
+"""
+Cluster-wide rate limiting for external APIs (GitHub, Zenodo),
+and concurrency limits shared by the worker nodes.
+
+Web (gunicorn) and worker (celery) processes share the same API
+credentials, so request budgets are kept in Redis. Waiting is done
+with gevent.sleep, which yields to other greenlets instead of
+blocking the worker.
+"""
+
+# Request priorities. High priority requests (e.g., user visible
+# status comments) may use the reserved part of the budget.
+PRIORITY_HIGH = "high"
+PRIORITY_NORMAL = "normal"
+
+_request_priority = contextvars.ContextVar("request_priority", default=PRIORITY_NORMAL)
+
+@contextmanager
+def request_priority(priority):
+    """
+    Sets the priority of the API requests made within the block.
+    Context variables are greenlet-local under gevent.
+    """
+    token = _request_priority.set(priority)
+    try:
+        yield
+    finally:
+        _request_priority.reset(token)
+
+def get_request_priority():
+    return _request_priority.get()
+
+# Refill tokens based on elapsed time, take one if it does not dip
+# into the reserve, otherwise return the number of seconds to wait.
+# Numbers are returned as strings, Lua numbers are truncated to integers.
+_TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local reserve = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+local ts = tonumber(redis.call('HGET', KEYS[1], 'ts'))
+if tokens == nil or ts == nil then
+    tokens = capacity
+    ts = now
+end
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens - 1 >= reserve then
+    tokens = tokens - 1
+else
+    wait = (reserve + 1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+class RedisTokenBucket:
+    """
+    Token bucket shared by all processes through Redis.
+
+    name
+        Used in the Redis key.
+    rate
+        Tokens added per second.
+    capacity
+        Maximum number of tokens (burst size).
+    """
+    def __init__(self, name, rate, capacity, redis_client=None):
+        self.key = f"ratelimit:bucket:{name}"
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.redis = redis_client or get_redis()
+        self._script = self.redis.register_script(_TOKEN_BUCKET_SCRIPT)
+
+    def try_acquire(self, reserve=0):
+        """
+        Takes a token if available. Returns 0 on success, otherwise the
+        number of seconds after which a token should be available.
+        """
+        return float(self._script(keys=[self.key],
+                                  args=[self.capacity, self.rate, reserve, time.time()]))
+
+    def acquire(self, reserve=0):
+        """
+        Blocks (cooperatively) until a token is acquired. Fails open
+        if Redis is unavailable.
+        """
+        while True:
+            try:
+                wait = self.try_acquire(reserve)
+            except redis_lib.exceptions.RedisError as e:
+                logging.warning(f"Rate limiter {self.key} unavailable, not throttling: {e}")
+                return
+            if wait <= 0:
+                return
+            cooperative_sleep(min(wait, 5))
+
+class ApiRateBudget:
+    """
+    Request budget of an API credential.
+
+    Combines a local pacing bucket with the limits reported by the
+    server through X-RateLimit-Remaining/X-RateLimit-Reset and
+    Retry-After headers (see record). Normal priority requests leave
+    burst_reserve tokens and remaining_reserve server-side requests to
+    high priority ones.
+    """
+    def __init__(self, name, per_hour, burst, burst_reserve=0, remaining_reserve=0, redis_client=None):
+        self.name = name
+        self.redis = redis_client or get_redis()
+        self.bucket = RedisTokenBucket(name, per_hour / 3600.0, burst, self.redis)
+        self.burst_reserve = burst_reserve
+        self.remaining_reserve = remaining_reserve
+        self.blocked_key = f"ratelimit:blocked:{name}"
+        self.low_key = f"ratelimit:low:{name}"
+
+    def acquire(self):
+        high = get_request_priority() == PRIORITY_HIGH
+        while True:
+            try:
+                keys = [self.blocked_key] if high else [self.blocked_key, self.low_key]
+                until = max([float(v) for v in self.redis.mget(keys) if v is not None], default=0)
+            except redis_lib.exceptions.RedisError as e:
+                logging.warning(f"Rate budget {self.name} unavailable, not throttling: {e}")
+                return
+            wait = until - time.time()
+            if wait <= 0:
+                break
+            logging.info(f"{self.name} rate limit reached, waiting {wait:.0f}s")
+            cooperative_sleep(min(wait, 30))
+        self.bucket.acquire(0 if high else self.burst_reserve)
+
+    def record(self, status, headers):
+        """
+        Updates the shared state from the response of a request.
+        """
+        now = time.time()
+        try:
+            retry_after = headers.get("Retry-After")
+            remaining = headers.get("X-RateLimit-Remaining")
+            reset = headers.get("X-RateLimit-Reset")
+            if retry_after is not None and status in (403, 429):
+                # Secondary rate limit, everyone backs off.
+                self._block(self.blocked_key, now + float(retry_after))
+            elif remaining is not None and reset is not None:
+                remaining = int(remaining)
+                if remaining == 0:
+                    self._block(self.blocked_key, float(reset))
+                elif remaining <= self.remaining_reserve:
+                    # Keep what is left for high priority requests.
+                    self._block(self.low_key, float(reset))
+        except ValueError:
+            pass
+        except redis_lib.exceptions.RedisError as e:
+            logging.warning(f"Could not record {self.name} rate limit state: {e}")
+
+    def _block(self, key, until):
+        ttl = max(1, int(until - time.time()) + 1)
+        self.redis.set(key, until, ex=ttl)
+
+# Drops expired holders, then adds the holder if there is a free slot
+# (or refreshes it if it already holds one).
+_SEMAPHORE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if redis.call('ZSCORE', KEYS[1], ARGV[3]) or redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('ZADD', KEYS[1], ARGV[4], ARGV[3])
+    redis.call('EXPIRE', KEYS[1], ARGV[5])
+    return 1
+end
+return 0
+"""
+
+class RedisSemaphore:
+    """
+    Counting semaphore shared by all processes through Redis.
+
+    name
+        Used in the Redis key.
+    limit
+        Maximum number of concurrent holders.
+    ttl
+        Seconds after which a slot that was not released (e.g., killed
+        worker) is freed.
+    """
+    def __init__(self, name, limit, ttl, redis_client=None):
+        self.key = f"semaphore:{name}"
+        self.limit = limit
+        self.ttl = int(ttl)
+        self.redis = redis_client or get_redis()
+        self._script = self.redis.register_script(_SEMAPHORE_SCRIPT)
+
+    def acquire(self, holder):
+        """
+        Takes a slot for holder (e.g., a task id) without waiting.
+        Returns True if acquired. Fails open if Redis is unavailable.
+        """
+        now = time.time()
+        try:
+            return bool(self._script(keys=[self.key],
+                                     args=[now, self.limit, holder, now + self.ttl, self.ttl]))
+        except redis_lib.exceptions.RedisError as e:
+            logging.warning(f"Semaphore {self.key} unavailable, not limiting: {e}")
+            return True
+
+    def release(self, holder):
+        try:
+            self.redis.zrem(self.key, holder)
+        except redis_lib.exceptions.RedisError as e:
+            logging.warning(f"Could not release {holder} from semaphore {self.key}: {e}")
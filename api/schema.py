@@ -50,6 +50,7 @@ class MystBuildSchema(Schema):
     is_prod = fields.Boolean(required=False,dump_default=False,description="Whether or not the build is intended for production.")
     build_cache = fields.Boolean(required=False,dump_default=True,description="Whether or not to use the MyST build cache.")
     prod_version = fields.String(required=False,dump_default="v1",description="Version suffix to be used to define the build directory.")
+    force = fields.Boolean(required=False,dump_default=False,description="Rebuild even if this commit has already been built with the same runtime image.")
 
 class BuildTestSchema(Schema):
     """
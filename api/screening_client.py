@@ -1,12 +1,18 @@
 import os
 import re
+import time
+import logging
+import threading
 import pytz
 import datetime
 import json
 import yaml
 import git
-from github import Github, InputFileContent
+from github import InputFileContent
 from common  import load_yaml, send_email
+from github_client import get_github_client, gh_get_repo, gh_get_issue, gh_get_comment, gh_handle_cache, \
+                          gh_cached_get, gh_read_issue_tags
+from ratelimit import request_priority, PRIORITY_HIGH
 from dotenv import load_dotenv
 from flask import jsonify, make_response
 
@@ -16,6 +22,71 @@ common_config = load_yaml("config/common.yaml")
 GH_ORGANIZATION = common_config['GH_ORGANIZATION']
 REVIEW_REPOSITORY = common_config['REVIEW_REPOSITORY']
 JOURNAL_NAME = common_config['JOURNAL_NAME']
+# Minimum number of seconds between two in-progress (STARTED) edits
+# of the same status comment.
+GH_COMMENT_UPDATE_INTERVAL = common_config.get('GH_COMMENT_UPDATE_INTERVAL', 10)
+
+class DebouncedCommentUpdater:
+    """
+    Coalesces rapid status comment edits of a task.
+
+    In-progress updates (submit) are applied at most once per interval,
+    the latest one always wins and is flushed by a background timer
+    (a greenlet under gevent). Terminal updates (flush_now) cancel any
+    pending edit and are applied synchronously, so they are never
+    dropped nor overwritten by an older in-progress state.
+    """
+    def __init__(self, update_func, interval=GH_COMMENT_UPDATE_INTERVAL):
+        self.update_func = update_func
+        self.interval = interval
+        self._lock = threading.Lock()
+        # Serializes the edits themselves to keep their order.
+        self._edit_lock = threading.Lock()
+        self._pending = None
+        self._timer = None
+        self._last_edit = 0.0
+
+    def submit(self, comment_body):
+        with self._lock:
+            self._pending = comment_body
+            if self._timer is not None:
+                # A flush is already scheduled, it will pick this body.
+                return
+            delay = self._last_edit + self.interval - time.monotonic()
+            if delay > 0:
+                self._timer = threading.Timer(delay, self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+                return
+        self._flush()
+
+    def flush_now(self, comment_body):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._pending = None
+        with self._edit_lock:
+            try:
+                return self.update_func(comment_body)
+            finally:
+                with self._lock:
+                    self._last_edit = time.monotonic()
+
+    def _flush(self):
+        with self._edit_lock:
+            with self._lock:
+                comment_body, self._pending = self._pending, None
+                self._timer = None
+            if comment_body is None:
+                return
+            try:
+                self.update_func(comment_body)
+            except Exception as e:
+                logging.warning(f"Could not update status comment: {e}")
+            finally:
+                with self._lock:
+                    self._last_edit = time.monotonic()
 
 class ScreeningClient:
     def __init__(self, task_name, issue_id=None, email_address=None, target_repo_url = None, task_id=None, comment_id=None, commit_hash=None, notify_target=False, review_repository=REVIEW_REPOSITORY, **extra_payload):
@@ -29,17 +100,18 @@ class ScreeningClient:
         self.commit_hash = commit_hash
         self.comment_id = comment_id
         self.notify_target = notify_target
+        self.comment_updater = None
+        self.issue_tags = None
         self.__extra_payload = extra_payload
         self._init_responder()
 
         for key, value in extra_payload.items():
             setattr(self, key, value)
 
-        # Private GitHub token
-        self.__gh_bot_token = os.getenv('GH_BOT')
-        self.github_client = Github(self.__gh_bot_token)
+        # Process-wide client authenticated with the bot token
+        self.github_client = get_github_client()
         if self.target_repo_url:
-            self.repo_object = self.github_client.get_repo(self.gh_filter(self.target_repo_url))
+            self.repo_object = gh_get_repo(self.github_client, self.gh_filter(self.target_repo_url))
         else:
             self.repo_object = None
 
@@ -62,6 +134,10 @@ class ScreeningClient:
                     comment_id = self.client.gh_create_comment(template['PENDING'])
                     self.comment_id = comment_id
                     return comment_id
+                elif self.client.comment_updater is not None:
+                    if self.phase == "STARTED":
+                        return self.client.comment_updater.submit(template[self.phase])
+                    return self.client.comment_updater.flush_now(template[self.phase])
                 else:
                     return self.client.gh_update_comment(template[self.phase])
 
@@ -82,6 +158,13 @@ class ScreeningClient:
 
         self.respond = ResponderContainer(self)
 
+    def enable_debounced_updates(self, interval=GH_COMMENT_UPDATE_INTERVAL):
+        """
+        Route status comment edits through a DebouncedCommentUpdater.
+        Meant for long running tasks that report progress frequently.
+        """
+        self.comment_updater = DebouncedCommentUpdater(self.gh_update_comment, interval)
+
     def to_dict(self):
         # Convert the object to a dictionary to pass to Celery
         result = {
@@ -112,11 +195,12 @@ class ScreeningClient:
         extra_payload = {key: value for key, value in data.items() if key not in standard_attrs}
         return cls(**standard_dict, **extra_payload)
 
-    def start_celery_task(self, celery_task_func):
+    def start_celery_task(self, celery_task_func, task_id=None):
         
         # This trick is needed to pass the ScreeningClient object to the Celery task.
         # This is because the ScreeningClient object cannot be serialized into JSON, which is required by Redis.
-        task_result = celery_task_func.apply_async(args=[self.to_dict()])
+        # task_id can be set in advance (e.g., to register the build before queueing it).
+        task_result = celery_task_func.apply_async(args=[self.to_dict()], task_id=task_id)
         
         if task_result.task_id is not None:
             self.task_id = task_result.task_id
@@ -196,42 +280,48 @@ class ScreeningClient:
         return input_str
 
     def gh_create_comment(self, comment_body, override_assign=False):
-        repo = self.github_client.get_repo(self.gh_filter(self.review_repository))
-        issue = repo.get_issue(number=self.issue_id)
-        commit_comment = issue.create_comment(comment_body)
+        review_repository = self.gh_filter(self.review_repository)
+        with request_priority(PRIORITY_HIGH):
+            issue = gh_get_issue(self.github_client, review_repository, self.issue_id)
+            commit_comment = issue.create_comment(comment_body)
+        gh_handle_cache.set(("comment", review_repository, commit_comment.id), commit_comment)
         if not override_assign:
             self.comment_id = commit_comment.id  # Update comment_id after creation
         return commit_comment.id
 
     def gh_update_comment(self, comment_body):
-        repo = self.github_client.get_repo(self.gh_filter(self.review_repository))
-        issue = repo.get_issue(self.issue_id)
-        comment = issue.get_comment(self.comment_id)
-        comment.edit(comment_body)
+        review_repository = self.gh_filter(self.review_repository)
+        try:
+            with request_priority(PRIORITY_HIGH):
+                comment = gh_get_comment(self.github_client, review_repository, self.issue_id, self.comment_id)
+                comment.edit(comment_body)
+        except Exception:
+            gh_handle_cache.invalidate(("comment", review_repository, int(self.comment_id)))
+            raise
 
     def gh_get_project_name(self):
-        repo = self.github_client.get_repo(self.gh_filter(self.review_repository))
+        repo = gh_get_repo(self.github_client, self.gh_filter(self.review_repository))
         contents = repo.get_contents("binder/data_requirement.json")
         data = json.loads(contents.decoded_content)
         return data['projectName']
 
     def gh_fork_repository(self, source_repo):
-        repo_to_fork = self.github_client.get_repo(self.gh_filter(source_repo))
+        repo_to_fork = gh_get_repo(self.github_client, self.gh_filter(source_repo))
         target_org = self.github_client.get_organization(self.GH_ORGANIZATION)
         forked_repo = target_org.create_fork(repo_to_fork)
         return forked_repo
 
     def gh_get_file_content(self, file_path):
-        repo = self.github_client.get_repo(self.gh_filter(self.review_repository))
         try:
-            file_content = repo.get_contents(file_path).decoded_content.decode()
+            file_content = gh_cached_get(f"/repos/{self.gh_filter(self.review_repository)}/contents/{file_path}",
+                                         accept="application/vnd.github.raw")
         except Exception as e:
             print(f"Error retrieving file content: {str(e)}")
             return ""
-        return file_content
+        return file_content or ""
 
     def gh_update_file_content(self, file_path, new_content, commit_message):
-        repo = self.github_client.get_repo(self.gh_filter(self.review_repository))
+        repo = gh_get_repo(self.github_client, self.gh_filter(self.review_repository))
         try:
             file = repo.get_contents(file_path)
             repo.update_file(file.path, commit_message, new_content, file.sha)
@@ -266,25 +356,22 @@ class ScreeningClient:
     def gh_get_paper_markdown(self):
         return self.gh_get_file_content("paper.md")
 
+    def gh_read_issue_tags(self, refresh=False):
+        """
+        Tags of the review issue, fetched once for this client (i.e., the task).
+        """
+        if self.issue_tags is None or refresh:
+            self.issue_tags = gh_read_issue_tags(self.github_client, self.gh_filter(self.review_repository), self.issue_id)
+        return self.issue_tags
+
     def gh_read_from_issue_body(self, tag):
-        repo = self.github_client.get_repo(self.gh_filter(self.review_repository))
-        issue = repo.get_issue(self.issue_id)
-        issue_body = issue.body
-        start_marker = f"<!--{tag}-->"
-        end_marker = f"<!--end-{tag}-->"
-        start_index = issue_body.find(start_marker)
-        end_index = issue_body.find(end_marker)
-        if start_index != -1 and end_index != -1:
-            extracted_text = issue_body[start_index + len(start_marker):end_index].strip()
-            if extracted_text == "Pending":
-                extracted_text = None
-        else:
-            extracted_text = None
-        return extracted_text
+        return self.gh_read_issue_tags().get(tag)
 
     def get_default_branch(self):
-        repo = self.github_client.get_repo(self.gh_filter(self.review_repository))
-        return repo.default_branch
+        repo = gh_cached_get(f"/repos/{self.gh_filter(self.review_repository)}")
+        if repo is None:
+            raise ValueError(f"Repository {self.gh_filter(self.review_repository)} not found")
+        return json.loads(repo)["default_branch"]
 
     @staticmethod
     def gh_clone_repository(repo_url, target_path, depth=1):
@@ -0,0 +1,134 @@
+import time
+import json
+import logging
+import redis as redis_lib
+from common import load_yaml, get_redis
+
+"""
+Task progress events.
+
+Tasks publish their phase changes, progress counters and log lines
+to a Redis pub/sub channel per task. The last events are also kept
+in a list, so that clients connecting late (or reconnecting) get
+what they missed. The web apps relay them as server-sent events.
+"""
+
+common_config = load_yaml('config/common.yaml')
+
+# Number of events kept per task, and for how long (seconds).
+TASK_EVENTS_HISTORY = common_config.get('TASK_EVENTS_HISTORY', 500)
+TASK_EVENTS_TTL = common_config.get('TASK_EVENTS_TTL', 86400)
+# Seconds between two keepalive comments on an idle stream.
+TASK_EVENTS_KEEPALIVE = common_config.get('TASK_EVENTS_KEEPALIVE', 15)
+# Streams of a task that never published an event and is still PENDING
+# (Celery cannot tell an unknown task from a queued one) end after this
+# many seconds.
+TASK_EVENTS_UNKNOWN_TIMEOUT = common_config.get('TASK_EVENTS_UNKNOWN_TIMEOUT', 600)
+
+EVENT_STATE = "state"
+EVENT_PROGRESS = "progress"
+EVENT_LOG = "log"
+# Last event of a task, published when it returns (see task_postrun).
+EVENT_END = "end"
+
+# Celery states of finished tasks.
+TERMINAL_STATES = ("SUCCESS", "FAILURE", "REVOKED", "IGNORED")
+
+def _channel(task_id):
+    return f"task-events:{task_id}"
+
+def _history_key(task_id):
+    return f"task-events-history:{task_id}"
+
+def _seq_key(task_id):
+    return f"task-events-seq:{task_id}"
+
+def publish_task_event(task_id, event_type, **data):
+    """
+    Publishes an event of a task. Never raises, events are best effort.
+    """
+    if task_id is None:
+        return
+    try:
+        redis_client = get_redis()
+        seq = redis_client.incr(_seq_key(task_id))
+        payload = json.dumps(dict(id=seq, type=event_type, task_id=task_id, time=time.time(), **data), default=str)
+        pipe = redis_client.pipeline()
+        pipe.expire(_seq_key(task_id), TASK_EVENTS_TTL)
+        pipe.rpush(_history_key(task_id), payload)
+        pipe.ltrim(_history_key(task_id), -TASK_EVENTS_HISTORY, -1)
+        pipe.expire(_history_key(task_id), TASK_EVENTS_TTL)
+        pipe.publish(_channel(task_id), payload)
+        pipe.execute()
+    except redis_lib.exceptions.RedisError as e:
+        logging.warning(f"Could not publish {event_type} event of task {task_id}: {e}")
+
+def format_sse(payload):
+    """
+    Formats a published event (JSON string) as a server-sent event.
+    """
+    event = json.loads(payload)
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {payload}\n\n"
+
+def _is_terminal(event):
+    return event['type'] == EVENT_END
+
+def task_event_stream(task_id, last_event_id=0, get_task_state=None):
+    """
+    Generator of server-sent events for a task.
+
+    last_event_id
+        Events up to this id are not sent again (Last-Event-ID header).
+    get_task_state
+        Called with the task id on idle streams, returns the Celery state.
+        Ends the stream if the task finished without publishing its
+        end event (e.g., killed worker), or if it is still PENDING without
+        any event after TASK_EVENTS_UNKNOWN_TIMEOUT (e.g., unknown task id).
+
+    Ends after the end event of the task. Keepalive comments are
+    sent while idle so that proxies do not close the connection.
+    """
+    pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+    # Subscribe before reading the history, so that nothing published
+    # in between is lost (duplicates are skipped by id).
+    pubsub.subscribe(_channel(task_id))
+    try:
+        for payload in get_redis().lrange(_history_key(task_id), 0, -1):
+            payload = payload.decode()
+            event = json.loads(payload)
+            if event['id'] <= last_event_id:
+                continue
+            last_event_id = event['id']
+            yield format_sse(payload)
+            if _is_terminal(event):
+                return
+
+        stream_started = last_message = time.time()
+        while True:
+            message = pubsub.get_message(timeout=1.0)
+            if message is not None and message['type'] == 'message':
+                payload = message['data'].decode()
+                event = json.loads(payload)
+                if event['id'] <= last_event_id:
+                    continue
+                last_event_id = event['id']
+                last_message = time.time()
+                yield format_sse(payload)
+                if _is_terminal(event):
+                    return
+            elif time.time() - last_message > TASK_EVENTS_KEEPALIVE:
+                last_message = time.time()
+                if get_task_state is not None:
+                    state = get_task_state(task_id)
+                    if state in TERMINAL_STATES:
+                        yield f"event: {EVENT_END}\ndata: {json.dumps(dict(type=EVENT_END, task_id=task_id, state=state))}\n\n"
+                        return
+                    if state == "PENDING" and last_event_id == 0 and time.time() - stream_started > TASK_EVENTS_UNKNOWN_TIMEOUT:
+                        yield f"event: {EVENT_END}\ndata: {json.dumps(dict(type=EVENT_END, task_id=task_id, state=state, message='No event was published for this task'))}\n\n"
+                        return
+                yield ": keepalive\n\n"
+    except redis_lib.exceptions.RedisError as e:
+        logging.warning(f"Event stream of task {task_id} interrupted: {e}")
+        yield f"event: error\ndata: {json.dumps(dict(message='Event stream unavailable'))}\n\n"
+    finally:
+        pubsub.close()
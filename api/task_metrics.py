@@ -0,0 +1,144 @@
+import time
+import logging
+import contextlib
+import redis as redis_lib
+from prometheus_client import CollectorRegistry, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import HistogramMetricFamily
+from common import get_redis
+
+"""
+Timing of task phases, exported as Prometheus histograms.
+
+Tasks time their phases (spawning JupyterHub, building, archiving,
+uploading...) with a context manager. Observations are aggregated in
+Redis, as tasks run in the worker processes and the metrics are served
+by the web apps (/api/metrics).
+"""
+
+# Upper bounds of the histogram buckets (+Inf is implicit).
+SECONDS_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+BYTES_BUCKETS = (10**6, 10**7, 10**8, 5 * 10**8, 10**9, 5 * 10**9, 10**10, 5 * 10**10)
+
+METRICS_KEY_PREFIX = "task-metrics:"
+PHASE_SECONDS = "neurolibre_task_phase_seconds"
+PHASE_BYTES = "neurolibre_task_phase_bytes"
+TASK_SECONDS = "neurolibre_task_seconds"
+
+# name: (documentation, label names, buckets)
+METRICS = {
+    PHASE_SECONDS: ("Duration of task phases.", ("task", "phase", "outcome"), SECONDS_BUCKETS),
+    PHASE_BYTES: ("Bytes produced or transferred by task phases.", ("task", "phase"), BYTES_BUCKETS),
+    TASK_SECONDS: ("Duration of tasks.", ("task", "state"), SECONDS_BUCKETS),
+}
+
+OUTCOME_SUCCESS = "success"
+OUTCOME_FAILURE = "failure"
+OUTCOME_ERROR = "error"
+
+# Label values cannot contain the field separator.
+_SEP = "|"
+
+def observe(metric, labels, value):
+    """
+    Records an observation of a histogram. Never raises, metrics are
+    best effort.
+    """
+    _, _, buckets = METRICS[metric]
+    bucket = next((str(le) for le in buckets if value <= le), "+Inf")
+    field = _SEP.join(str(label).replace(_SEP, "/") for label in labels)
+    try:
+        pipe = get_redis().pipeline()
+        key = f"{METRICS_KEY_PREFIX}{metric}"
+        pipe.hincrby(key, f"{field}{_SEP}bucket{_SEP}{bucket}", 1)
+        pipe.hincrbyfloat(key, f"{field}{_SEP}sum", value)
+        pipe.execute()
+    except redis_lib.exceptions.RedisError as e:
+        logging.warning(f"Could not record {metric} {labels}: {e}")
+
+class Phase:
+    """
+    A timed phase of a task. Within the block, set nbytes to the
+    size of what the phase produced or transferred, and outcome if
+    it did not end as success (e.g., "skipped").
+    """
+    def __init__(self, task_name, name):
+        self.task_name = task_name
+        self.name = name
+        self.nbytes = None
+        self.outcome = OUTCOME_SUCCESS
+        self.started = None
+        self.duration = None
+
+    def summary(self):
+        text = f"{self.duration:.1f}s {self.outcome}"
+        if self.nbytes is not None:
+            text += f" {self.nbytes} bytes"
+        return text
+
+@contextlib.contextmanager
+def phase(task_name, name, on_end=None):
+    """
+    Times a phase of a task:
+
+    with phase("myst_upload_task", "upload") as p:
+        ...
+        p.nbytes = os.path.getsize(archive)
+
+    The outcome is "error" if the block raises (unless set to something
+    else than success before). on_end is called with
+    the phase once it is recorded.
+    """
+    p = Phase(task_name, name)
+    p.started = time.time()
+    try:
+        yield p
+    except BaseException:
+        if p.outcome == OUTCOME_SUCCESS:
+            p.outcome = OUTCOME_ERROR
+        raise
+    finally:
+        p.duration = time.time() - p.started
+        observe(PHASE_SECONDS, (task_name, name, p.outcome), p.duration)
+        if p.nbytes is not None:
+            observe(PHASE_BYTES, (task_name, name), p.nbytes)
+        if on_end is not None:
+            on_end(p)
+
+class RedisHistogramCollector:
+    """
+    Prometheus collector of the histograms aggregated in Redis.
+    """
+    def collect(self):
+        redis_client = get_redis()
+        for metric, (documentation, label_names, buckets) in METRICS.items():
+            fields = redis_client.hgetall(f"{METRICS_KEY_PREFIX}{metric}")
+            series = {}
+            for field, value in fields.items():
+                parts = field.decode().split(_SEP)
+                labels = tuple(parts[:len(label_names)])
+                entry = series.setdefault(labels, dict(buckets={}, sum=0.0))
+                kind = parts[len(label_names)]
+                if kind == "bucket":
+                    entry['buckets'][parts[-1]] = int(value)
+                elif kind == "sum":
+                    entry['sum'] = float(value)
+            family = HistogramMetricFamily(metric, documentation, labels=label_names)
+            for labels, entry in series.items():
+                cumulative = 0
+                histogram_buckets = []
+                for le in [str(b) for b in buckets] + ["+Inf"]:
+                    cumulative += entry['buckets'].get(le, 0)
+                    histogram_buckets.append((le, cumulative))
+                family.add_metric(list(labels), histogram_buckets, entry['sum'])
+            yield family
+
+def generate_metrics(*collectors):
+    """
+    Returns (body, content_type) of the Prometheus exposition, with
+    the metrics of additional collectors.
+    """
+    registry = CollectorRegistry()
+    registry.register(RedisHistogramCollector())
+    for collector in collectors:
+        registry.register(collector)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
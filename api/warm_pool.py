@@ -0,0 +1,226 @@
+import json
+import time
+import socket
+import logging
+import docker
+import gevent
+import requests
+import redis as redis_lib
+from gevent import sleep as cooperative_sleep
+from common import load_yaml, get_redis, get_http_session, REDIS_LOCK_DB
+
+"""
+Warm pool of JupyterHub containers for MyST builds.
+
+Spawning the execution container (image pull, container start, Jupyter
+server start) dominates short builds. Instead of removing it after a
+successful build, the container is parked in the pool, idle, and the
+next build of the same repository with the same image and limits
+claims it. The sources are mounted when a container is spawned (Docker
+cannot add mounts to a running container), so containers are pooled
+per mounted latest/ directory: it is updated in place by the next
+build, and the mount stays valid. A container is not reused if the
+updated sources require another dataset than the one it mounts.
+
+Idle containers are removed after WARM_POOL_IDLE_TIMEOUT, and at most
+WARM_POOL_SIZE containers are parked per host.
+"""
+
+common_config = load_yaml('config/common.yaml')
+
+WARM_POOL_ENABLED = common_config.get('WARM_POOL_ENABLED', False)
+WARM_POOL_SIZE = common_config.get('WARM_POOL_SIZE', 4)
+WARM_POOL_IDLE_TIMEOUT = common_config.get('WARM_POOL_IDLE_TIMEOUT', 900)
+
+# Containers are local to the docker daemon of a host.
+POOL_KEY = f"warm-pool:{socket.gethostname()}"
+
+# Returns the first idle container of the key that has not expired.
+_CLAIM_SCRIPT = """
+local entries = redis.call('HGETALL', KEYS[1])
+for i = 1, #entries, 2 do
+    local entry = cjson.decode(entries[i + 1])
+    if entry['key'] == ARGV[1] and entry['idle_since'] + tonumber(ARGV[3]) > tonumber(ARGV[2]) then
+        redis.call('HDEL', KEYS[1], entries[i])
+        return entries[i + 1]
+    end
+end
+return false
+"""
+
+# Parks a container if the pool is not full. Returns 1 if parked.
+_PARK_SCRIPT = """
+if redis.call('HLEN', KEYS[1]) >= tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+return 1
+"""
+
+_reaper = None
+
+def pool_key(source_dir, image, cpu_limit, memory_limit):
+    """
+    Containers are interchangeable if they mount the same sources and
+    run the same image with the same limits.
+    """
+    return f"{source_dir}|{image}|{cpu_limit}|{memory_limit}"
+
+def _remove_container(docker_client, container_id):
+    try:
+        container = docker_client.containers.get(container_id)
+        container.stop(timeout=10)
+        container.remove(force=True)
+    except docker.errors.NotFound:
+        pass
+    except docker.errors.DockerException as e:
+        logging.warning(f"Could not remove pooled container {container_id}: {e}")
+
+def claim_container(hub, key):
+    """
+    Attaches an idle container of the pool to the (not spawned) hub.
+
+    Returns True if the hub now runs in a pooled container. The caller
+    still has to update the sources (clone/checkout in latest/).
+    """
+    # Idle containers left by a previous worker process are reaped too.
+    _start_reaper()
+    redis_client = get_redis(REDIS_LOCK_DB)
+    script = redis_client.register_script(_CLAIM_SCRIPT)
+    while True:
+        try:
+            entry = script(keys=[POOL_KEY], args=[key, time.time(), WARM_POOL_IDLE_TIMEOUT])
+        except redis_lib.exceptions.RedisError as e:
+            logging.warning(f"Warm pool unavailable: {e}")
+            return False
+        if not entry:
+            return False
+        entry = json.loads(entry)
+        try:
+            container = hub.rees.docker_client.containers.get(entry['container_id'])
+            container.reload()
+        except docker.errors.DockerException:
+            continue
+        if container.status != "running":
+            _remove_container(hub.rees.docker_client, entry['container_id'])
+            continue
+        hub.container = container
+        hub.port = entry['port']
+        hub.jh_token = entry['token']
+        hub.jh_url = entry['url']
+        # Dataset mounted when the container was spawned.
+        hub.warm_dataset = entry.get('dataset')
+        logging.info(f"Claimed warm container {container.short_id} for {key}.")
+        return True
+
+def _mounted_dataset(hub):
+    """
+    Host path of the dataset a hub would mount for its sources, None
+    if no dataset is staged.
+    """
+    dataset_path = hub._dataset_host_path()
+    if dataset_path is None or not hub._is_populated_dir(dataset_path):
+        return None
+    return str(dataset_path)
+
+def dataset_matches(hub):
+    """
+    Whether the claimed container mounts the dataset required by the
+    updated sources (the data mount cannot be changed either).
+    """
+    return getattr(hub, 'warm_dataset', None) == _mounted_dataset(hub)
+
+def discard_container(hub):
+    """
+    Removes a claimed container that cannot be used, the hub can
+    be spawned afterwards.
+    """
+    _remove_container(hub.rees.docker_client, hub.container.id)
+    hub.container = None
+    del hub.warm_dataset
+
+def _shutdown_kernels(hub):
+    """
+    Leaves the Jupyter server as a fresh one: no kernel, no session.
+    """
+    session = get_http_session()
+    headers = {'Authorization': f"token {hub.jh_token}"}
+    for kernel in session.get(f"{hub.jh_url}/api/kernels", headers=headers, timeout=10).json():
+        session.delete(f"{hub.jh_url}/api/kernels/{kernel['id']}", headers=headers, timeout=10)
+
+def park_container(hub, key):
+    """
+    Returns the container of a finished build to the pool. Returns
+    False if it was not pooled (pool full or container unhealthy),
+    the caller removes it then.
+    """
+    if hub is None or hub.container is None:
+        return False
+    try:
+        hub.container.reload()
+        if hub.container.status != "running":
+            return False
+        _shutdown_kernels(hub)
+    except (docker.errors.DockerException, requests.exceptions.RequestException, ValueError) as e:
+        logging.warning(f"Not pooling container {hub.container.short_id}: {e}")
+        return False
+    if hasattr(hub, 'warm_dataset'):
+        dataset = hub.warm_dataset
+    else:
+        dataset = _mounted_dataset(hub) if getattr(hub, 'dataset_available', False) else None
+    entry = json.dumps(dict(container_id=hub.container.id, key=key, port=hub.port,
+                            token=hub.jh_token, url=hub.jh_url, dataset=dataset,
+                            idle_since=time.time()))
+    try:
+        redis_client = get_redis(REDIS_LOCK_DB)
+        script = redis_client.register_script(_PARK_SCRIPT)
+        if not int(script(keys=[POOL_KEY], args=[hub.container.id, entry, WARM_POOL_SIZE])):
+            return False
+    except redis_lib.exceptions.RedisError as e:
+        logging.warning(f"Warm pool unavailable: {e}")
+        return False
+    # Container statistics are reported per build.
+    stats_collector = getattr(hub, '_stats_collector', None)
+    if stats_collector is not None:
+        stats_collector.stop()
+        hub._stats_collector = None
+    logging.info(f"Parked container {hub.container.short_id} in the warm pool for {key}.")
+    _start_reaper()
+    return True
+
+def reap_idle_containers():
+    """
+    Removes the containers of this host that have been idle for too long.
+    Returns the number of pooled containers left.
+    """
+    redis_client = get_redis(REDIS_LOCK_DB)
+    docker_client = docker.from_env()
+    now = time.time()
+    entries = redis_client.hgetall(POOL_KEY)
+    for container_id, entry in entries.items():
+        entry = json.loads(entry)
+        # Removed from the pool first, a build might be claiming it.
+        if entry['idle_since'] + WARM_POOL_IDLE_TIMEOUT <= now and redis_client.hdel(POOL_KEY, container_id):
+            logging.info(f"Removing idle container {entry['container_id'][:12]} ({entry['key']}).")
+            _remove_container(docker_client, entry['container_id'])
+    return redis_client.hlen(POOL_KEY)
+
+def _reap_forever():
+    global _reaper
+    try:
+        while True:
+            cooperative_sleep(min(60, WARM_POOL_IDLE_TIMEOUT / 2))
+            if reap_idle_containers() == 0:
+                break
+    except (redis_lib.exceptions.RedisError, docker.errors.DockerException) as e:
+        logging.warning(f"Warm pool reaper stopped: {e}")
+    finally:
+        _reaper = None
+
+def _start_reaper():
+    """
+    Removes idle containers in the background while the pool is not empty.
+    """
+    global _reaper
+    if _reaper is None:
+        _reaper = gevent.spawn(_reap_forever)